@@ -0,0 +1,92 @@
+# coding: utf-8
+
+"""Benchmark reading a large FETCH literal, imaplib vs betterimap.IMAP4.
+
+Modes:
+    imaplib, betterimap: only read the literal.
+    imaplib+parse: read it, then email.message_from_string().
+    stream: parse it with FeedParser while reading.
+
+Each mode runs in a separate process, so that peak RSS is its own:
+
+    python benchmarks/large_literal.py [size in MB, 50 by default]
+"""
+
+import email
+import imaplib
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import betterimap
+
+CHUNK = 'x' * 1023 + '\n'
+HEADER = 'Subject: large\r\n\r\n'
+
+
+def serve(listener, size):
+    conn, _ = listener.accept()
+    conn.sendall('* 1 FETCH (RFC822 {%d}\r\n' % size)
+    conn.sendall(HEADER)
+    chunk = CHUNK * 64
+    sent = len(HEADER)
+    while sent < size:
+        data = chunk[:size - sent]
+        conn.sendall(data)
+        sent += len(data)
+    conn.sendall(')\r\n')
+    conn.close()
+
+
+def run(mode, size):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = threading.Thread(target=serve, args=(listener, size))
+    server.daemon = True
+    server.start()
+
+    base = imaplib.IMAP4 if mode.startswith('imaplib') else betterimap.IMAP4
+
+    class Reader(base):
+        """Reads from a connected socket, without the IMAP4 handshake."""
+
+        def __init__(self, sock):
+            self.sock = sock
+            self.file = sock.makefile('rb')
+
+    mail = Reader(socket.create_connection(listener.getsockname()))
+    mail.stream_messages = mode == 'stream'
+
+    start = time.time()
+    line = mail.readline()
+    literal = mail.read(int(line[line.rindex('{') + 1:-3]))
+    mail.readline()
+    if mode == 'imaplib+parse':
+        literal = email.message_from_string(literal)
+    elif mode == 'stream':
+        literal = literal.message
+    elapsed = time.time() - start
+    assert mode in ('imaplib+parse', 'stream') or len(literal) == size
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print '%-14s %8.1f MB/s %8.1f MB peak RSS' % (
+        mode, size / elapsed / 1024 / 1024, peak_mb)
+
+
+def main():
+    if len(sys.argv) == 3:
+        run(sys.argv[1], int(sys.argv[2]))
+        return
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 50) * 1024 * 1024
+    for mode in ('imaplib', 'betterimap', 'imaplib+parse', 'stream'):
+        subprocess.check_call([sys.executable, __file__, mode, str(size)])
+
+
+if __name__ == '__main__':
+    main()
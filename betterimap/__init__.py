@@ -2,26 +2,39 @@
 
 """Utils for logging into imap services and parsing emails."""
 
+import binascii
+import bisect
+import codecs
+import collections
 import datetime
 import email
+import email.feedparser
 import email.message
 import email.utils
 import email.header
 import imaplib
 import logging
 import json
+import operator
+import quopri
 import re
+import select
 import socket
 import time
 import threading
 import Queue
 import urllib
 import urllib2
+import zlib
 
 try:
-    import chardet
+    # cChardet is a faster drop-in replacement for chardet.
+    import cchardet as chardet
 except ImportError:
-    chardet = None
+    try:
+        import chardet
+    except ImportError:
+        chardet = None
 
 from . import imapUTF7
 
@@ -30,6 +43,9 @@ log = logging.getLogger(__name__)
 # Default maximum amount of messages to fetch.
 FETCH_LIMIT = 100
 
+# How many bytes of an attachment to request with a single partial FETCH.
+PART_CHUNK_SIZE = 1024 * 1024
+
 ZERO = datetime.timedelta(0)
 
 ATTACH_FILENAME_RE = re.compile(r'name=(\S+)')
@@ -60,6 +76,169 @@ class OAuth2Error(AuthError):
     pass
 
 
+class LRUCache(object):
+    """A thread-safe mapping of up to max_size least recently used items.
+
+    Set max_size to 0 to disable the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self):
+        """The share of get() calls that found the key, from 0 to 1."""
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def get(self, key, default=None):
+        if self.max_size <= 0:
+            return default
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove all items and reset the counters."""
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+
+# Decoded header values, shared by all messages, as the same From: and
+# Subject: values repeat a lot in a mailbox. Keyed by (MessageWrapper class,
+# raw header value).
+header_cache = LRUCache(10000)
+
+# Charset detection results keyed by (backend, sample size, raw string), as
+# detectors with different backends may disagree. Only strings up to
+# CHARDET_CACHE_MAX_LENGTH bytes are cached, e.g. headers, but not payloads.
+# Callers apply their confidence thresholds to the cached results.
+chardet_cache = LRUCache(10000)
+CHARDET_CACHE_MAX_LENGTH = 1024
+
+# How many first bytes of a string CharsetDetector examines.
+CHARSET_SAMPLE_SIZE = 64 * 1024
+
+_NON_ASCII_RE = re.compile(u'[^\x00-\x7f]')
+
+
+class CharsetDetector(object):
+    """Guesses the charset of strings, like chardet.detect().
+
+    Only the first sample_size bytes are examined. The sample is first
+    checked to be ASCII or valid UTF-8, which is much cheaper than chardet,
+    and UTF-8 gets the same confidence as from chardet's UTF-8 prober.
+    Other samples are passed to the backend.
+
+    The number of detections and the time spent are accumulated in "calls"
+    and "seconds".
+
+    Example, to use a different detector:
+
+        betterimap.charset_detector = betterimap.CharsetDetector(
+            backend=chardet, sample_size=4096)
+    """
+
+    def __init__(self, backend=None, sample_size=CHARSET_SAMPLE_SIZE):
+        """Create a detector.
+
+        Args:
+            backend: a module or object with chardet compatible detect().
+              By default cchardet if it is installed, otherwise chardet.
+            sample_size: how many first bytes of a string to examine.
+        """
+        self.backend = backend
+        self.sample_size = sample_size
+        self.calls = 0
+        self.seconds = 0.0
+
+    @property
+    def mean_time(self):
+        """Average seconds spent in one detection."""
+        return self.seconds / self.calls if self.calls else 0.0
+
+    def detect(self, data):
+        """Detect the charset of a string.
+
+        Returns a dictionary with "encoding" and "confidence" keys, or None if
+        no backend is installed.
+        """
+        backend = self.backend or chardet
+        if backend is None:
+            return
+        use_cache = len(data) <= CHARDET_CACHE_MAX_LENGTH
+        if use_cache:
+            key = (backend, self.sample_size, data)
+            detected = chardet_cache.get(key)
+            if detected is not None:
+                return detected
+        start = time.time()
+        sample = data[:self.sample_size]
+        detected = self._detect_utf8(sample, len(sample) < len(data))
+        if detected is None:
+            detected = backend.detect(sample)
+        elapsed = time.time() - start
+        self.calls += 1
+        self.seconds += elapsed
+        log.debug(
+            'Detected %s in %d bytes in %.2f ms', detected.get('encoding'),
+            len(sample), elapsed * 1000)
+        if use_cache:
+            chardet_cache.put(key, detected)
+        return detected
+
+    @staticmethod
+    def _detect_utf8(sample, truncated):
+        """Check if the sample is ASCII or UTF-8, return None if not."""
+        if '\x1b' in sample:
+            # 7-bit encodings like ISO-2022-JP are left to the backend.
+            return
+        try:
+            text = codecs.getincrementaldecoder('utf-8')().decode(
+                sample, final=not truncated)
+        except UnicodeDecodeError:
+            return
+        non_ascii = 0
+        for _ in _NON_ASCII_RE.finditer(text):
+            non_ascii += 1
+            if non_ascii == 6:
+                break
+        if not non_ascii:
+            return {'encoding': 'ascii', 'confidence': 1.0}
+        # The confidence formula of chardet's UTF8Prober.
+        confidence = 0.99
+        if non_ascii < 6:
+            confidence = 1 - 0.99 * 0.5 ** non_ascii
+        return {'encoding': 'utf-8', 'confidence': confidence}
+
+
+# The CharsetDetector used by MessageWrapper.
+charset_detector = CharsetDetector()
+
+
 class UTC(datetime.tzinfo):
     """UTC timezone, copied from stdlib documentation."""
 
@@ -112,12 +291,265 @@ class Attachment(object):
         """Integer length of the attachment."""
         return len(self)
 
+    def iter_chunks(self, chunk_size=PART_CHUNK_SIZE):
+        """Yield the decoded attachment data in strings of up to chunk_size."""
+        data = self.data or ''
+        for offset in xrange(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    def save_to(self, fileobj, chunk_size=PART_CHUNK_SIZE):
+        """Write the decoded attachment data to a file object.
+
+        Returns the number of bytes written.
+        """
+        written = 0
+        for chunk in self.iter_chunks(chunk_size):
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
     @property
     def content_type(self):
         """String content type of the attachment."""
         return self.msg.get_content_type()
 
 
+class RemoteAttachment(Attachment):
+    """An attachment described by BODYSTRUCTURE, downloaded on first access.
+
+    The filename, content type and encoded size are known without
+    downloading the attachment.
+    """
+
+    def __init__(self, msg, part):
+        assert isinstance(msg, MessageWrapper)
+        assert isinstance(part, BodyPart)
+        self.msg = msg
+        self.part = part
+        self._data = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def filename(self):
+        """String attachment filename, if it's defined."""
+        if self.part.disposition != 'attachment':
+            return
+        return self.part.filename
+
+    @property
+    def data(self):
+        """String payload of the attachment, fetched from the server once."""
+        if self._data is None:
+            self._data = self._adapter().fetch_part(
+                self.msg.uid, self.part.part, encoding=self.part.encoding,
+                by_uid=self._by_uid())
+        return self._data
+
+    def iter_chunks(self, chunk_size=PART_CHUNK_SIZE):
+        """Yield the decoded attachment data, fetched chunk_size at a time.
+
+        Unlike data, the attachment is not kept in memory. Chunks may be a
+        bit shorter than chunk_size after decoding.
+        """
+        if self._data is not None:
+            return super(RemoteAttachment, self).iter_chunks(chunk_size)
+        return self._adapter().iter_part(
+            self.msg.uid, self.part.part, encoding=self.part.encoding,
+            chunk_size=chunk_size, by_uid=self._by_uid())
+
+    def _adapter(self):
+        if self.msg.adapter is None:
+            raise NotSupported(
+                'The message was not fetched with IMAPAdapter, '
+                'cannot download the attachment')
+        return self.msg.adapter
+
+    def _by_uid(self):
+        # uidvalidity is only set on messages fetched by uid.
+        return self.msg.uidvalidity is not None
+
+    @property
+    def size(self):
+        """Integer length of the attachment.
+
+        Until the data is downloaded, this is estimated from the encoded size.
+        """
+        if self._data is not None:
+            return len(self._data)
+        size = self.part.size or 0
+        if self.part.encoding == 'base64':
+            # 76 characters per line plus CRLF, 4 characters per 3 bytes.
+            return (size - size // 78 * 2) * 3 // 4
+        return size
+
+    @property
+    def encoded_size(self):
+        """Integer size of the attachment as stored on the server."""
+        return self.part.size
+
+    @property
+    def content_type(self):
+        """String content type of the attachment."""
+        return self.part.content_type
+
+
+class BodyPart(object):
+    """A MIME part of a message, parsed from a BODYSTRUCTURE response.
+
+    Attributes:
+        part: the part number for BODY[<part>] fetches, e.g. "2.1", or an
+          empty string for the top-level multipart message.
+        content_type: lower-case content type, e.g. "application/pdf".
+        params: a dictionary of content type parameters, e.g. charset.
+        encoding: lower-case content transfer encoding, e.g. "base64".
+        size: integer size of the encoded part body.
+        disposition: lower-case content disposition, e.g. "attachment".
+        disposition_params: a dictionary of disposition parameters.
+        parts: a list of BodyPart children of multipart or message/rfc822
+          parts.
+    """
+
+    def __init__(
+        self, part, content_type, params=None, id=None, description=None,
+        encoding=None, size=None, lines=None, disposition=None,
+        disposition_params=None, parts=()
+    ):
+        self.part = part
+        self.content_type = content_type
+        self.params = params or {}
+        self.id = id
+        self.description = description
+        self.encoding = encoding
+        self.size = size
+        self.lines = lines
+        self.disposition = disposition
+        self.disposition_params = disposition_params or {}
+        self.parts = list(parts)
+
+    def __repr__(self):
+        return '<BodyPart %s %s, size %s>' % (
+            self.part or 'TEXT', self.content_type, self.size)
+
+    @property
+    def filename(self):
+        """Unicode filename from the disposition or content type parameters."""
+        for params, name in ((self.disposition_params, 'filename'),
+                             (self.params, 'name')):
+            if params.get(name + '*'):
+                charset, _, value = email.utils.decode_rfc2231(
+                    params[name + '*'])
+                value = urllib.unquote(value)
+                try:
+                    return value.decode(charset or 'ascii')
+                except (UnicodeDecodeError, LookupError):
+                    return value.decode('utf-8', 'replace')
+            if params.get(name):
+                return u''.join(MessageWrapper._get_header(params[name]))
+
+    def walk(self):
+        """Recursively walk this part and its children."""
+        yield self
+        for part in self.parts:
+            for child in part.walk():
+                yield child
+
+    def attachment_parts(self):
+        """Get parts MessageWrapper.attachments() treats as attachments."""
+        if self.content_type != 'multipart/mixed':
+            return []
+        return [
+            part for part in self.parts
+            if not part.content_type.startswith('multipart/')]
+
+    @classmethod
+    def parse(cls, structure, part=None):
+        """Make a BodyPart tree from a parsed BODYSTRUCTURE list."""
+        if not isinstance(structure, list) or not structure:
+            raise Error('Unexpected BODYSTRUCTURE: %r' % (structure, ))
+        if isinstance(structure[0], list):
+            return cls._parse_multipart(structure, part or '')
+        return cls._parse_single(structure, part or '1')
+
+    @classmethod
+    def _parse_multipart(cls, structure, part):
+        children = []
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number = len(children) + 1
+            children.append(cls.parse(
+                child, '%s.%d' % (part, number) if part else str(number)))
+        # Subtype and extension data: params, disposition, ...
+        rest = structure[len(children):]
+        subtype = (rest[0] if rest else None) or 'mixed'
+        disposition, disposition_params = cls._parse_disposition(rest[2:3])
+        return cls(
+            part, 'multipart/' + subtype.lower(),
+            params=cls._parse_params(rest[1] if len(rest) > 1 else None),
+            disposition=disposition, disposition_params=disposition_params,
+            parts=children)
+
+    @classmethod
+    def _parse_single(cls, structure, part):
+        if len(structure) < 7:
+            raise Error('Unexpected BODYSTRUCTURE: %r' % (structure, ))
+        maintype, subtype, params, id, description, encoding, size = (
+            structure[:7])
+        content_type = ('%s/%s' % (maintype, subtype)).lower()
+        rest = structure[7:]
+        lines = None
+        children = []
+        if content_type == 'message/rfc822' and len(rest) >= 3:
+            # Envelope, body structure and size in lines of the message.
+            body = rest[1]
+            if isinstance(body, list) and body:
+                children.append(cls.parse(
+                    body,
+                    part if isinstance(body[0], list) else part + '.1'))
+            lines = rest[2]
+            rest = rest[3:]
+        elif maintype and maintype.lower() == 'text' and rest:
+            lines = rest[0]
+            rest = rest[1:]
+        # Extension data: md5, disposition, language, location.
+        disposition, disposition_params = cls._parse_disposition(rest[1:2])
+        return cls(
+            part, content_type, params=cls._parse_params(params), id=id,
+            description=description,
+            encoding=encoding.lower() if encoding else None,
+            size=_to_int(size), lines=_to_int(lines), disposition=disposition,
+            disposition_params=disposition_params, parts=children)
+
+    @staticmethod
+    def _parse_params(params):
+        """Make a dictionary from a list like ["CHARSET", "utf-8"]."""
+        if not isinstance(params, list):
+            return {}
+        return dict(
+            (params[i].lower(), params[i + 1])
+            for i in xrange(0, len(params) - 1, 2)
+            if isinstance(params[i], basestring))
+
+    @classmethod
+    def _parse_disposition(cls, rest):
+        """Parse a list like [["ATTACHMENT", ["FILENAME", "a.pdf"]]]."""
+        if not rest or not isinstance(rest[0], list) or not rest[0]:
+            return None, {}
+        disposition = rest[0]
+        params = disposition[1] if len(disposition) > 1 else None
+        disposition_type = (disposition[0] or '').lower() or None
+        return disposition_type, cls._parse_params(params)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return
+
+
 class MessageWrapper(object):
     """A wrapper for email.message.Message with some convenient methods."""
 
@@ -132,19 +564,61 @@ class MessageWrapper(object):
     # for the header to decode successfully.
     CHARDET_CONFIDENCE = 0.7
 
+    # Wrappers are kept for every message of large searches, so they don't
+    # have a __dict__.
+    __slots__ = (
+        'msg', 'uid', 'folder', 'uidvalidity', 'x_gm_msgid', 'x_gm_thrid',
+        'x_gm_labels', 'bodystructure', 'adapter', '_memo')
+
     def __init__(self, email_message):
         assert isinstance(email_message, email.message.Message)
         self.msg = email_message
+        # Maps keys to tuples (raw header value, computed value), see
+        # _memoize(). Created on the first use.
+        self._memo = None
         # These ones may be set by the IMAPAdapter.
         self.uid = None
+        self.folder = None
+        self.uidvalidity = None
         self.x_gm_msgid = None
+        self.x_gm_thrid = None
+        self.x_gm_labels = None
+        # BodyPart tree, if the message was fetched with BODYSTRUCTURE.
+        self.bodystructure = None
+        # The IMAPAdapter used to download RemoteAttachment data.
+        self.adapter = None
 
     def __getattr__(self, attr):
+        # copy and pickle look up special methods before __init__ runs, when
+        # there is no self.msg yet.
+        if attr == 'msg' or attr.startswith('__'):
+            raise AttributeError(attr)
         return getattr(self.msg, attr)
 
     def __getitem__(self, item):
         return self.msg[item]
 
+    def __getstate__(self):
+        # For copy and pickle, which don't handle __slots__ by themselves.
+        # Memoized values are recomputed after copying.
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        state['_memo'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    @property
+    def key(self):
+        """A stable (folder, uidvalidity, uid) tuple identifying the message.
+
+        Only available for messages fetched with use_uid=True, otherwise None.
+        """
+        if self.uidvalidity is None or self.uid is None:
+            return
+        return self.folder, self.uidvalidity, self.uid
+
     @property
     def from_addr(self):
         """A tuple (name, addr) parsed from From: header."""
@@ -168,13 +642,19 @@ class MessageWrapper(object):
     @property
     def received(self):
         """Timezone-aware date from the "Received:" header."""
-        received = self.get_header('received').split('\n')[-1].strip()
-        received = received.split(';')[-1]
-        return self.parse_date(received)
+        return self._memoize('received', self.msg['received'], self._received)
 
     @property
     def date(self):
         """Timezone-aware date from the "Date:" header."""
+        return self._memoize('date', self.msg['date'], self._date)
+
+    def _received(self):
+        received = self.get_header('received').split('\n')[-1].strip()
+        received = received.split(';')[-1]
+        return self.parse_date(received)
+
+    def _date(self):
         date = self.get_header('date')
         try:
             return self.parse_date(date)
@@ -182,7 +662,16 @@ class MessageWrapper(object):
             log.exception('Error parsing date header %s', date)
 
     def attachments(self):
-        """Get a list of betterimap.Attachment email attachments."""
+        """Get a list of betterimap.Attachment email attachments.
+
+        If the message was fetched with FETCH_BODYSTRUCTURE and without the
+        body, RemoteAttachment objects are returned, which download the
+        data on first access.
+        """
+        if self.bodystructure is not None and not self.msg.get_payload():
+            return [
+                RemoteAttachment(self, part)
+                for part in self.bodystructure.attachment_parts()]
         return map(Attachment, self._attachments())
 
     def plaintext(self):
@@ -216,11 +705,16 @@ class MessageWrapper(object):
                 return payload.decode(charset)
             except (UnicodeEncodeError, UnicodeDecodeError, LookupError):
                 pass
-        if chardet:
-            # try to guess the charset if chardet is available
-            detected = chardet.detect(payload)
-            if detected['confidence'] > self.CHARDET_CONFIDENCE:
+        # try to guess the charset if chardet is available
+        detected = charset_detector.detect(payload)
+        if detected and detected['encoding'] and (
+            detected['confidence'] > self.CHARDET_CONFIDENCE
+        ):
+            try:
                 payload = payload.decode(detected['encoding'])
+            except (UnicodeDecodeError, LookupError):
+                # Only a sample was detected, the rest does not decode.
+                pass
         return payload
 
     def get_payload(self, *args, **kwargs):
@@ -271,19 +765,49 @@ class MessageWrapper(object):
         hvalue = self.msg[name]
         if not hvalue:
             return
-        result = self._get_header(hvalue)
+        result = self._memoize(
+            ('header', name.lower()), hvalue,
+            lambda: self._get_header(hvalue))
         if join:
             return ' '.join(result)
+        return list(result)
+
+    def _memoize(self, key, raw, compute):
+        """Get compute() result cached until the raw header value changes.
+
+        The raw value is compared on every call, so mutating the headers of
+        the underlying email.message.Message invalidates the cache.
+        """
+        if self._memo is None:
+            self._memo = {}
+        cached = self._memo.get(key)
+        if cached is not None and cached[0] == raw:
+            return cached[1]
+        value = compute()
+        self._memo[key] = (raw, value)
+        return value
 
     @classmethod
     def _get_header(cls, hvalue):
         """Decode an email header value
 
-        Returns a list of unicode objects.
+        Returns a list of unicode objects. Results are cached in header_cache.
         """
-        result = []
         if not hvalue:
             return
+        if not isinstance(hvalue, basestring):
+            return cls._decode_header(hvalue)
+        key = (cls, hvalue)
+        result = header_cache.get(key)
+        if result is None:
+            result = cls._decode_header(hvalue)
+            header_cache.put(key, tuple(result))
+            return result
+        return list(result)
+
+    @classmethod
+    def _decode_header(cls, hvalue):
+        result = []
         hvalue = cls._fix_header(hvalue)
         seen_encodings = set()
 
@@ -320,11 +844,12 @@ class MessageWrapper(object):
                 result[idx] = hvalue
                 continue
             # Try to guess the charset if chardet is available
-            if chardet:
-                detected = chardet.detect(hvalue)
-                if detected['confidence'] > 0.7:
-                    result[idx] = hvalue.decode(detected['encoding'])
-                    continue
+            detected = charset_detector.detect(hvalue)
+            if detected and detected['encoding'] and (
+                detected['confidence'] > cls.CHARDET_CONFIDENCE
+            ):
+                result[idx] = hvalue.decode(detected['encoding'])
+                continue
             # Try some common encodings (this lib was written for russian
             # emails).
             for encoding in cls.LAST_RESORT_ENCODINGS:
@@ -421,29 +946,880 @@ class MessageWrapper(object):
         return '<MesageWrapper: %r>' % self.msg
 
 
+class Envelope(object):
+    """Message headers parsed from the IMAP ENVELOPE, see FETCH_ENVELOPE.
+
+    Much cheaper to make than a MessageWrapper, as the email package is not
+    used. Attributes are named like MessageWrapper properties.
+
+    Attributes:
+        date: timezone-aware date from the "Date:" header.
+        subject: unicode subject.
+        from_addr, sender: (name, addr) tuples, ('', '') if missing.
+        reply_to, to, cc, bcc: lists of (name, addr) tuples, or None.
+        message_id, in_reply_to: string message ids.
+        size: integer RFC822.SIZE of the message.
+        flags: a list of flags, e.g. ["\\Seen"].
+        internaldate: timezone-aware date the server received the message.
+    """
+
+    __slots__ = (
+        'uid', 'folder', 'uidvalidity', 'x_gm_msgid', 'x_gm_thrid',
+        'x_gm_labels', 'date', 'subject', 'from_addr', 'sender', 'reply_to',
+        'to', 'cc', 'bcc', 'message_id', 'in_reply_to', 'size', 'flags',
+        'internaldate')
+
+    def __init__(self, items):
+        """Make an Envelope from parsed FETCH items with ENVELOPE."""
+        fields = items['ENVELOPE']
+        if not isinstance(fields, list) or len(fields) < 10:
+            raise Error('Unexpected ENVELOPE: %r' % (fields, ))
+        (date, subject, from_addr, sender, reply_to, to, cc, bcc,
+         in_reply_to, message_id) = fields[:10]
+        self.uid = None
+        self.folder = None
+        self.uidvalidity = None
+        self.x_gm_msgid = None
+        self.x_gm_thrid = None
+        self.x_gm_labels = None
+        self.date = self._parse_date(date)
+        self.subject = self._decode(subject)
+        self.from_addr = (self._parse_addrlist(from_addr) or [('', '')])[0]
+        self.sender = (self._parse_addrlist(sender) or [('', '')])[0]
+        self.reply_to = self._parse_addrlist(reply_to)
+        self.to = self._parse_addrlist(to)
+        self.cc = self._parse_addrlist(cc)
+        self.bcc = self._parse_addrlist(bcc)
+        self.in_reply_to = in_reply_to
+        self.message_id = message_id
+        self.size = _to_int(items.get('RFC822.SIZE'))
+        self.flags = items.get('FLAGS')
+        internaldate = items.get('INTERNALDATE')
+        # "17-Jul-1996 02:44:25 -0700" to the format of the Date: header.
+        self.internaldate = self._parse_date(
+            internaldate and internaldate.replace('-', ' ', 2))
+
+    def __repr__(self):
+        return '<Envelope %s: %r>' % (self.uid, self.subject)
+
+    @property
+    def key(self):
+        """See MessageWrapper.key."""
+        if self.uidvalidity is None or self.uid is None:
+            return
+        return self.folder, self.uidvalidity, self.uid
+
+    @staticmethod
+    def _decode(value):
+        if not value:
+            return value
+        if '=?' not in value:
+            # Without RFC 2047 encoded words, _get_header() would only
+            # decode it as ASCII.
+            try:
+                return value.decode('ascii')
+            except UnicodeDecodeError:
+                pass
+        return u' '.join(MessageWrapper._get_header(value))
+
+    @staticmethod
+    def _parse_date(value):
+        try:
+            return MessageWrapper.parse_date(value)
+        except (TypeError, ValueError, OverflowError):
+            log.exception('Error parsing date %s', value)
+
+    @classmethod
+    def _parse_addrlist(cls, addresses):
+        """Parse a list of (name, route, mailbox, host) address lists."""
+        if not addresses:
+            return
+        result = []
+        for address in addresses:
+            name, _, mailbox, host = address
+            if host is None:
+                # Start or end of a group, like "undisclosed-recipients:;".
+                continue
+            addr = '%s@%s' % (mailbox, host) if mailbox else host
+            result.append(
+                (cls._decode(name) or u'', addr.decode('utf-8', 'replace')))
+        return result
+
+
 # Fetch specifications.
 FETCH_RFC822 = '(RFC822)'
 
 # Use this if you don't need the email content.
 FETCH_HEADERS_ONLY = '(BODY[HEADER.FIELDS (SUBJECT FROM DATE TO CC)])'
 
+# Use this to list attachments without downloading them, see
+# MessageWrapper.attachments().
+FETCH_BODYSTRUCTURE = '(BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+# Use this to list messages, search() will return Envelope objects.
+FETCH_ENVELOPE = '(ENVELOPE RFC822.SIZE FLAGS INTERNALDATE)'
+
+# Headers IMAPAdapter.thread() fetches to thread messages locally.
+FETCH_THREAD_HEADERS = (
+    '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID IN-REPLY-TO REFERENCES DATE)])')
+
+# How many messages to request with a single FETCH command.
+FETCH_BATCH_SIZE = 200
+
+# The longest message set in one command. RFC 7162 recommends clients to
+# keep command lines within 8192 octets, some room is left for the rest.
+MESSAGE_SET_MAX_LENGTH = 8000
+
+# How long IMAPAdapter.idle() keeps collecting notifications after a new
+# message comes, to fetch all messages of a burst with one FETCH.
+IDLE_DEBOUNCE = 0.5
+
+# Servers may drop IDLE after 30 minutes, so it's restarted more often.
+IDLE_TIMEOUT = 29 * 60
+
+# How often an idling thread checks if it was stopped, in seconds.
+IDLE_POLL_INTERVAL = 1
+
+# IMAPAdapter.idle() polls servers without IDLE with NOOP. The interval
+# starts at POLL_MIN_INTERVAL seconds, grows POLL_BACKOFF times after each
+# poll without new messages up to POLL_MAX_INTERVAL, and is reset after
+# new messages come.
+POLL_MIN_INTERVAL = 5
+POLL_MAX_INTERVAL = 120
+POLL_BACKOFF = 1.5
+
+# How many connections to a host IMAPAdapter.sharded_search() may open at
+# the same time, in all threads. Change before the first sharded search.
+DEFAULT_HOST_CONNECTION_LIMIT = 4
+HOST_CONNECTION_LIMITS = {}
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+# Tokens of a server response, see _parse_imap_list(). Groups are: the
+# whole token with leading whitespace, "(", ")", quoted string contents,
+# literal length and atom.
+_IMAP_TOKEN_RE = re.compile(
+    r'(\s*(?:'
+    r'(\()|(\))|'
+    r'"((?:[^"\\]|\\.)*)"|'
+    r'\{(\d+)\+?\}|'
+    r'((?:[^\s()"\[]|\[[^\]]*\])+)'
+    r'))', re.DOTALL)
+_IMAP_QUOTED_ESCAPE_RE = re.compile(r'\\(.)')
+
+# A literal at the end of a response line, e.g. "{123}\r\n".
+_LITERAL_END_RE = re.compile(r'\{(\d+)\}\r\n$')
+
+# Beginning of a single message in the FETCH response, e.g. "12 (UID 34".
+_FETCH_START_RE = re.compile(r'^(\d+) \(')
+
+
+def _parse_imap_list(text, literals=()):
+    """Parse a server response string into nested lists.
+
+    Parenthesized lists become python lists, quoted strings and atoms become
+    strings, NIL becomes None. Literal markers like "{123}" are replaced by
+    the next value from the "literals" iterable.
+    """
+    literals = iter(literals)
+    end = len(text.rstrip())
+    # findall() is much faster than matching tokens one by one, but skips
+    # unparseable text, which is checked by the total length of the tokens.
+    tokens = _IMAP_TOKEN_RE.findall(text, 0, end)
+    if sum(map(len, map(operator.itemgetter(0), tokens))) != end:
+        pos = 0
+        for token in tokens:
+            if not text.startswith(token[0], pos):
+                break
+            pos += len(token[0])
+        raise Error('Cannot parse server response at %d: %r' % (
+            pos, text[pos:pos + 50]))
+    stack = []
+    current = []
+    for _, opening, closing, quoted, literal, atom in tokens:
+        # The most common tokens go first.
+        if atom:
+            if len(atom) == 3 and atom.upper() == 'NIL':
+                atom = None
+            current.append(atom)
+        elif opening:
+            stack.append(current)
+            current = []
+        elif closing:
+            if not stack:
+                raise Error('Unbalanced parentheses in %r' % text)
+            token = current
+            current = stack.pop()
+            current.append(token)
+        elif literal:
+            try:
+                current.append(next(literals))
+            except StopIteration:
+                raise Error('Missing literal data in %r' % text)
+        else:
+            if '\\' in quoted:
+                quoted = _IMAP_QUOTED_ESCAPE_RE.sub(r'\1', quoted)
+            current.append(quoted)
+    if stack:
+        raise Error('Unbalanced parentheses in %r' % text)
+    return current
+
+
+def _parse_fetch_response(data):
+    """Parse imaplib FETCH response data.
+
+    Returns a list of tuples (message number, items), where items is a
+    dictionary mapping upper-cased fetch item names, e.g. "RFC822" or "UID",
+    to their values.
+    """
+    result = []
+    chunks, literals = [], []
+
+    def flush():
+        if not chunks:
+            return
+        tokens = _parse_imap_list(''.join(chunks), literals)
+        del chunks[:]
+        del literals[:]
+        if len(tokens) != 2 or not isinstance(tokens[1], list):
+            log.warning('Unexpected FETCH response: %r', tokens)
+            return
+        num, values = tokens
+        items = {}
+        for i in xrange(0, len(values) - 1, 2):
+            items[values[i].upper()] = values[i + 1]
+        result.append((num, items))
+
+    for part in data:
+        if part is None:
+            continue
+        if isinstance(part, tuple):
+            text, literal = part
+        else:
+            text, literal = part, None
+        if _FETCH_START_RE.match(text):
+            flush()
+        chunks.append(text)
+        if isinstance(part, tuple):
+            literals.append(literal)
+    flush()
+    return result
+
+
+def _get_fetched_body(items):
+    """Get the message body or headers from parsed FETCH items."""
+    for name, value in items.iteritems():
+        if name in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT') or (
+            name.startswith('BODY[') or name.startswith('BODY.PEEK[')
+        ):
+            return value
+
+
+class _TransferDecoder(object):
+    """Incrementally decode base64 or quoted-printable data.
+
+    Feed the data in chunks of any size to decode(), then call flush().
+    """
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or '').lower()
+        self.buffer = ''
+
+    def decode(self, data):
+        data = self.buffer + data
+        if self.encoding == 'base64':
+            data = ''.join(data.split())
+            cut = len(data) // 4 * 4
+        elif self.encoding == 'quoted-printable':
+            # Only decode complete lines, or up to a possibly incomplete
+            # "=XX" escape and trailing whitespace.
+            cut = data.rfind('\n') + 1
+            if not cut:
+                cut = len(data.rstrip(' \t\r'))
+                escape = data.rfind('=', max(cut - 2, 0), cut)
+                if escape != -1:
+                    cut = escape
+        else:
+            return data
+        self.buffer = data[cut:]
+        return self._decode(data[:cut])
+
+    def flush(self):
+        data, self.buffer = self.buffer, ''
+        if self.encoding == 'base64' and data:
+            data += '=' * (-len(data) % 4)
+        return self._decode(data)
+
+    def _decode(self, data):
+        if not data:
+            return ''
+        if self.encoding == 'base64':
+            try:
+                return binascii.a2b_base64(data)
+            except binascii.Error:
+                log.warning('Invalid base64 data, returning it undecoded')
+                return data
+        return quopri.decodestring(data)
+
+
+def _decode_transfer_encoding(data, encoding):
+    """Decode a part body fetched with BODY[<part>]."""
+    decoder = _TransferDecoder(encoding)
+    return decoder.decode(data) + decoder.flush()
+
+
+def _add_fetch_items(fetch_spec, items):
+    """Add items like "UID" to a fetch specification like "(RFC822)"."""
+    spec = fetch_spec.strip()
+    if spec.startswith('(') and spec.endswith(')'):
+        spec = spec[1:-1]
+    existing = spec.upper().split()
+    extra = [item for item in items if item.upper() not in existing]
+    return '(%s)' % ' '.join(extra + [spec])
+
+
+def _get_host_semaphore(host):
+    """Get a semaphore limiting the number of connections to the host."""
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                HOST_CONNECTION_LIMITS.get(
+                    host, DEFAULT_HOST_CONNECTION_LIMIT))
+        return _host_semaphores[host]
+
+
+def _uid_ranges(uids):
+    """Make sorted ranges of uids, e.g. ["1:200", "205", "310:400"]."""
+    numbers = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return [
+        str(start) if start == end else '%d:%d' % (start, end)
+        for start, end in ranges]
+
+
+def _compress_uids(uids):
+    """Make a compact IMAP message set, e.g. "1:200,205,310:400" from uids."""
+    return ','.join(_uid_ranges(uids))
+
+
+def _split_message_sets(uids, max_length=MESSAGE_SET_MAX_LENGTH):
+    """Make compact message sets of uids, each up to max_length long."""
+    sets, current, length = [], [], 0
+    for uid_range in _uid_ranges(uids):
+        if current and length + 1 + len(uid_range) > max_length:
+            sets.append(','.join(current))
+            current, length = [], 0
+        length += len(uid_range) + (1 if current else 0)
+        current.append(uid_range)
+    if current:
+        sets.append(','.join(current))
+    return sets
+
+
+class MessageSet(object):
+    """A lazy list of string ids, made of ranges like "1:200,205,310:400".
+
+    Ids are expanded on demand, so the ids of a huge folder found by
+    ESEARCH take the memory of a few ranges. Supports what search results
+    are used for: len(), iteration, "in", indexing, slicing (into a list of
+    string ids) and reverse().
+    """
+
+    def __init__(self, message_set=''):
+        ranges = []
+        for part in message_set.split(','):
+            if not part:
+                continue
+            start, _, end = part.partition(':')
+            start, end = int(start), int(end or start)
+            ranges.append((min(start, end), max(start, end)))
+        ranges.sort()
+        self._starts = [start for start, _ in ranges]
+        self._ranges = ranges
+        # _offsets[i] is the number of ids before the range i.
+        self._offsets = []
+        length = 0
+        for start, end in ranges:
+            self._offsets.append(length)
+            length += end - start + 1
+        self._length = length
+        self.reversed = False
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self.reversed:
+            for start, end in reversed(self._ranges):
+                for number in xrange(end, start - 1, -1):
+                    yield str(number)
+        else:
+            for start, end in self._ranges:
+                for number in xrange(start, end + 1):
+                    yield str(number)
+
+    def __contains__(self, uid):
+        number = int(uid)
+        i = bisect.bisect_right(self._starts, number) - 1
+        return i >= 0 and number <= self._ranges[i][1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('MessageSet index out of range')
+        return self._get(index)
+
+    def _get(self, index):
+        if self.reversed:
+            index = len(self) - 1 - index
+        i = bisect.bisect_right(self._offsets, index) - 1
+        return str(self._ranges[i][0] + index - self._offsets[i])
+
+    def reverse(self):
+        """Reverse the order of ids in place, like list.reverse()."""
+        self.reversed = not self.reversed
+
+    def __str__(self):
+        return ','.join(
+            str(start) if start == end else '%d:%d' % (start, end)
+            for start, end in self._ranges)
+
+    def __repr__(self):
+        return '<MessageSet %s%s>' % (
+            self, ' reversed' if self.reversed else '')
+
+
+def _parse_esearch(text):
+    """Parse an ESEARCH response (RFC 4731) into a dict of return data.
 
-def _idle_imap4_connection(connection):
-    """Wait for messages on imaplib.IMAP4, yield tuples (uid, string)."""
-    assert isinstance(connection, imaplib.IMAP4)
-    tag = connection._new_tag()
-    connection.send("%s IDLE\r\n" % tag)
-    response = connection.readline()
-    if response != '+ idling\r\n':
-        raise Error("IDLE not handled? : %s" % response)
-    while True:
-        resp = connection.readline()
-        uid, message = resp[2:-2].split(' ')
-        yield uid, message
+    E.g. '(TAG "A1") UID COUNT 3 ALL 2,10:11' is parsed into
+    {'UID': True, 'COUNT': 3, 'ALL': MessageSet('2,10:11')}. PARTIAL data
+    (RFC 5267) is a MessageSet of the ids in the requested window.
+    """
+    items = _parse_imap_list(text)
+    if items and isinstance(items[0], list):
+        # The search correlator, (TAG "A1").
+        items = items[1:]
+    result = {}
+    if items and items[0].upper() == 'UID':
+        result['UID'] = True
+        items = items[1:]
+    for name, value in zip(items[::2], items[1::2]):
+        name = name.upper()
+        if name == 'ALL':
+            value = MessageSet(value)
+        elif name == 'PARTIAL':
+            value = MessageSet(value[1] or '')
+        elif name in ('MIN', 'MAX', 'COUNT'):
+            value = int(value)
+        result[name] = value
+    return result
+
+
+# Prefixes and trailers removed to get the base subject of RFC 5256.
+_SUBJECT_PREFIX_RE = re.compile(
+    r'^\s*(?:(?:re|fwd?)\s*(?:\[[^\]]*\])?\s*:|\[[^\]]*\](?=.*\S))\s*',
+    re.IGNORECASE | re.UNICODE)
+_SUBJECT_TRAILER_RE = re.compile(r'\s*\(fwd\)\s*$', re.IGNORECASE)
+_MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+
+def _base_subject(subject):
+    """Strip "Re:", "Fwd:", "[list]" and the like from a subject."""
+    subject = u' '.join((subject or u'').split())
+    previous = None
+    while subject != previous:
+        previous = subject
+        subject = _SUBJECT_TRAILER_RE.sub(u'', subject)
+        subject = _SUBJECT_PREFIX_RE.sub(u'', subject)
+    return subject.lower()
+
+
+def _first_mailbox(addresses):
+    """The lower-cased local part of the first address, for sorting."""
+    if not addresses or not addresses[0][1]:
+        return u''
+    return addresses[0][1].split(u'@')[0].lower()
+
+
+def _maybe(value):
+    """Make a sort key of a value which may be None, Nones first."""
+    return value is not None, value
+
+
+# RFC 5256 SORT keys, as functions of Envelope objects.
+_SORT_KEYS = {
+    'ARRIVAL': lambda envelope: _maybe(envelope.internaldate),
+    'CC': lambda envelope: _first_mailbox(envelope.cc),
+    'DATE': lambda envelope: _maybe(envelope.date or envelope.internaldate),
+    'FROM': lambda envelope: _first_mailbox([envelope.from_addr]),
+    'SIZE': lambda envelope: envelope.size,
+    'SUBJECT': lambda envelope: _base_subject(envelope.subject),
+    'TO': lambda envelope: _first_mailbox(envelope.to),
+}
+
+
+def _parse_sort_criteria(criteria):
+    """Parse "REVERSE DATE SUBJECT" to [('DATE', True), ('SUBJECT', False)]."""
+    if isinstance(criteria, basestring):
+        criteria = criteria.strip('()').split()
+    result = []
+    reverse = False
+    for criterion in criteria:
+        criterion = criterion.upper()
+        if criterion == 'REVERSE':
+            reverse = True
+            continue
+        if criterion not in _SORT_KEYS:
+            raise ProgrammingError('Unknown sort criterion %s' % criterion)
+        result.append((criterion, reverse))
+        reverse = False
+    if reverse or not result:
+        raise ProgrammingError('Invalid sort criteria %r' % (criteria, ))
+    return result
+
+
+def _thread_by_references(messages):
+    """Thread MessageWrappers by References and In-Reply-To headers.
+
+    A simplified REFERENCES algorithm of RFC 5256: threads are not merged
+    by subject, and messages whose parents are missing start new threads.
+    Returns threads like IMAPAdapter.thread().
+    """
+    by_id = {}
+    for msg in messages:
+        for message_id in _MESSAGE_ID_RE.findall(msg.msg['message-id'] or ''):
+            by_id.setdefault(message_id, msg)
+    parents = {}
+    for msg in messages:
+        references = _MESSAGE_ID_RE.findall(
+            '%s %s' % (msg.msg['references'] or '',
+                       msg.msg['in-reply-to'] or ''))
+        for message_id in reversed(references):
+            parent = by_id.get(message_id)
+            if parent is None or parent is msg:
+                continue
+            # Skip parents which would make a loop.
+            ancestor = parent
+            while ancestor is not None and ancestor is not msg:
+                ancestor = parents.get(id(ancestor))
+            if ancestor is None:
+                parents[id(msg)] = parent
+                break
+    order = dict((id(msg), i) for i, msg in enumerate(messages))
+    children = {}
+    roots = []
+    for msg in messages:
+        parent = parents.get(id(msg))
+        if parent is None:
+            roots.append(msg)
+        else:
+            children.setdefault(id(parent), []).append(msg)
+
+    def by_date(msg):
+        return _maybe(msg.date), order[id(msg)]
+
+    def make_thread(msg):
+        thread = [str(msg.uid)]
+        replies = sorted(children.get(id(msg), ()), key=by_date)
+        while len(replies) == 1:
+            thread.append(str(replies[0].uid))
+            replies = sorted(children.get(id(replies[0]), ()), key=by_date)
+        thread.extend(make_thread(reply) for reply in replies)
+        return thread
+
+    return [make_thread(msg) for msg in sorted(roots, key=by_date)]
+
+
+# How many compressed bytes to read from a socket at once.
+COMPRESS_READ_SIZE = 65536
+
+
+class _CompressMixin(object):
+    """RFC 4978 COMPRESS=DEFLATE for imaplib.IMAP4 classes, see compress().
+
+    Counts bytes sent and received before compression in bytes_out and
+    bytes_in, and on the wire in wire_bytes_out and wire_bytes_in.
+    """
+
+    compressed = False
+    bytes_in = bytes_out = wire_bytes_in = wire_bytes_out = 0
+
+    def compress(self):
+        """Start compressing the connection.
+
+        Raises:
+            NotSupported, if the server does not support COMPRESS=DEFLATE.
+        """
+        if 'COMPRESS=DEFLATE' not in self.capabilities:
+            raise NotSupported('Server does not support COMPRESS=DEFLATE')
+        imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            raise NotSupported('COMPRESS failed: %s' % data[-1])
+        # Compression starts right after the OK, so the data the server sent
+        # after it may be in the read buffer already.
+        pending = _take_buffered(self.file)
+        self._compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        # Decompressed data is appended to _zbuf and read from _zpos on, the
+        # read part is dropped once it is the larger half of the buffer.
+        self._zbuf = bytearray()
+        self._zpos = 0
+        self.compressed = True
+        if pending:
+            self._decompress(pending)
+
+    @property
+    def compression_ratio(self):
+        """How many times less data went over the wire, 1 if not compressed."""
+        wire = self.wire_bytes_in + self.wire_bytes_out
+        if not self.compressed or not wire:
+            return 1.0
+        return float(self.bytes_in + self.bytes_out) / wire
+
+    def read(self, size):
+        if not self.compressed:
+            return super(_CompressMixin, self).read(size)
+        while self.buffered_in < size:
+            self._fill()
+        return self._consume(self._zpos + size)
+
+    def readline(self):
+        if not self.compressed:
+            return super(_CompressMixin, self).readline()
+        end = self._zbuf.find('\n', self._zpos)
+        while end < 0:
+            start = len(self._zbuf)
+            self._fill()
+            end = self._zbuf.find('\n', start)
+        return self._consume(end + 1)
+
+    @property
+    def buffered_in(self):
+        """How many decompressed bytes are received, but not read yet."""
+        if not self.compressed:
+            return 0
+        return len(self._zbuf) - self._zpos
+
+    def _consume(self, end):
+        """Return the decompressed data up to the offset end, as read."""
+        data = str(self._zbuf[self._zpos:end])
+        self._zpos = end
+        if self._zpos * 2 >= len(self._zbuf):
+            del self._zbuf[:self._zpos]
+            self._zpos = 0
+        return data
+
+    def send(self, data):
+        if not self.compressed:
+            return super(_CompressMixin, self).send(data)
+        self.bytes_out += len(data)
+        data = self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+        self.wire_bytes_out += len(data)
+        super(_CompressMixin, self).send(data)
+
+    def _fill(self):
+        sslobj = getattr(self, 'sslobj', None)
+        if sslobj is not None:
+            data = sslobj.read(COMPRESS_READ_SIZE)
+        else:
+            data = self.sock.recv(COMPRESS_READ_SIZE)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self._decompress(data)
+
+    def _decompress(self, data):
+        self.wire_bytes_in += len(data)
+        data = self._decompressor.decompress(data)
+        self.bytes_in += len(data)
+        self._zbuf.extend(data)
+
+
+# Literals up to this size are read into a buffer reused by the connection,
+# larger ones into a buffer of their own.
+LITERAL_BUFFER_SIZE = 1024 * 1024
+
+
+def _take_buffered(fileobj, keep_from=None):
+    """Remove and return the data buffered in a socket._fileobject.
+
+    If keep_from is given, the data after this offset stays in the buffer.
+    """
+    rbuf = getattr(fileobj, '_rbuf', None)
+    if rbuf is None:
+        return ''
+    data = rbuf.getvalue()
+    rbuf.seek(0)
+    rbuf.truncate()
+    if keep_from is not None:
+        rbuf.write(data[keep_from:])
+        data = data[:keep_from]
+    return data
+
+
+class _RecvIntoMixin(object):
+    """Reads literals of imaplib.IMAP4 classes with recv_into().
+
+    imaplib reads a literal through socket._fileobject.read(), which calls
+    recv() for the whole remaining size again and again, and joins the
+    chunks in a StringIO. Here the literal is received into a buffer sized
+    from its {N} length, and copied to a string once.
+    """
+
+    _literal_buffer = None
+
+    def read(self, size):
+        if not hasattr(self.file, '_rbuf'):
+            return super(_RecvIntoMixin, self).read(size)
+        buffered = _take_buffered(self.file, keep_from=size)
+        if len(buffered) == size:
+            return buffered
+        if size <= LITERAL_BUFFER_SIZE:
+            if self._literal_buffer is None:
+                self._literal_buffer = bytearray(LITERAL_BUFFER_SIZE)
+            buf = self._literal_buffer
+        else:
+            buf = bytearray(size)
+        view = memoryview(buf)
+        view[:len(buffered)] = buffered
+        received = len(buffered)
+        sock = getattr(self, 'sslobj', None) or self.sock
+        while received < size:
+            count = sock.recv_into(view[received:size], size - received)
+            if not count:
+                raise self.abort('socket error: EOF')
+            received += count
+        return view[:size].tobytes()
+
+
+# Message literals of at least this size are parsed while they are received,
+# in chunks of STREAM_CHUNK_SIZE, see IMAPAdapter(stream_messages=...).
+STREAM_MIN_SIZE = 256 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The end of a response line followed by a whole message literal.
+_MESSAGE_LITERAL_RE = re.compile(r'(?:RFC822|BODY\[\]) \{\d+\}\r\n$')
+
+
+class _ParsedMessage(object):
+    """A message literal, parsed to email.message.Message as it came."""
+
+    __slots__ = ('message', 'size')
+
+    def __init__(self, message, size):
+        self.message = message
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class _StreamMixin(object):
+    """Parses large message literals of imaplib.IMAP4 classes on the fly.
+
+    If stream_messages is set, RFC822 and BODY[] literals of at least
+    STREAM_MIN_SIZE bytes are fed to email.feedparser.FeedParser chunk by
+    chunk as they are received, and returned as _ParsedMessage objects.
+    The whole message never exists as one string.
+    """
+
+    stream_messages = False
+    _last_line = ''
+
+    def readline(self):
+        self._last_line = super(_StreamMixin, self).readline()
+        return self._last_line
+
+    def read(self, size):
+        if not (
+            self.stream_messages and size >= STREAM_MIN_SIZE and
+            _MESSAGE_LITERAL_RE.search(self._last_line)
+        ):
+            return super(_StreamMixin, self).read(size)
+        parser = email.feedparser.FeedParser()
+        left = size
+        while left:
+            chunk = super(_StreamMixin, self).read(
+                min(left, STREAM_CHUNK_SIZE))
+            parser.feed(chunk)
+            left -= len(chunk)
+        return _ParsedMessage(parser.close(), size)
+
+
+class IMAP4(_StreamMixin, _CompressMixin, _RecvIntoMixin, imaplib.IMAP4):
+    pass
+
+
+class IMAP4_SSL(
+    _StreamMixin, _CompressMixin, _RecvIntoMixin, imaplib.IMAP4_SSL
+):
+    pass
+
+
+def _imap4_readable(connection, timeout):
+    """Wait up to timeout seconds until imaplib.IMAP4 has data to read."""
+    # imaplib reads through a buffered file object, and SSL buffers data too,
+    # so select() alone would miss the data which is already received.
+    if getattr(connection, 'buffered_in', 0):
+        return True
+    rbuf = getattr(connection.file, '_rbuf', None)
+    if rbuf is not None and rbuf.tell():
+        return True
+    sslobj = getattr(connection, 'sslobj', None)
+    if sslobj is not None and sslobj.pending():
+        return True
+    readable, _, _ = select.select([connection.sock], [], [], timeout)
+    return bool(readable)
+
+
+def _imap4_read_response(connection):
+    """Read a response from imaplib.IMAP4, including literals, if any."""
+    response = line = connection.readline()
+    match = _LITERAL_END_RE.search(line)
+    while match:
+        response += connection.read(int(match.group(1)))
+        line = connection.readline()
+        response += line
+        match = _LITERAL_END_RE.search(line)
+    return response
+
+
+class IdleStats(object):
+    """Counters of IMAPAdapter.idle(), see IMAPAdapter.idle_stats.
+
+    Latency is the time from noticing new messages to fetching them: from
+    the first EXISTS during IDLE, or from the previous poll when polling,
+    which is the worst case.
+    """
 
+    def __init__(self):
+        self.idles = 0
+        self.polls = 0
+        self.reconnects = 0
+        self.messages = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
 
-def _send_done_imap4_connection(connection):
-    connection.send("DONE\r\n")
+    @property
+    def mean_latency(self):
+        """Average seconds from noticing a new message to fetching it."""
+        return self.latency / self.messages if self.messages else 0.0
+
+    def add_messages(self, count, latency):
+        self.messages += count
+        self.latency += count * latency
+        self.max_latency = max(self.max_latency, latency)
 
 
 class IMAPFolder(object):
@@ -482,10 +1858,149 @@ class IMAPFolder(object):
         return '<IMAPFolder: %s>' % self.name.encode('utf-8')
 
 
-class IMAPAdapter(object):
-    """A wrapper around IMAP4, that decorates it with useful functionality."""
+# Arguments of easy_search() used to build the query.
+EASY_SEARCH_ARGS = (
+    'since', 'before', 'subject', 'sender', 'exact_date', 'headers',
+    'other_queries')
 
-    host = None
+
+class _FetchMixin(object):
+    """Query building and FETCH response handling, which does not do I/O.
+
+    Shared by IMAPAdapter and the event-loop driven adapters in
+    betterimap.protocol. Expects use_uid, selected_folder and uidvalidity
+    attributes.
+    """
+
+    def _encode(self, string):
+        """Encode a string to UTF7 if it's unicode."""
+        if isinstance(string, unicode):
+            return imapUTF7.imapUTF7Encode(string)
+        return string
+
+    def _decode(self, string):
+        """Decode a string from UTF7 if it's not unicode."""
+        if isinstance(string, unicode):
+            return string
+        return imapUTF7.imapUTF7Decode(string)
+
+    def _extra_fetch_items(self):
+        """Items to fetch along with every message, e.g. "UID"."""
+        if self.use_uid:
+            return ['UID']
+        return []
+
+    def _set_fetched_attributes(self, msg, items):
+        """Set MessageWrapper attributes from _extra_fetch_items() values."""
+        pass
+
+    def _messages_from_fetch(self, uids, parsed, by_uid):
+        """Make MessageWrappers from _parse_fetch_response() results.
+
+        Returns a list of MessageWrapper objects in the order of uids, or
+        Envelope objects if ENVELOPE was fetched without the message body.
+        Messages not returned by the server are skipped.
+        """
+        fetched = {}
+        for num, items in parsed:
+            if (_get_fetched_body(items) is not None or
+                    'BODYSTRUCTURE' in items or 'ENVELOPE' in items):
+                fetched[items.get('UID') if by_uid else num] = items
+        result = []
+        for uid in uids:
+            items = fetched.get(str(uid))
+            if items is None:
+                log.warning('Message %s was not returned by FETCH', uid)
+                continue
+            body = _get_fetched_body(items)
+            if body is None and 'ENVELOPE' in items and (
+                'BODYSTRUCTURE' not in items
+            ):
+                msg = Envelope(items)
+            else:
+                msg = self.parse_email(body or '')
+            if items.get('BODYSTRUCTURE'):
+                msg.bodystructure = BodyPart.parse(items['BODYSTRUCTURE'])
+            msg.folder = self.selected_folder
+            if self.use_uid:
+                msg.uid = items['UID']
+                msg.uidvalidity = self.uidvalidity
+            else:
+                msg.uid = uid
+            self._set_fetched_attributes(msg, items)
+            result.append(msg)
+        return result
+
+    def parse_email(self, email_string):
+        """Convert an email string to MessageWrapper."""
+        if isinstance(email_string, _ParsedMessage):
+            return MessageWrapper(email_string.message)
+        msg = email.message_from_string(email_string)
+        return MessageWrapper(msg)
+
+    def _easy_search_query(
+        self, since=None, before=None, subject=None, sender=None,
+        exact_date=None, headers=None, other_queries=()
+    ):
+        """Build the IMAP query for easy_search().
+
+        Returns a tuple (query, matches), where matches is a function, which
+        checks a MessageWrapper with headers against the arguments the
+        server cannot check precisely.
+        """
+        if since and before:
+            assert before > since
+        if exact_date and (since or before):
+            raise ProgrammingError(
+                'If exact_date is specified, since and before should be not')
+        if exact_date:
+            # We cannot determine date for sure cause of unknown server tz.
+            since = exact_date.date() - datetime.timedelta(1)
+            before = exact_date.date() + datetime.timedelta(1)
+        query = []
+        headers = headers or {}
+        headers = dict((k.upper(), v) for k, v in headers.iteritems())
+        if since:
+            query.extend(['SINCE', since.strftime('%d-%b-%Y')])
+        if before:
+            query.extend(['BEFORE', before.strftime('%d-%b-%Y')])
+        assert isinstance(other_queries, (list, tuple))
+        query.extend(other_queries)
+        if subject:
+            try:
+                subject = unicode(subject)
+            except UnicodeEncodeError:
+                raise NotSupported(
+                    'Non-unicode subject queries are not supported')
+            try:
+                headers['SUBJECT'] = subject.encode('ascii')
+            except UnicodeEncodeError:
+                if not sender:
+                    raise NotSupported('Unicode subject search requires sender')
+        if sender:
+            headers['FROM'] = sender
+        for header, value in headers.iteritems():
+            value = value.replace('"', r'\"')
+            query.extend(['HEADER %s' % header, '"%s"' % value])
+
+        def matches(msg):
+            if subject and subject not in (msg.subject or ''):
+                return False
+            if exact_date and msg.date != exact_date:
+                return False
+            if isinstance(since, datetime.datetime) and msg.date < since:
+                return False
+            if isinstance(before, datetime.datetime) and msg.date > before:
+                return False
+            return True
+
+        return '(%s)' % ' '.join(query), matches
+
+
+class IMAPAdapter(_FetchMixin):
+    """A wrapper around IMAP4, that decorates it with useful functionality."""
+
+    host = None
     port = None
     ssl = None
 
@@ -500,11 +2015,12 @@ class IMAPAdapter(object):
         u'Trash|Корзина', re.UNICODE | re.IGNORECASE
     )
 
-    imap_cls = imaplib.IMAP4
-    imap_cls_ssl = imaplib.IMAP4_SSL
+    imap_cls = IMAP4
+    imap_cls_ssl = IMAP4_SSL
 
     def __init__(
-        self, login=None, password=None, host=None, port=None, ssl=None
+        self, login=None, password=None, host=None, port=None, ssl=None,
+        use_uid=False, cache=None, compress=False, stream_messages=True
     ):
         """Connect and authenticate with an IMAP4 server.
 
@@ -514,6 +2030,19 @@ class IMAPAdapter(object):
             host: the servername, optional if provided in the subclass
             port: the integer port, optional
             ssl: if True, will use SSL connection.
+            use_uid: if True, search and fetch with UID SEARCH and UID FETCH,
+              so that MessageWrapper.uid is a real UID, stable across
+              connections while the folder UIDVALIDITY stays the same.
+            cache: a betterimap.cache.MessageCache. If given, messages
+              fetched by UID are stored there, and later read from it without
+              going to the server.
+            compress: if True, compress the connection with COMPRESS=DEFLATE
+              if the server supports it. Byte counters are in self.mail,
+              see _CompressMixin.
+            stream_messages: if True, parse large messages while they are
+              downloaded by the adapter, see _StreamMixin. Not used with a
+              cache, which needs the raw messages. Calls on self.mail always
+              return the raw messages.
         """
         self.host = host or self.host
         self.port = port or self.port
@@ -521,6 +2050,12 @@ class IMAPAdapter(object):
         assert self.host, 'Server should not be empty'
         self.login = login
         self.password = password
+        self.use_uid = use_uid
+        self.cache = cache
+        self.compress = compress
+        self.stream_messages = stream_messages
+        # IdleStats of the last idle() call.
+        self.idle_stats = None
         if self.ssl:
             self.imap_cls = self.imap_cls_ssl
         self._connect_and_login()
@@ -537,11 +2072,40 @@ class IMAPAdapter(object):
         else:
             self.mail = self.imap_cls(self.host)
         self._authenticate(login, password)
+        self._capabilities_refreshed = False
+        if self.compress:
+            self._start_compression()
         self.selected_folder = None
         self.total = None
+        self.uidvalidity = None
+        self.uidnext = None
         self._folder_list = None
         self.idling = False
 
+    def _refresh_capabilities(self):
+        # Servers often announce extensions like COMPRESS or MOVE only after
+        # login, while imaplib reads capabilities before it.
+        typ, data = self.mail.capability()
+        if typ == 'OK':
+            self.mail.capabilities = tuple(data[-1].upper().split())
+        self._capabilities_refreshed = True
+
+    def has_capability(self, name):
+        """Check if the server supports a capability, e.g. "MOVE"."""
+        if not self._capabilities_refreshed:
+            self._refresh_capabilities()
+        return name.upper() in self.mail.capabilities
+
+    def _start_compression(self):
+        if not hasattr(self.mail, 'compress'):
+            log.debug('%s does not support compression', self.imap_cls)
+            return
+        self._refresh_capabilities()
+        try:
+            self.mail.compress()
+        except NotSupported as e:
+            log.debug('Not compressing connection to %s: %s', self.host, e)
+
     def reconnect(self):
         """Reconnect and reselect the currently selected folder."""
         folder = self.selected_folder
@@ -549,10 +2113,35 @@ class IMAPAdapter(object):
         if folder:
             self.select(folder)
 
+    def noop(self):
+        """Send NOOP, e.g. to check that the connection is alive.
+
+        Updates self.total if the server reports new messages.
+
+        Returns the number of messages reported by EXISTS, None if there
+        was no EXISTS response.
+        """
+        status, data = self.mail.noop()
+        if status != 'OK':
+            raise Error(data[0])
+        total = self._get_response_code_int('EXISTS')
+        if total is not None and self.selected_folder:
+            self.total = total
+        return total
+
+    def logout(self):
+        """Log out and close the connection, ignoring errors."""
+        try:
+            self.mail.logout()
+        except (imaplib.IMAP4.error, socket.error):
+            log.debug('Error logging out from %s', self.host, exc_info=True)
+
     def _copy_args(self):
         # This is moved into a separate method because Gmail overrides it.
         return [self.login, self.password], dict(
-            host=self.host, port=self.port, ssl=self.ssl)
+            host=self.host, port=self.port, ssl=self.ssl,
+            use_uid=self.use_uid, cache=self.cache, compress=self.compress,
+            stream_messages=self.stream_messages)
 
     def copy(self):
         """Create a new IMAP4Adapter like self, and connect to it."""
@@ -563,47 +2152,194 @@ class IMAPAdapter(object):
             new_conn.select(folder)
         return new_conn
 
-    def _idle(self, fetch_spec, msg_q):
+    def _idle(
+        self, fetch_spec, msg_q, debounce=IDLE_DEBOUNCE,
+        idle_timeout=IDLE_TIMEOUT, stats=None
+    ):
+        stats = stats or IdleStats()
         self.idling = True
-        while self.idling:
-            try:
-                uid = None
-                for uid, message in _idle_imap4_connection(self.mail):
+        # How many messages were in the folder when they were last fetched.
+        known = self.total or 0
+        use_idle = self.has_capability('IDLE')
+        interval = POLL_MIN_INTERVAL
+        try:
+            while self.idling:
+                try:
+                    if use_idle:
+                        exists, known, noticed = self._idle_until_new(
+                            known, debounce, idle_timeout, stats)
+                    else:
+                        exists, known, noticed = self._poll_until_new(
+                            known, interval, stats)
+                        if exists > known:
+                            interval = POLL_MIN_INTERVAL
+                        else:
+                            interval = min(
+                                interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
                     if not self.idling:
-                        uid = None
                         break
-                    if message != 'EXISTS':
-                        continue
-                    _send_done_imap4_connection(self.mail)
-                    break
-                if not uid:
-                    continue
-                # ManualStop requested.
-                if not self.idling:
-                    break
-
-                message = self.fetch_email_by_uid(uid, fetch_spec=fetch_spec)
-                msg_q.put(message)
-            except NotSupported, e:
-                msg_q.put(e)
+                    # EXISTS reports sequence numbers, even in use_uid mode.
+                    new = range(known + 1, exists + 1)
+                    for start in xrange(0, len(new), FETCH_BATCH_SIZE):
+                        for message in self._fetch_batch(
+                            new[start:start + FETCH_BATCH_SIZE], fetch_spec,
+                            by_uid=False
+                        ):
+                            msg_q.put(message)
+                    if new:
+                        stats.add_messages(len(new), time.time() - noticed)
+                    known = exists
+                except NotSupported:
+                    log.info(
+                        'IDLE is not supported by %s, polling instead',
+                        self.host)
+                    use_idle = False
+                except (socket.error, imaplib.IMAP4.abort):
+                    log.warning(
+                        'IDLE connection to %s lost, reconnecting', self.host,
+                        exc_info=True)
+                    stats.reconnects += 1
+                    self.reconnect()
+                    self.idling = True
+                    known = self.total or 0
+        except Exception as e:
+            # The consumer of msg_q would wait forever otherwise.
+            log.exception('IDLE on %s failed', self.host)
+            self.idling = False
+            msg_q.put(e)
+
+    def _poll_until_new(self, known, interval, stats):
+        """Wait "interval" seconds, then check for new messages with NOOP.
+
+        Returns like _idle_until_new(), the previous poll time is returned as
+        the time new messages were noticed.
+        """
+        started = time.time()
+        deadline = started + interval
+        while self.idling and time.time() < deadline:
+            time.sleep(max(0, min(IDLE_POLL_INTERVAL, deadline - time.time())))
+        if not self.idling:
+            return known, known, started
+        # Forget EXPUNGE responses of the previous commands.
+        self.mail.response('EXPUNGE')
+        reported = self.noop()
+        stats.polls += 1
+        _, expunged = self.mail.response('EXPUNGE')
+        expunged = [number for number in expunged or () if number is not None]
+        for number in expunged:
+            if int(number) <= known:
+                known -= 1
+        if reported is None:
+            # Without EXISTS, the total only changes by expunged messages.
+            self._count_expunged(expunged)
+        exists = self.total if self.total is not None else known
+        return exists, known, started
+
+    def _idle_until_new(self, known, debounce, idle_timeout, stats):
+        """Run IDLE until new messages come and "debounce" seconds pass.
+
+        Also returns if idling is stopped, or after idle_timeout seconds.
+
+        Returns a tuple (the number of messages in the folder, how many of
+        them were known before, when new messages were noticed), adjusted
+        for expunged messages.
+        """
+        mail = self.mail
+        counts = {
+            'exists': self.total if self.total is not None else known,
+            'known': known}
+        tag = mail._new_tag()
+        mail.send('%s IDLE\r\n' % tag)
+        stats.idles += 1
+        came = False
+        response = _imap4_read_response(mail)
+        while not response.startswith('+'):
+            if response.startswith(tag + ' '):
+                raise NotSupported('IDLE failed: %s' % response.strip())
+            came = self._handle_idle_response(response, counts) or came
+            response = _imap4_read_response(mail)
+
+        started = time.time()
+        deadline = started + debounce if came else None
+        while self.idling:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            if now - started >= idle_timeout:
+                break
+            timeout = IDLE_POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, deadline - now)
+            if not _imap4_readable(mail, timeout):
+                continue
+            response = _imap4_read_response(mail)
+            if self._handle_idle_response(response, counts) and (
+                deadline is None
+            ):
+                deadline = time.time() + debounce
+
+        mail.send('DONE\r\n')
+        while True:
+            response = _imap4_read_response(mail)
+            if response.startswith(tag + ' '):
+                if not response.startswith(tag + ' OK'):
+                    raise Error('IDLE failed: %s' % response.strip())
                 break
-            except socket.error:
-                self.reconnect()
-                self.idling = True
+            self._handle_idle_response(response, counts)
+        self.total = counts['exists']
+        noticed = deadline - debounce if deadline is not None else time.time()
+        return counts['exists'], counts['known'], noticed
 
-    def idle(self, fetch_spec=FETCH_HEADERS_ONLY, copy=True):
+    def _handle_idle_response(self, response, counts):
+        """Update message counts from an untagged response during IDLE.
+
+        Returns True if new messages came.
+        """
+        parts = response.rstrip('\r\n').split(' ', 3)
+        if parts[0] != '*' or len(parts) < 2:
+            log.debug('Unexpected response during IDLE: %r', response)
+            return False
+        if parts[1].upper() == 'BYE':
+            raise imaplib.IMAP4.abort(response.strip())
+        if len(parts) < 3 or not parts[1].isdigit():
+            return False
+        number, typ = int(parts[1]), parts[2].upper()
+        if typ == 'EXISTS':
+            counts['exists'] = number
+            return number > counts['known']
+        if typ == 'EXPUNGE':
+            counts['exists'] -= 1
+            if number <= counts['known']:
+                counts['known'] -= 1
+        # FETCH with changed flags, RECENT etc. don't matter here.
+        return False
+
+    def idle(
+        self, fetch_spec=FETCH_HEADERS_ONLY, copy=True, debounce=IDLE_DEBOUNCE,
+        idle_timeout=IDLE_TIMEOUT
+    ):
         """Starts IDLE in a separate thread.
 
+        IDLE is restarted every idle_timeout seconds. If the server does not
+        support IDLE, the folder is polled with NOOP instead, more often
+        after new messages, and less often while there are none. Counters
+        are collected in self.idle_stats, an IdleStats object.
+
         Args:
           fetch_spec: in what RFC to fetch the email values. You can set
             to FETCH_RFC822 to yield whole email objects.
           copy: if True, which is the default, do not touch the existing
             connection, but create a new one.
+          debounce: after a new message comes, wait this many seconds for
+            more, and fetch them all at once.
+          idle_timeout: restart IDLE after this many seconds, set it below
+            the server or NAT idle connection timeout.
 
         Returns a tuple:
           - first is a function, which you should call with no arguments, if you
             want to stop idling.
-          - an iterable of MessageWrapper objects that you can consume.
+          - an iterable of MessageWrapper objects that you can consume, or
+            Envelope objects if fetch_spec is FETCH_ENVELOPE.
         """
         if not self.selected_folder:
             raise ProgrammingError('You should select a folder before idling')
@@ -612,7 +2348,10 @@ class IMAPAdapter(object):
         else:
             conn = self
         q = Queue.Queue()
-        t = threading.Thread(target=conn._idle, args=(fetch_spec, q))
+        self.idle_stats = IdleStats()
+        t = threading.Thread(
+            target=conn._idle,
+            args=(fetch_spec, q, debounce, idle_timeout, self.idle_stats))
         t.daemon = True
         t.start()
 
@@ -623,13 +2362,12 @@ class IMAPAdapter(object):
         def iter_messages():
             while True:
                 result = q.get()
-                if isinstance(result, MessageWrapper):
-                    yield result
-                    continue
-                elif isinstance(result, ManualStop):
+                if isinstance(result, ManualStop):
                     raise StopIteration
                 elif isinstance(result, Exception):
                     raise result
+                # MessageWrapper or Envelope, depending on fetch_spec.
+                yield result
         return stop, iter_messages()
 
     def search_folders(self, name_re=None, flags=None):
@@ -708,45 +2446,289 @@ class IMAPAdapter(object):
         assert status == 'OK', data[0]
         self.selected_folder = folder
         self.total = int(data[0])
+        self.uidvalidity = self._get_response_code_int('UIDVALIDITY')
+        self.uidnext = self._get_response_code_int('UIDNEXT')
+        if self.cache is not None and self.uidvalidity is not None:
+            self.cache.set_uidvalidity(
+                self._cache_account(), folder, self.uidvalidity)
         return self.total
 
-    def _encode(self, string):
-        """Encode a string to UTF7 if it's unicode."""
-        if isinstance(string, unicode):
-            return imapUTF7.imapUTF7Encode(string)
-        return string
-
-    def _decode(self, string):
-        """Decode a string from UTF7 if it's not unicode."""
-        if isinstance(string, unicode):
-            return string
-        return imapUTF7.imapUTF7Decode(string)
+    def _get_response_code_int(self, code):
+        """Get an integer response code, e.g. UIDVALIDITY, after a command."""
+        _, data = self.mail.response(code)
+        for value in reversed(data or []):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                continue
 
-    def search(self, query='ALL', reverse=True, **kwargs):
+    def search(self, query='ALL', reverse=True, sort=None, **kwargs):
         """Fetch and parse "limit" emails by search query.
 
         Args:
             query: an IMAP4 query to search the emails for.
             reverse: if True (default), the newest email is the first to come.
+            sort: RFC 5256 sort criteria, e.g. "REVERSE DATE" for the newest
+              by the "Date:" header first, see sort_ids(). reverse is ignored
+              then.
 
         Yields MessageWrapper objects.
 
         For a more high-level method see search_emails().
         """
+        if sort:
+            uids = self.sort_ids(sort, query)
+            count = len(uids)
+        else:
+            count, uids = self._search_window(
+                query, kwargs.get('limit', FETCH_LIMIT), reverse)
+        log.info(
+            'IMAP search in "%s", %s found, query "%s", kwargs %s',
+            self.selected_folder, count, query, kwargs)
+        return self._fetch_emails_by_uids(uids, **kwargs)
+
+    def sort_ids(self, criteria, query='ALL'):
+        """Search messages, and sort them by RFC 5256 criteria.
+
+        Uses SORT if the server supports it. Otherwise envelopes of all the
+        found messages are fetched and sorted locally.
+
+        Args:
+            criteria: a string or a list of ARRIVAL, CC, DATE, FROM, SIZE,
+              SUBJECT or TO, each may be preceded by REVERSE.
+            query: an IMAP4 query to search the emails for.
+
+        Returns a list of string ids.
+        """
+        parsed = _parse_sort_criteria(criteria)
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        if not self.has_capability('SORT'):
+            return self._sort_locally(parsed, self._search_ids(query))
+        criteria = '(%s)' % ' '.join(
+            ('REVERSE %s' if reverse else '%s') % criterion
+            for criterion, reverse in parsed)
+        if self.use_uid:
+            status, data = self.mail.uid('SORT', criteria, 'UTF-8', query)
+        else:
+            status, data = self.mail.sort(criteria, 'UTF-8', query)
+        if status != 'OK':
+            raise Error('SORT failed: %s' % data[0])
+        if data and data[0]:
+            return data[0].split()
+        return []
+
+    def _sort_locally(self, criteria, uids):
+        envelopes = []
+        for start in xrange(0, len(uids), FETCH_BATCH_SIZE):
+            envelopes.extend(self._fetch_batch(
+                uids[start:start + FETCH_BATCH_SIZE], FETCH_ENVELOPE))
+        # Stable sorts by each key from the last one, ties stay in the
+        # order of uids, as RFC 5256 requires.
+        for criterion, reverse in reversed(criteria):
+            envelopes.sort(key=_SORT_KEYS[criterion], reverse=reverse)
+        return [str(envelope.uid) for envelope in envelopes]
+
+    def thread(self, query='ALL', algorithm='REFERENCES'):
+        """Search messages, and group them into threads (RFC 5256).
+
+        Uses THREAD if the server supports the algorithm. Otherwise, for
+        REFERENCES, headers of all the found messages are fetched and
+        threaded locally, without merging threads by subject.
+
+        Returns a list of threads. A thread is a list of string ids, where a
+        message is followed by its reply. If a message has several replies,
+        each of them starts a nested list. E.g. [['2'], ['3', '6', ['4',
+        '23'], ['44', '7', '96']]]: 2 has no replies, 3 has a reply 6, which
+        has replies 4 and 44. Like the server, may return threads starting
+        with nested lists, if their root messages are missing.
+        """
+        algorithm = algorithm.upper()
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        if not self.has_capability('THREAD=' + algorithm):
+            if algorithm != 'REFERENCES':
+                raise NotSupported(
+                    'Server does not support THREAD=%s' % algorithm)
+            return self._thread_locally(self._search_ids(query))
+        if self.use_uid:
+            status, data = self.mail.uid('THREAD', algorithm, 'UTF-8', query)
+        else:
+            status, data = self.mail.thread(algorithm, 'UTF-8', query)
+        if status != 'OK':
+            raise Error('THREAD failed: %s' % data[0])
+        if not data or not data[0]:
+            return []
+        return _parse_imap_list(data[0])
+
+    def _thread_locally(self, uids):
+        messages = []
+        for start in xrange(0, len(uids), FETCH_BATCH_SIZE):
+            messages.extend(self._fetch_batch(
+                uids[start:start + FETCH_BATCH_SIZE], FETCH_THREAD_HEADERS))
+        return _thread_by_references(messages)
+
+    def _search_ids(self, query, by_uid=None):
+        """Run SEARCH or UID SEARCH, return a list of string ids.
+
+        With ESEARCH (RFC 4731) the ids come as ranges, and a MessageSet is
+        returned instead of a list.
+        """
+        if by_uid is None:
+            by_uid = self.use_uid
         if isinstance(query, unicode):
             query = query.encode('utf-8')
-        status, data = self.mail.search('utf-8', query)
+        if self.has_capability('ESEARCH'):
+            return self._esearch(query, by_uid, 'ALL').get('ALL', MessageSet())
+        if by_uid:
+            status, data = self.mail.uid('SEARCH', 'CHARSET', 'utf-8', query)
+        else:
+            status, data = self.mail.search('utf-8', query)
         assert status == 'OK', data[0]
         if data[0]:
-            uids = data[0].split()
+            return data[0].split()
+        return []
+
+    def _search_window(self, query, limit=None, reverse=False, by_uid=None):
+        """Search, return the number of found ids and the first "limit" ids.
+
+        If reverse, the ids go from the last one, i.e. the newest. With
+        PARTIAL (RFC 9394) or CONTEXT=SEARCH (RFC 5267) only the ids in the
+        window are sent by the server.
+        """
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        if not limit or not (
+            self.has_capability('PARTIAL') or
+            self.has_capability('CONTEXT=SEARCH')
+        ):
+            uids = self._search_ids(query, by_uid)
+            if reverse:
+                uids.reverse()
+            return len(uids), uids[:limit] if limit else uids
+        if not reverse:
+            window = '1:%d' % limit
+        elif self.has_capability('PARTIAL'):
+            window = '-1:-%d' % limit
         else:
-            uids = []
-        log.info(
-            'IMAP search in "%s", %s found, query "%s", kwargs %s',
-            self.selected_folder, len(uids), query, kwargs)
+            # RFC 5267 has no ranges from the end, so count the ids first.
+            count = self._esearch(query, by_uid, 'COUNT').get('COUNT', 0)
+            if not count:
+                return 0, []
+            window = '%d:%d' % (max(count - limit + 1, 1), count)
+        result = self._esearch(query, by_uid, 'COUNT PARTIAL %s' % window)
+        uids = result.get('PARTIAL', MessageSet())
         if reverse:
             uids.reverse()
-        return self._fetch_emails_by_uids(uids, **kwargs)
+        return result.get('COUNT', len(uids)), uids
+
+    def _esearch(self, query, by_uid, options):
+        """Run SEARCH RETURN (options), return the parsed ESEARCH response."""
+        # Forget ESEARCH responses left from other commands.
+        self.mail.response('ESEARCH')
+        self._uid_command(
+            'SEARCH', by_uid, 'RETURN', '(%s)' % options, 'CHARSET', 'utf-8',
+            query)
+        _, data = self.mail.response('ESEARCH')
+        result = {}
+        for response in data or ():
+            if response:
+                result.update(_parse_esearch(response))
+        return result
+
+    def sharded_search(
+        self, query='ALL', connections=4, ordered=True, reverse=True,
+        limit=None, fetch_spec=FETCH_RFC822, batch_size=FETCH_BATCH_SIZE
+    ):
+        """Search, and fetch the results over several connections at once.
+
+        The found UIDs are split into batches, which are downloaded in
+        parallel by up to "connections" copies of this adapter. At most
+        HOST_CONNECTION_LIMITS connections per host are open at the same
+        time by all sharded searches in the process.
+
+        Args:
+            query, reverse, limit, fetch_spec, batch_size: same as in search(),
+              but there is no limit by default.
+            connections: how many connections to download with.
+            ordered: if True, messages are yielded in the search order,
+              otherwise as soon as their batch is downloaded.
+
+        Yields MessageWrapper objects with real UIDs, see use_uid.
+        """
+        if not self.selected_folder:
+            raise ProgrammingError('You should select a folder first')
+        _, uids = self._search_window(query, limit, reverse, by_uid=True)
+        batches = Queue.Queue()
+        for idx, start in enumerate(xrange(0, len(uids), batch_size)):
+            batches.put((idx, uids[start:start + batch_size]))
+        connections = min(connections, batches.qsize())
+        if not connections:
+            return
+        results = Queue.Queue()
+        stopped = threading.Event()
+        # Limits how many batches may wait in memory to be yielded.
+        window = threading.Semaphore(connections * 2)
+        host_semaphore = _get_host_semaphore(self.host)
+
+        def worker():
+            with host_semaphore:
+                conn = None
+                try:
+                    while not stopped.is_set():
+                        window.acquire()
+                        try:
+                            idx, batch = batches.get_nowait()
+                        except Queue.Empty:
+                            window.release()
+                            break
+                        if stopped.is_set():
+                            break
+                        if conn is None:
+                            conn = self.copy()
+                            conn.use_uid = True
+                        results.put(
+                            (idx, conn._fetch_batch(batch, fetch_spec)))
+                except Exception as e:
+                    results.put((None, e))
+                finally:
+                    if conn is not None:
+                        conn.logout()
+                    results.put((None, None))
+
+        for _ in xrange(connections):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        next_idx = 0
+        running = connections
+        try:
+            while running:
+                idx, result = results.get()
+                if idx is None:
+                    if isinstance(result, Exception):
+                        raise result
+                    running -= 1
+                    continue
+                if not ordered:
+                    window.release()
+                    for msg in result:
+                        yield msg
+                    continue
+                pending[idx] = result
+                while next_idx in pending:
+                    msgs = pending.pop(next_idx)
+                    next_idx += 1
+                    window.release()
+                    for msg in msgs:
+                        yield msg
+        finally:
+            stopped.set()
+            # Wake up the workers waiting for the window.
+            for _ in xrange(connections):
+                window.release()
 
     def list(self):
         """Return a list of IMAPFolder objects for this connection."""
@@ -763,7 +2745,8 @@ class IMAPAdapter(object):
         """Fetch an EmailMessage by uid.
 
         Args:
-            uid: the uid of the email, only makes sense during this connection.
+            uid: the uid of the email. Unless use_uid is set, this is a
+              sequence number, only makes sense during this connection.
             fetch_spec: RFC822 fetch specification.
 
         Returns:
@@ -776,33 +2759,272 @@ class IMAPAdapter(object):
         e.g. '(BODY[HEADER.FIELDS (SUBJECT FROM DATE TO CC)])', this is
         already defined in FETCH_HEADERS_ONLY in this module.
         """
-        status, data = self.mail.fetch(uid, fetch_spec)
+        for msg in self._fetch_batch([uid], fetch_spec):
+            return msg
+        raise Error('Message %s not found' % uid)
+
+    def _fetch_emails_by_uids(
+        self, uids, limit=FETCH_LIMIT, fetch_spec=FETCH_RFC822,
+        batch_size=FETCH_BATCH_SIZE
+    ):
+        """Fetch and parse emails by uids, batch_size emails per command.
+
+        Yields MessageWrapper objects in the order of uids.
+        """
+        if limit:
+            uids = uids[:limit]
+        for start in xrange(0, len(uids), batch_size):
+            chunk = uids[start:start + batch_size]
+            for msg in self._fetch_batch(chunk, fetch_spec):
+                yield msg
+
+    def _fetch(self, message_set, fetch_spec, by_uid=None):
+        """Run FETCH or UID FETCH, return parsed (number, items) tuples."""
+        if by_uid is None:
+            by_uid = self.use_uid
+        if by_uid:
+            status, data = self.mail.uid('FETCH', message_set, fetch_spec)
+        else:
+            status, data = self.mail.fetch(message_set, fetch_spec)
         if status != 'OK':
             raise Error(data[0])
-        return self.parse_email(data[0][1])
+        return _parse_fetch_response(data)
+
+    def _fetch_batch(self, uids, fetch_spec, by_uid=None):
+        """Fetch emails by uids with a single FETCH command.
+
+        If by_uid is False, uids are sequence numbers even if use_uid is set.
+
+        Returns a list of MessageWrapper objects in the order of uids.
+        Messages not returned by the server are skipped.
+        """
+        if by_uid is None:
+            by_uid = self.use_uid
+        fetch_spec = _add_fetch_items(fetch_spec, self._extra_fetch_items())
+        use_cache = (
+            self.cache is not None and by_uid and self.uidvalidity is not None)
+        cached, missing = [], uids
+        if use_cache:
+            cached, missing = self._get_cached(uids, fetch_spec)
+        parsed = []
+        if missing:
+            # Streaming is only on for this FETCH, so that imaplib calls on
+            # self.mail still get strings.
+            self.mail.stream_messages = (
+                self.stream_messages and self.cache is None)
+            try:
+                parsed = self._fetch(
+                    _compress_uids(missing), fetch_spec, by_uid=by_uid)
+            finally:
+                self.mail.stream_messages = False
+            if use_cache:
+                self._put_cached(missing, fetch_spec, parsed)
+        messages = self._messages_from_fetch(uids, cached + parsed, by_uid)
+        for msg in messages:
+            if isinstance(msg, MessageWrapper):
+                msg.adapter = self
+        return messages
+
+    def search_envelopes(
+        self, query='ALL', reverse=True, limit=FETCH_LIMIT,
+        batch_size=FETCH_BATCH_SIZE
+    ):
+        """Search and fetch FETCH_ENVELOPE, for listing messages.
+
+        Returns a list of Envelope objects, newest first if reverse is True.
+        """
+        return list(self.search(
+            query, reverse=reverse, limit=limit, fetch_spec=FETCH_ENVELOPE,
+            batch_size=batch_size))
+
+    def set_flags(self, uids, flags, by_uid=None):
+        """Add flags to messages, e.g. set_flags(uids, ['\\Seen']).
+
+        Like other bulk operations, uses as few commands as possible, and
+        takes sequence numbers instead of uids if by_uid is False.
+        """
+        self._store(uids, '+FLAGS.SILENT', flags, by_uid)
+
+    def clear_flags(self, uids, flags, by_uid=None):
+        """Remove flags from messages."""
+        self._store(uids, '-FLAGS.SILENT', flags, by_uid)
+
+    def copy_to(self, uids, folder, by_uid=None):
+        """Copy messages to another folder."""
+        folder = self._folder_arg(folder)
+        for message_set in _split_message_sets(uids):
+            self._uid_command('COPY', by_uid, message_set, folder)
+
+    def move_to(self, uids, folder, by_uid=None, expunge=False):
+        """Move messages to another folder.
+
+        Uses MOVE if the server supports it, otherwise copies the messages
+        and deletes them, see delete(). Only the copied messages are
+        expunged then, with UID EXPUNGE, if by_uid and the server supports
+        UIDPLUS. Otherwise they stay flagged as \\Deleted, unless expunge
+        is True: EXPUNGE then removes all the messages flagged as \\Deleted
+        in the folder, not only the moved ones.
+        """
+        if not self.has_capability('MOVE'):
+            if by_uid is None:
+                by_uid = self.use_uid
+            self.copy_to(uids, folder, by_uid)
+            self.delete(uids, by_uid, expunge=expunge or (
+                by_uid and self.has_capability('UIDPLUS')))
+            return
+        imaplib.Commands.setdefault('MOVE', ('SELECTED', ))
+        folder = self._folder_arg(folder)
+        self._pop_expunged()
+        # Moving the highest sequence numbers first keeps the lower ones.
+        for message_set in reversed(_split_message_sets(uids)):
+            self._uid_command('MOVE', by_uid, message_set, folder)
+        self._pop_expunged()
+
+    def delete(self, uids, by_uid=None, expunge=True):
+        """Flag messages as \\Deleted, and expunge them.
+
+        With UIDPLUS and by_uid, only these messages are expunged. Otherwise
+        EXPUNGE removes all the messages flagged as \\Deleted in the folder.
+        """
+        self.set_flags(uids, ['\\Deleted'], by_uid)
+        if not expunge:
+            return
+        if by_uid is None:
+            by_uid = self.use_uid
+        self._pop_expunged()
+        if by_uid and self.has_capability('UIDPLUS'):
+            for message_set in _split_message_sets(uids):
+                self._uid_command('EXPUNGE', True, message_set)
+        else:
+            status, data = self.mail.expunge()
+            if status != 'OK':
+                raise Error(data[0])
+            # imaplib returns the EXPUNGE responses of EXPUNGE.
+            self._count_expunged(data)
+        self._pop_expunged()
+
+    def _store(self, uids, action, flags, by_uid):
+        flags = '(%s)' % ' '.join(flags)
+        for message_set in _split_message_sets(uids):
+            self._uid_command('STORE', by_uid, message_set, action, flags)
+
+    def _uid_command(self, command, by_uid, *args):
+        """Run a command with UID if by_uid, or use_uid by default."""
+        if by_uid is None:
+            by_uid = self.use_uid
+        if by_uid:
+            status, data = self.mail.uid(command, *args)
+        else:
+            status, data = self.mail._simple_command(command, *args)
+        if status != 'OK':
+            raise Error('%s failed: %s' % (command, data[0]))
+        return data
+
+    def _folder_arg(self, folder):
+        if isinstance(folder, IMAPFolder):
+            folder = folder.name
+        return self._encode(folder)
+
+    def _pop_expunged(self):
+        """Update self.total after EXPUNGE responses, and forget them."""
+        _, expunged = self.mail.response('EXPUNGE')
+        self._count_expunged(expunged)
+
+    def _count_expunged(self, expunged):
+        expunged = [number for number in expunged or () if number is not None]
+        if expunged and self.total is not None:
+            self.total -= len(expunged)
 
-    def _fetch_emails_by_uids(self, uids, limit=FETCH_LIMIT, **kwargs):
-        """Fetch and parse emails by uids."""
-        limit = limit or -1
+    def _cache_account(self):
+        return '%s@%s' % (self.login, self.host)
+
+    def _get_cached(self, uids, fetch_spec):
+        """Look up messages in the cache.
+
+        Returns a tuple (parsed FETCH results of the cached messages, a list
+        of uids not found in the cache).
+        """
+        cached, missing = [], []
+        account = self._cache_account()
         for uid in uids:
-            msg = self.fetch_email_by_uid(uid, **kwargs)
-            msg.uid = uid
-            yield msg
-            limit -= 1
-            if limit == 0:
-                break
+            items = self.cache.get(
+                account, self.selected_folder, self.uidvalidity, uid,
+                fetch_spec)
+            if items is None:
+                missing.append(uid)
+            else:
+                items['UID'] = str(uid)
+                cached.append((str(uid), items))
+        return cached, missing
+
+    def _put_cached(self, uids, fetch_spec, parsed):
+        requested = set(str(uid) for uid in uids)
+        account = self._cache_account()
+        for _, items in parsed:
+            uid = items.get('UID')
+            if uid not in requested or (
+                _get_fetched_body(items) is None and
+                'BODYSTRUCTURE' not in items
+            ):
+                continue
+            self.cache.put(
+                account, self.selected_folder, self.uidvalidity, uid,
+                fetch_spec, items)
 
-    def parse_email(self, email_string):
-        """Convert an email string to MessageWrapper."""
-        msg = email.message_from_string(email_string)
-        return MessageWrapper(msg)
+    def fetch_part(
+        self, uid, part, encoding=None, offset=None, length=None, by_uid=None
+    ):
+        """Fetch one MIME part of a message with BODY.PEEK[<part>].
 
-    def easy_search(
-        self, since=None, before=None, subject=None, sender=None,
-        exact_date=None, headers=None, fetch_spec=FETCH_RFC822,
-        other_queries=(),
-        **kwargs
+        Args:
+            uid: the uid or sequence number of the message.
+            part: the part number, e.g. "2.1", see BodyPart.part.
+            encoding: the content transfer encoding of the part, e.g.
+              "base64". If given, the data is decoded.
+            offset, length: if given, fetch only "length" bytes of the
+              encoded part starting from "offset".
+            by_uid: if False, uid is a sequence number even if use_uid is set.
+
+        Returns:
+            String part data.
+        """
+        if by_uid is None:
+            by_uid = self.use_uid
+        section = 'BODY.PEEK[%s]' % part
+        if offset is not None:
+            section += '<%d.%d>' % (offset, length)
+        for _, items in self._fetch(str(uid), '(%s)' % section, by_uid=by_uid):
+            for name, data in items.iteritems():
+                if name.startswith('BODY['):
+                    # The server returns NIL past the end of the part.
+                    return _decode_transfer_encoding(data or '', encoding)
+        raise Error('Part %s of message %s not found' % (part, uid))
+
+    def iter_part(
+        self, uid, part, encoding=None, chunk_size=PART_CHUNK_SIZE,
+        by_uid=None
     ):
+        """Fetch a MIME part with partial fetches, chunk_size at a time.
+
+        Yields decoded strings, see fetch_part() for the arguments. Only one
+        chunk is held in memory at a time.
+        """
+        decoder = _TransferDecoder(encoding)
+        offset = 0
+        while True:
+            data = self.fetch_part(
+                uid, part, offset=offset, length=chunk_size, by_uid=by_uid)
+            offset += len(data)
+            decoded = decoder.decode(data)
+            if decoded:
+                yield decoded
+            if len(data) < chunk_size:
+                break
+        decoded = decoder.flush()
+        if decoded:
+            yield decoded
+
+    def easy_search(self, fetch_spec=FETCH_RFC822, **kwargs):
         """An intelligent generic search function.
 
         Args (all optional):
@@ -815,60 +3037,43 @@ class IMAPAdapter(object):
             fetch_spec: in what form to yield emails
             other_queries: additonal string IMAP queries.
         """
-        if since and before:
-            assert before > since
-        if exact_date and (since or before):
-            raise ProgrammingError(
-                'If exact_date is specified, since and before should be not')
-        if exact_date:
-            # We cannot determine date for sure cause of unknown server tz.
-            since = exact_date.date() - datetime.timedelta(1)
-            before = exact_date.date() + datetime.timedelta(1)
-        query = []
-        headers = headers or {}
-        headers = dict((k.upper(), v) for k, v in headers.iteritems())
-        if since:
-            query.extend(['SINCE', since.strftime('%d-%b-%Y')])
-        if before:
-            query.extend(['BEFORE', before.strftime('%d-%b-%Y')])
-        assert isinstance(other_queries, (list, tuple))
-        query.extend(other_queries)
-        if subject:
-            try:
-                subject = unicode(subject)
-            except UnicodeEncodeError:
-                raise NotSupported(
-                    'Non-unicode subject queries are not supported')
-            try:
-                headers['SUBJECT'] = subject.encode('ascii')
-            except UnicodeEncodeError:
-                if not sender:
-                    raise NotSupported('Unicode subject search requires sender')
-        if sender:
-            headers['FROM'] = sender
-        for header, value in headers.iteritems():
-            value = value.replace('"', r'\"')
-            query.extend(['HEADER %s' % header, '"%s"' % value])
-
-        for msg in self.search(query='(%s)' % ' '.join(query),
-                               fetch_spec=FETCH_HEADERS_ONLY, **kwargs):
-            if subject and subject not in (msg.subject or ''):
-                continue
-            if exact_date and msg.date != exact_date:
-                continue
-            if isinstance(since, datetime.datetime) and msg.date < since:
-                continue
-            if isinstance(before, datetime.datetime) and msg.date > before:
+        query_kwargs = dict(
+            (name, kwargs.pop(name)) for name in EASY_SEARCH_ARGS
+            if name in kwargs)
+        query, matches = self._easy_search_query(**query_kwargs)
+
+        # Headers are fetched and filtered first, then the survivors are
+        # fetched with fetch_spec in batches.
+        batch_size = kwargs.get('batch_size', FETCH_BATCH_SIZE)
+        survivors = []
+        for msg in self.search(
+            query=query, fetch_spec=FETCH_HEADERS_ONLY, **kwargs
+        ):
+            if not matches(msg):
                 continue
             if fetch_spec == FETCH_HEADERS_ONLY:
                 yield msg
-            else:
-                yield self.fetch_email_by_uid(msg.uid, fetch_spec=fetch_spec)
+                continue
+            survivors.append(msg.uid)
+            if len(survivors) >= batch_size:
+                for msg in self._fetch_batch(survivors, fetch_spec):
+                    yield msg
+                survivors = []
+        if survivors:
+            for msg in self._fetch_batch(survivors, fetch_spec):
+                yield msg
 
 
-class Gmail(IMAPAdapter):
-    host = 'imap.gmail.com'
-    ssl = True
+class _GmailMixin(object):
+    """Gmail OAuth2 and X-GM-* extensions, shared with betterimap.protocol."""
+
+    # Gmail extension fetch items and the MessageWrapper attributes they are
+    # stored to.
+    X_GM_ATTRIBUTES = {
+        'X-GM-MSGID': 'x_gm_msgid',
+        'X-GM-THRID': 'x_gm_thrid',
+        'X-GM-LABELS': 'x_gm_labels',
+    }
 
     @staticmethod
     def get_access_token(refresh_token, client_id, client_secret):
@@ -895,19 +3100,80 @@ class Gmail(IMAPAdapter):
         self.client_id = kwargs.pop('client_id', None)
         self.client_secret = kwargs.pop('client_secret', None)
         self.refresh_token_callback = kwargs.pop('refresh_token_callback', None)
+        # Which of X_GM_ATTRIBUTES to fetch along with every message.
+        self.x_gm_fetch_items = tuple(
+            kwargs.pop('x_gm_fetch_items', ('X-GM-MSGID',)))
         if self.refresh_token:
             assert self.client_id and self.client_secret, (
                 'Using OAuth2 refresh_token requires client_id'
                 ' and client_secret')
-        super(Gmail, self).__init__(*args, **kwargs)
-
-    def _authenticate(self, login, password=None):
+        super(_GmailMixin, self).__init__(*args, **kwargs)
+
+    def _extra_fetch_items(self):
+        return (
+            super(_GmailMixin, self)._extra_fetch_items() +
+            list(self.x_gm_fetch_items))
+
+    def _set_fetched_attributes(self, msg, items):
+        super(_GmailMixin, self)._set_fetched_attributes(msg, items)
+        for item in self.x_gm_fetch_items:
+            value = items.get(item)
+            if item == 'X-GM-LABELS' and value is not None:
+                value = [self._decode(label) for label in value]
+            setattr(msg, self.X_GM_ATTRIBUTES[item], value)
+
+    def _use_oauth2(self, password):
+        """Check the credentials, return True if OAuth2 tokens are given."""
         if (self.access_token or self.refresh_token) and password:
             raise ProgrammingError(
                 'Password should be empty if using access tokens')
         if not self.login:
             raise ProgrammingError('Login missing')
-        if not (self.access_token or self.refresh_token):
+        return bool(self.access_token or self.refresh_token)
+
+    def _next_access_token(self, login, access_token, refresh_token):
+        """Choose the access token for the next XOAUTH2 attempt.
+
+        If there is no access_token, a new one is requested with the
+        refresh_token, which can be used only once.
+
+        Returns a tuple (access token, refresh token for the next attempt).
+
+        Raises:
+            OAuth2Error, if both tokens are used up.
+        """
+        if access_token:
+            return access_token, refresh_token
+        if not refresh_token:
+            raise OAuth2Error('Cannot login to gmail %s with XOAUTH2' % login)
+        data = self.get_access_token(
+            refresh_token, self.client_id, self.client_secret)
+        if self.refresh_token_callback:
+            self.refresh_token_callback(data)
+        return data['access_token'], None
+
+    @staticmethod
+    def _generate_oauth_string(user, access_token):
+        """Generates an IMAP OAuth2 authentication string.
+
+        See https://developers.google.com/google-apps/gmail/oauth2_overview
+
+        Args:
+          username: the username (email address) of the account to authenticate
+          access_token: An OAuth2 access token.
+
+        Returns:
+          The SASL argument for the OAuth2 mechanism.
+        """
+        return 'user=%s\1auth=Bearer %s\1\1' % (user, access_token)
+
+
+class Gmail(_GmailMixin, IMAPAdapter):
+    host = 'imap.gmail.com'
+    ssl = True
+
+    def _authenticate(self, login, password=None):
+        if not self._use_oauth2(password):
             return self._auth_login(login, password)
         else:
             return self._auth_token(login)
@@ -919,36 +3185,25 @@ class Gmail(IMAPAdapter):
     def _auth_token(self, login):
         access_token = self.access_token
         refresh_token = self.refresh_token
-
-        while access_token or refresh_token:
-            if not access_token:
-                data = self.get_access_token(
-                    self.refresh_token, self.client_id, self.client_secret)
-                access_token = data['access_token']
-                if self.refresh_token_callback:
-                    self.refresh_token_callback(data)
-                refresh_token = None
-            auth_string = self._generate_oauth_string(
-                login, access_token)
+        while True:
+            access_token, refresh_token = self._next_access_token(
+                login, access_token, refresh_token)
+            auth_string = self._generate_oauth_string(login, access_token)
             try:
                 self.mail.authenticate('XOAUTH2', lambda x: auth_string)
-                self.access_token = access_token
-                break
             except:
                 access_token = None
-        else:
-            raise OAuth2Error('Cannot login to gmail %s with XOAUTH2' % login)
+                continue
+            self.access_token = access_token
+            return
 
     def get_x_gm_msgid(self, uid):
         """Get the Gmail unique id for the message."""
         # Example response:
         # ('OK', ['1663 (X-GM-MSGID 1417225945689728157)'])
-        status, data = self.mail.fetch(uid, '(X-GM-MSGID)')
-        assert status == 'OK', data[0]
-        result = data[0]
-        match = re.match(r'%s \(X-GM-MSGID (.+?)\)' % uid, result)
-        if match:
-            return match.group(1)
+        for _, items in self._fetch(str(uid), '(X-GM-MSGID)'):
+            if 'X-GM-MSGID' in items:
+                return items['X-GM-MSGID']
 
     def _copy_args(self):
         args, kwargs = super(Gmail, self)._copy_args()
@@ -957,6 +3212,7 @@ class Gmail(IMAPAdapter):
         kwargs['client_id'] = self.client_id
         kwargs['client_secret'] = self.client_secret
         kwargs['refresh_token_callback'] = self.refresh_token_callback
+        kwargs['x_gm_fetch_items'] = self.x_gm_fetch_items
         return args, kwargs
 
     def easy_search(self, x_gm_msgid=None, **kwargs):
@@ -972,26 +3228,6 @@ class Gmail(IMAPAdapter):
         ):
             return msg
 
-    def search(self, *args, **kwargs):
-        """Search for message, but also fetch X-GM-MSGID."""
-        for msg in super(Gmail, self).search(*args, **kwargs):
-            msg.x_gm_msgid = self.get_x_gm_msgid(msg.uid)
-            yield msg
-
-    def _generate_oauth_string(self, user, access_token):
-        """Generates an IMAP OAuth2 authentication string.
-
-        See https://developers.google.com/google-apps/gmail/oauth2_overview
-
-        Args:
-          username: the username (email address) of the account to authenticate
-          access_token: An OAuth2 access token.
-
-        Returns:
-          The SASL argument for the OAuth2 mechanism.
-        """
-        return 'user=%s\1auth=Bearer %s\1\1' % (user, access_token)
-
 
 class YandexMail(IMAPAdapter):
     host = 'imap.yandex.ru'
@@ -0,0 +1,235 @@
+# coding: utf-8
+
+"""An on-disk cache of fetched messages, see IMAPAdapter(cache=...)."""
+
+import collections
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# The suffix of entries being written.
+_TMP_SUFFIX = '.tmp'
+
+
+class MessageCache(object):
+    """A size-bounded LRU cache of fetched messages on local disk.
+
+    Entries are keyed by (account, folder, uidvalidity, uid, fetch_spec) and
+    stored as files under path/<account and folder>/<uidvalidity>/, one file
+    per message with its raw bytes. When a folder is selected with a new
+    UIDVALIDITY, entries of the old one are removed.
+
+    The cache may be shared by threads, and by processes using the same
+    path. Each process accounts the cache size separately, so with many
+    processes the cache may temporarily grow above max_size.
+
+    Only messages fetched by UID are cached. Items like FLAGS or X-GM-LABELS
+    are cached along with the message, and may become stale.
+
+    Example:
+
+        cache = MessageCache('/var/cache/betterimap', max_size=1024 ** 3)
+        imap = IMAPAdapter(login, password, host=host, use_uid=True,
+                           cache=cache)
+    """
+
+    def __init__(self, path, max_size=512 * 1024 * 1024):
+        """Open or create a cache in the "path" directory.
+
+        Args:
+            path: the cache directory, created if it does not exist.
+            max_size: least recently used entries are removed when the total
+              size of the cached files exceeds this many bytes.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        # Maps file paths to their sizes, the least recently used first.
+        self._entries = collections.OrderedDict()
+        self._load()
+
+    @property
+    def hit_rate(self):
+        """The share of get() calls that found the message, from 0 to 1."""
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def get(self, account, folder, uidvalidity, uid, fetch_spec):
+        """Get the FETCH items dictionary of a message, or None."""
+        path = self._entry_path(account, folder, uidvalidity, uid, fetch_spec)
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline()
+                body = f.read()
+            os.utime(path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                log.warning('Cannot read cache entry %s: %s', path, e)
+            with self._lock:
+                self.misses += 1
+                self._forget(path)
+            return
+        try:
+            body_name, items = json.loads(header)
+            items = dict(
+                (str(name), _to_str(value))
+                for name, value in items.iteritems())
+        except (AttributeError, TypeError, ValueError) as e:
+            log.warning('Removing corrupt cache entry %s: %s', path, e)
+            with self._lock:
+                self.misses += 1
+                self._forget(path)
+            self._remove_files([path])
+            return
+        if body_name is not None:
+            items[str(body_name)] = body
+        with self._lock:
+            self.hits += 1
+            if path in self._entries:
+                self._entries[path] = self._entries.pop(path)
+        return items
+
+    def put(self, account, folder, uidvalidity, uid, fetch_spec, items):
+        """Store the FETCH items dictionary of a message."""
+        body_name = None
+        other_items = {}
+        for name, value in items.iteritems():
+            if body_name is None and isinstance(value, str) and (
+                name.startswith('BODY[') or name.startswith('RFC822')
+            ):
+                body_name = name
+            else:
+                other_items[name] = value
+        try:
+            header = json.dumps([body_name, other_items])
+        except (TypeError, ValueError):
+            log.debug('Not caching message %s, items are not ASCII', uid)
+            return
+        path = self._entry_path(account, folder, uidvalidity, uid, fetch_spec)
+        directory = os.path.dirname(path)
+        tmp_path = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Written to a temporary file first, so that readers never see
+            # a partially written entry.
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=_TMP_SUFFIX)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header + '\n')
+                f.write(items.get(body_name) or '')
+            os.rename(tmp_path, path)
+            size = os.path.getsize(path)
+        except (IOError, OSError) as e:
+            log.warning('Cannot write cache entry %s: %s', path, e)
+            if tmp_path is not None:
+                self._remove_files([tmp_path])
+            return
+        with self._lock:
+            self._forget(path)
+            self._entries[path] = size
+            self.size += size
+            expired = self._expire()
+        self._remove_files(expired)
+
+    def set_uidvalidity(self, account, folder, uidvalidity):
+        """Remove the cached messages of the folder with other UIDVALIDITY."""
+        folder_path = self._folder_path(account, folder)
+        try:
+            names = os.listdir(folder_path)
+        except OSError:
+            return
+        for name in names:
+            if name == str(uidvalidity):
+                continue
+            log.info(
+                'UIDVALIDITY of %s changed to %s, removing cached messages',
+                folder, uidvalidity)
+            self._remove_directory(os.path.join(folder_path, name))
+
+    def clear(self):
+        """Remove all cached messages."""
+        self._remove_directory(self.path)
+
+    def _remove_directory(self, path):
+        prefix = os.path.join(path, '')
+        with self._lock:
+            for entry in self._entries.keys():
+                if entry.startswith(prefix):
+                    self._forget(entry)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _folder_path(self, account, folder):
+        if isinstance(folder, unicode):
+            folder = folder.encode('utf-8')
+        key = hashlib.sha1('%s\0%s' % (account, folder)).hexdigest()
+        return os.path.join(self.path, key)
+
+    def _entry_path(self, account, folder, uidvalidity, uid, fetch_spec):
+        spec_key = hashlib.sha1(fetch_spec).hexdigest()[:16]
+        return os.path.join(
+            self._folder_path(account, folder), str(uidvalidity),
+            '%s-%s' % (uid, spec_key))
+
+    def _load(self):
+        """Read the existing entries, ordered by their last use time."""
+        found = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.endswith(_TMP_SUFFIX):
+                    # Left by a process which crashed while writing.
+                    self._remove_files([path])
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        found.sort()
+        for _, path, size in found:
+            self._entries[path] = size
+            self.size += size
+        self._remove_files(self._expire())
+
+    def _forget(self, path):
+        """Drop an entry from the index, call with _lock held."""
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self.size -= size
+
+    def _expire(self):
+        """Pop least recently used entries above max_size, call with _lock."""
+        expired = []
+        while self.size > self.max_size and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self.size -= size
+            expired.append(path)
+        return expired
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    log.warning('Cannot remove cache entry %s: %s', path, e)
+
+
+def _to_str(value):
+    """Convert unicode strings loaded from JSON back to str."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return map(_to_str, value)
+    return value
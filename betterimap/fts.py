@@ -0,0 +1,213 @@
+# coding: utf-8
+
+"""A local full-text index of messages, using SQLite FTS5."""
+
+import HTMLParser
+import logging
+import re
+import sqlite3
+
+from . import (
+    FETCH_RFC822, Error, NotSupported, ProgrammingError, _add_fetch_items)
+
+log = logging.getLogger(__name__)
+
+_HTML_SKIP_RE = re.compile(
+    r'<(script|style)\b.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+_SPACES_RE = re.compile(r'\s+', re.UNICODE)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    UNIQUE (folder, uid)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    subject, sender, recipients, body, tokenize = 'unicode61'
+);
+'''
+
+
+class FullTextIndex(object):
+    """Full-text index of subjects, addresses and texts of messages.
+
+    Messages are identified by (folder, uid), so the adapters feeding the
+    index should use use_uid=True or update(). One index is meant for one
+    account, and one thread.
+
+    Example:
+
+        fts = FullTextIndex('/var/lib/mail/index.sqlite')
+        fts.update(imap, 'INBOX')
+        for msg in fts.fetch(imap, fts.search(u'отчёт квартал')):
+            print msg.subject
+    """
+
+    def __init__(self, path=':memory:'):
+        """Open or create the index in the SQLite database file "path".
+
+        Raises:
+            NotSupported, if SQLite is built without FTS5.
+        """
+        self.db = sqlite3.connect(path)
+        try:
+            self.db.executescript(_SCHEMA)
+        except sqlite3.OperationalError as e:
+            self.db.close()
+            raise NotSupported('SQLite FTS5 is not available: %s' % e)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def add(self, msg, folder=None, uidvalidity=None, uid=None):
+        """Index a MessageWrapper, replacing the old version if indexed.
+
+        folder, uidvalidity and uid default to the message attributes.
+        """
+        self._insert(msg, folder, uidvalidity, uid)
+        self.db.commit()
+
+    def _insert(self, msg, folder=None, uidvalidity=None, uid=None):
+        """Like add(), but without committing."""
+        folder = folder or msg.folder
+        uidvalidity = uidvalidity or msg.uidvalidity
+        uid = uid or msg.uid
+        if not (folder and uidvalidity and uid):
+            raise ProgrammingError(
+                'Messages need folder, uidvalidity and uid to be indexed')
+        self._delete(folder, 'uid = ?', [int(uid)])
+        cursor = self.db.execute(
+            'INSERT INTO messages (folder, uidvalidity, uid) VALUES (?, ?, ?)',
+            (folder, int(uidvalidity), int(uid)))
+        self.db.execute(
+            'INSERT INTO messages_fts (rowid, subject, sender, recipients, '
+            'body) VALUES (?, ?, ?, ?, ?)', (
+                cursor.lastrowid, msg.subject or u'',
+                _format_addrs([msg.from_addr]),
+                _format_addrs((msg.to or []) + (msg.cc or [])),
+                _message_text(msg)))
+
+    def remove(self, folder, uids):
+        """Remove messages of the folder from the index."""
+        for uid in uids:
+            self._delete(folder, 'uid = ?', [int(uid)])
+        self.db.commit()
+
+    def update(self, adapter, folder=None, batch_size=50):
+        """Index the messages of a folder which are not in the index yet.
+
+        Only UIDs above the highest indexed one are fetched. If the folder
+        UIDVALIDITY changed, the folder is indexed from scratch.
+
+        Returns the number of messages added.
+
+        Raises:
+            Error, if the server does not report the folder UIDVALIDITY.
+        """
+        folder = folder or adapter.selected_folder
+        if not folder:
+            raise ProgrammingError('No folder to index, select one first')
+        adapter.select(folder)
+        uidvalidity = adapter.uidvalidity
+        if uidvalidity is None:
+            raise Error(
+                'Server did not report UIDVALIDITY of %s, cannot index it' %
+                folder)
+        self._delete(folder, 'uidvalidity != ?', [uidvalidity])
+        self.db.commit()
+        last = self.db.execute(
+            'SELECT MAX(uid) FROM messages WHERE folder = ?',
+            (folder, )).fetchone()[0] or 0
+        uids = [
+            uid for uid in map(int, adapter._search_ids(
+                'UID %d:*' % (last + 1), by_uid=True))
+            if uid > last]
+        uids.sort()
+        fetch_spec = _add_fetch_items(FETCH_RFC822, ['UID'])
+        for start in xrange(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            for msg in adapter._fetch_batch(batch, fetch_spec, by_uid=True):
+                self._insert(msg, folder, uidvalidity, msg.uid)
+            self.db.commit()
+        log.info('Indexed %d new messages in %s', len(uids), folder)
+        return len(uids)
+
+    def search(self, query, folder=None, limit=100, raw=False):
+        """Find messages, the most relevant first.
+
+        Args:
+            query: words to search for. Messages with all of them are found.
+            folder: search only in this folder.
+            limit: the maximum number of results.
+            raw: if True, query is passed to FTS5 MATCH as is, e.g.
+              'subject:report AND sender:igor'.
+
+        Returns:
+            A list of (folder, uid) tuples.
+        """
+        if not raw:
+            query = u' '.join(
+                u'"%s"' % word.replace(u'"', u'""') for word in query.split())
+            if not query:
+                return []
+        sql = (
+            'SELECT m.folder, m.uid FROM messages_fts f '
+            'JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ?')
+        args = [query]
+        if folder:
+            sql += ' AND m.folder = ?'
+            args.append(folder)
+        sql += ' ORDER BY f.rank LIMIT ?'
+        args.append(limit)
+        return [
+            (folder, str(uid)) for folder, uid in self.db.execute(sql, args)]
+
+    def fetch(self, adapter, hits, fetch_spec=FETCH_RFC822):
+        """Fetch search() results, yields MessageWrapper objects."""
+        by_folder = {}
+        for folder, uid in hits:
+            by_folder.setdefault(folder, []).append(uid)
+        fetch_spec = _add_fetch_items(fetch_spec, ['UID'])
+        for folder, uids in by_folder.iteritems():
+            adapter.select(folder)
+            for msg in adapter._fetch_batch(uids, fetch_spec, by_uid=True):
+                yield msg
+
+    def _delete(self, folder, condition, args):
+        where = 'folder = ? AND ' + condition
+        args = [folder] + list(args)
+        self.db.execute(
+            'DELETE FROM messages_fts WHERE rowid IN '
+            '(SELECT id FROM messages WHERE %s)' % where, args)
+        self.db.execute('DELETE FROM messages WHERE %s' % where, args)
+
+
+def _format_addrs(addrs):
+    return u' '.join(
+        u'%s %s' % (_to_unicode(name), _to_unicode(addr))
+        for name, addr in addrs if name or addr)
+
+
+def _message_text(msg):
+    """Get the plaintext of a message, or the text of its HTML."""
+    text = msg.plaintext()
+    if not text:
+        html = msg.html()
+        if not html:
+            return u''
+        html = _to_unicode(html)
+        text = _HTML_TAG_RE.sub(u' ', _HTML_SKIP_RE.sub(u' ', html))
+        text = HTMLParser.HTMLParser().unescape(text)
+    return _SPACES_RE.sub(u' ', _to_unicode(text)).strip()
+
+
+def _to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value or u''
@@ -0,0 +1,260 @@
+# coding: utf-8
+
+"""A compact in-memory index of a folder, to filter without IMAP traffic."""
+
+import array
+import calendar
+import datetime
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import (
+    FETCH_BATCH_SIZE, FETCH_ENVELOPE, FETCH_RFC822, IMAPFolder,
+    _add_fetch_items)
+
+log = logging.getLogger(__name__)
+
+# Flags with fixed bits in MailboxIndex.flags, other flags get the next free
+# bits, up to 32 flags in total.
+SYSTEM_FLAGS = (
+    '\\Seen', '\\Answered', '\\Flagged', '\\Deleted', '\\Draft', '\\Recent')
+
+
+class MailboxIndex(object):
+    """Columns of message attributes of a folder, built from ENVELOPE.
+
+    Each attribute is stored in an array.array column, and queries filter
+    them with numpy if it is installed.
+
+    Columns, one item per message, in the order of UIDs:
+        uids: integer UIDs.
+        internaldates, dates: INTERNALDATE and Date: header as UTC epoch
+          seconds, NaN if missing.
+        sizes: integer RFC822.SIZE.
+        flags: bitmasks of flags, see flag_bits.
+        senders: indexes of From: addresses in the "addresses" list.
+
+    Example:
+
+        index = MailboxIndex(imap, 'INBOX')
+        uids = index.query(since=datetime.date(2014, 9, 1), flags=['\\\\Seen'],
+                           sender='igor@example.com')
+        for msg in index.fetch(uids):
+            print msg.subject
+    """
+
+    def __init__(self, adapter, folder=None, batch_size=FETCH_BATCH_SIZE):
+        """Build the index of a folder.
+
+        Args:
+            adapter: an IMAPAdapter, used to build and refresh the index.
+            folder: the folder to index, the selected folder by default.
+            batch_size: how many envelopes to request with one FETCH.
+        """
+        if isinstance(folder, IMAPFolder):
+            folder = folder.name
+        self.adapter = adapter
+        self.folder = folder or adapter.selected_folder
+        assert self.folder, 'No folder selected'
+        self.batch_size = batch_size
+        self.uidvalidity = None
+        self.flag_bits = dict(
+            (flag.lower(), 1 << i) for i, flag in enumerate(SYSTEM_FLAGS))
+        self.addresses = []
+        self._address_ids = {}
+        self._clear()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.uids)
+
+    def refresh(self):
+        """Add new messages to the index, and remove expunged ones.
+
+        Flag changes of indexed messages are not noticed. If the folder
+        UIDVALIDITY changed, the index is rebuilt.
+        """
+        self.adapter.select(self.folder)
+        if self.adapter.uidvalidity != self.uidvalidity:
+            if self.uidvalidity is not None:
+                log.info('UIDVALIDITY of %s changed, rebuilding the index',
+                         self.folder)
+            self._clear()
+            self.uidvalidity = self.adapter.uidvalidity
+        uids = [
+            int(uid) for uid in self.adapter._search_ids('ALL', by_uid=True)]
+        self._remove_missing(set(uids))
+        last = self.uids[-1] if self.uids else 0
+        new = sorted(uid for uid in uids if uid > last)
+        fetch_spec = _add_fetch_items(FETCH_ENVELOPE, ['UID'])
+        for start in xrange(0, len(new), self.batch_size):
+            batch = new[start:start + self.batch_size]
+            for envelope in self.adapter._fetch_batch(
+                batch, fetch_spec, by_uid=True
+            ):
+                self._append(envelope)
+        log.debug('Indexed %d messages in %s, %d new',
+                  len(self), self.folder, len(new))
+
+    def query(
+        self, since=None, before=None, sent_since=None, sent_before=None,
+        sender=None, min_size=None, max_size=None, flags=(), without_flags=()
+    ):
+        """Find messages in the index, without sending IMAP commands.
+
+        Args (all optional):
+            since, before: dates or datetimes to compare INTERNALDATE with,
+              like IMAP SINCE and BEFORE: since <= internaldate < before.
+              Dates and naive datetimes are in UTC.
+            sent_since, sent_before: the same for the Date: header.
+            sender: a From: address or a list of addresses.
+            min_size, max_size: the RFC822.SIZE range, inclusive.
+            flags: flags the messages must have, e.g. ["\\\\Seen"].
+            without_flags: flags the messages must not have.
+
+        Returns:
+            A list of integer UIDs in ascending order.
+        """
+        conditions = []
+        for column, low, high in (
+            (self.internaldates, since, before),
+            (self.dates, sent_since, sent_before),
+        ):
+            if low is not None:
+                conditions.append((column, '>=', _to_epoch(low)))
+            if high is not None:
+                conditions.append((column, '<', _to_epoch(high)))
+        if min_size is not None:
+            conditions.append((self.sizes, '>=', min_size))
+        if max_size is not None:
+            conditions.append((self.sizes, '<=', max_size))
+        if sender is not None:
+            if isinstance(sender, basestring):
+                sender = [sender]
+            ids = set(
+                self._address_ids.get(addr.lower(), -1) for addr in sender)
+            conditions.append((self.senders, 'in', ids))
+        required = self._flags_mask(flags)
+        if required is None:
+            return []
+        if required:
+            conditions.append((self.flags, 'all', required))
+        excluded = self._flags_mask(without_flags, ignore_unknown=True)
+        if excluded:
+            conditions.append((self.flags, 'none', excluded))
+        if not self.uids:
+            return []
+        if numpy is not None:
+            return self._query_numpy(conditions)
+        return self._query_python(conditions)
+
+    def fetch(self, uids, fetch_spec=FETCH_RFC822):
+        """Fetch messages found by query(), yields MessageWrapper objects."""
+        self.adapter.select(self.folder)
+        for start in xrange(0, len(uids), self.batch_size):
+            batch = uids[start:start + self.batch_size]
+            for msg in self.adapter._fetch_batch(
+                batch, _add_fetch_items(fetch_spec, ['UID']), by_uid=True
+            ):
+                yield msg
+
+    def _query_numpy(self, conditions):
+        mask = numpy.ones(len(self.uids), dtype=bool)
+        for column, op, value in conditions:
+            column = numpy.frombuffer(column, dtype=column.typecode)
+            if op == '>=':
+                mask &= column >= value
+            elif op == '<':
+                mask &= column < value
+            elif op == '<=':
+                mask &= column <= value
+            elif op == 'in':
+                mask &= numpy.in1d(column, list(value))
+            elif op == 'all':
+                mask &= (column & value) == value
+            else:
+                mask &= (column & value) == 0
+        uids = numpy.frombuffer(self.uids, dtype=self.uids.typecode)
+        return uids[mask].tolist()
+
+    def _query_python(self, conditions):
+        indexes = xrange(len(self.uids))
+        for column, op, value in conditions:
+            if op == '>=':
+                indexes = [i for i in indexes if column[i] >= value]
+            elif op == '<':
+                indexes = [i for i in indexes if column[i] < value]
+            elif op == '<=':
+                indexes = [i for i in indexes if column[i] <= value]
+            elif op == 'in':
+                indexes = [i for i in indexes if column[i] in value]
+            elif op == 'all':
+                indexes = [i for i in indexes if column[i] & value == value]
+            else:
+                indexes = [i for i in indexes if not column[i] & value]
+        return [self.uids[i] for i in indexes]
+
+    def _flags_mask(self, flags, ignore_unknown=False):
+        """Make a bitmask of flags, None if a flag is unknown."""
+        mask = 0
+        for flag in flags:
+            bit = self.flag_bits.get(flag.lower())
+            if bit is None and not ignore_unknown:
+                return
+            mask |= bit or 0
+        return mask
+
+    def _clear(self):
+        self.uids = array.array('I')
+        self.internaldates = array.array('d')
+        self.dates = array.array('d')
+        self.sizes = array.array('I')
+        self.flags = array.array('I')
+        self.senders = array.array('I')
+
+    def _columns(self):
+        return (
+            self.uids, self.internaldates, self.dates, self.sizes,
+            self.flags, self.senders)
+
+    def _append(self, envelope):
+        flags = 0
+        for flag in envelope.flags or ():
+            bit = self.flag_bits.get(flag.lower())
+            if bit is None and len(self.flag_bits) < 32:
+                bit = self.flag_bits[flag.lower()] = 1 << len(self.flag_bits)
+            flags |= bit or 0
+        address = envelope.from_addr[1].lower()
+        sender = self._address_ids.get(address)
+        if sender is None:
+            sender = self._address_ids[address] = len(self.addresses)
+            self.addresses.append(address)
+        self.uids.append(int(envelope.uid))
+        self.internaldates.append(_to_epoch(envelope.internaldate))
+        self.dates.append(_to_epoch(envelope.date))
+        self.sizes.append(envelope.size or 0)
+        self.flags.append(flags)
+        self.senders.append(sender)
+
+    def _remove_missing(self, uids):
+        """Remove messages with UIDs not in the "uids" set."""
+        keep = [i for i, uid in enumerate(self.uids) if uid in uids]
+        if len(keep) == len(self.uids):
+            return
+        for column in self._columns():
+            column[:] = array.array(column.typecode, (column[i] for i in keep))
+
+
+def _to_epoch(value):
+    """Convert a date or datetime to UTC epoch seconds, None to NaN."""
+    if value is None:
+        return float('nan')
+    if isinstance(value, datetime.datetime):
+        return float(calendar.timegm(value.utctimetuple()))
+    if isinstance(value, datetime.date):
+        return float(calendar.timegm(value.timetuple()))
+    return float(value)
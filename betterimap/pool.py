@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""A thread-safe pool of authenticated IMAPAdapter connections."""
+
+import contextlib
+import imaplib
+import logging
+import socket
+import threading
+import time
+
+from . import Error, IMAPAdapter, IMAPFolder
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(Error):
+    pass
+
+
+class PoolClosed(Error):
+    pass
+
+
+class IMAPAdapterPool(object):
+    """A pool of connections to one account, created with IMAPAdapter.copy().
+
+    Example:
+
+        pool = IMAPAdapterPool(imap, max_size=4)
+        with pool.connection('INBOX') as conn:
+            for msg in conn.search(limit=10):
+                print msg.subject
+    """
+
+    def __init__(
+        self, adapter, max_size=4, max_idle_time=300, health_check_after=10,
+        timeout=None
+    ):
+        """Create a pool.
+
+        Args:
+            adapter: an IMAPAdapter, new connections are made with its copy().
+              The adapter itself is never handed out by the pool.
+            max_size: maximum number of connections open at the same time.
+            max_idle_time: connections unused for this many seconds are closed.
+            health_check_after: connections unused for this many seconds are
+              checked with NOOP on checkout.
+            timeout: default number of seconds checkout() waits for a free
+              connection, None to wait forever.
+        """
+        assert isinstance(adapter, IMAPAdapter)
+        assert max_size > 0
+        self.adapter = adapter
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+        self.size = 0
+        self.closed = False
+        # (last used time, adapter) tuples, the last used is the last.
+        self._idle = []
+        self._cond = threading.Condition(threading.Lock())
+
+    def checkout(self, folder=None, timeout=None):
+        """Get a connection from the pool, with "folder" selected.
+
+        A connection that already has the folder selected is preferred, so
+        no SELECT is needed. Waits up to "timeout" seconds for a connection
+        if max_size connections are in use, then raises PoolTimeout.
+        """
+        if isinstance(folder, IMAPFolder):
+            folder = folder.name
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            last_used, conn = self._take(folder, deadline)
+            if conn is None:
+                conn = self._create()
+            elif not self._is_healthy(conn, last_used):
+                self._discard(conn)
+                continue
+            if folder:
+                try:
+                    conn.select(folder)
+                except:
+                    self.checkin(conn, discard=True)
+                    raise
+            return conn
+
+    def checkin(self, conn, discard=False):
+        """Return a connection to the pool, or close it if discard is True."""
+        if discard or conn.idling:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self.closed:
+                self.size -= 1
+            else:
+                self._idle.append((time.time(), conn))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            conn.logout()
+        self.reap()
+
+    @contextlib.contextmanager
+    def connection(self, folder=None, timeout=None):
+        """A context manager for checkout() and checkin()."""
+        conn = self.checkout(folder, timeout=timeout)
+        try:
+            yield conn
+        except (imaplib.IMAP4.abort, socket.error):
+            self.checkin(conn, discard=True)
+            raise
+        except:
+            self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    def reap(self):
+        """Close connections which were idle for more than max_idle_time."""
+        expired = []
+        now = time.time()
+        with self._cond:
+            while self._idle and now - self._idle[0][0] > self.max_idle_time:
+                expired.append(self._idle.pop(0)[1])
+            self.size -= len(expired)
+            if expired:
+                self._cond.notify_all()
+        for conn in expired:
+            log.debug('Closing idle connection to %s', conn.host)
+            conn.logout()
+
+    def close(self):
+        """Close idle connections, checked out ones are closed on checkin."""
+        with self._cond:
+            self.closed = True
+            idle = [conn for _, conn in self._idle]
+            self._idle = []
+            self.size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.logout()
+
+    def _take(self, folder, deadline):
+        """Take an idle connection, or reserve a slot for a new one.
+
+        Returns a tuple (last used time, adapter), or (None, None) if a new
+        connection should be created.
+        """
+        self.reap()
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise PoolClosed('The pool is closed')
+                if self._idle:
+                    idx = len(self._idle) - 1
+                    if folder:
+                        for i in xrange(len(self._idle) - 1, -1, -1):
+                            if self._idle[i][1].selected_folder == folder:
+                                idx = i
+                                break
+                    return self._idle.pop(idx)
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None, None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            'No free connection to %s in the pool' %
+                            self.adapter.host)
+                self._cond.wait(remaining)
+
+    def _create(self):
+        try:
+            return self.adapter.copy()
+        except:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+
+    def _is_healthy(self, conn, last_used):
+        if time.time() - last_used < self.health_check_after:
+            return True
+        try:
+            conn.noop()
+        except (Error, imaplib.IMAP4.error, socket.error):
+            log.info(
+                'Dropping dead connection to %s', conn.host, exc_info=True)
+            return False
+        return True
+
+    def _discard(self, conn):
+        with self._cond:
+            self.size -= 1
+            self._cond.notify()
+        conn.logout()
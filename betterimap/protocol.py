@@ -0,0 +1,1171 @@
+# coding: utf-8
+
+"""An IMAP4 client for event loops, which never blocks on network I/O.
+
+Python 2 has no asyncio, so this module is built in layers:
+
+- ResponseReader splits the data from the server into responses, reading
+  literals by their {N} length.
+- IMAPProtocol tags commands and dispatches their responses to callbacks.
+  It does not do any I/O itself, so any event loop can drive it.
+- Loop is a minimal epoll/select based event loop, and Future is a result of
+  an operation that is not finished yet, like in asyncio.
+- AsyncIMAPAdapter and AsyncGmail drive IMAPProtocol over a non-blocking
+  socket in a Loop. They have the IMAPAdapter methods, but return Futures.
+- IdleMultiplexer watches many folders with IDLE in one Loop, reconnecting
+  when connections fail.
+
+One Loop can drive hundreds of AsyncIMAPAdapters in a single thread:
+
+    loop = Loop()
+    imap = AsyncIMAPAdapter('login', 'password', host='imap.example.com',
+                            ssl=True, loop=loop)
+    loop.run_until_complete(imap.connect())
+    loop.run_until_complete(imap.select('INBOX'))
+    for msg in loop.run_until_complete(imap.search(limit=10)):
+        print msg.subject
+"""
+
+import base64
+import errno
+import heapq
+import imaplib
+import itertools
+import logging
+import Queue
+import re
+import select
+import socket
+import ssl as ssl_lib
+import time
+
+import betterimap
+from betterimap import (
+    Error, ProgrammingError, IMAPFolder, FETCH_BATCH_SIZE, FETCH_HEADERS_ONLY,
+    FETCH_LIMIT, FETCH_RFC822, EASY_SEARCH_ARGS, IDLE_TIMEOUT)
+
+log = logging.getLogger(__name__)
+
+# How many bytes to read from a socket at once.
+READ_SIZE = 65536
+
+# How many seconds IdleMultiplexer waits before reconnecting, doubled after
+# each failed attempt, up to RECONNECT_MAX_DELAY.
+RECONNECT_DELAY = 5
+RECONNECT_MAX_DELAY = 300
+
+_TAGGED_RE = re.compile(
+    r'(?P<tag>[A-Za-z0-9]+) (?P<type>[A-Z]+)( (?P<data>.*))?$')
+_LITERAL_RE = re.compile(r'\{(?P<size>\d+)\}$')
+
+
+def _quote(arg):
+    """Quote a command argument, like imaplib does."""
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class Future(object):
+    """A result of an operation, which will be available later."""
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Return the result, or raise the exception of the operation."""
+        if not self._done:
+            raise ProgrammingError('The result is not ready yet')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, func):
+        """Call func(future) when the future is done."""
+        if self._done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._set_done()
+
+    def _set_done(self):
+        if self._done:
+            raise ProgrammingError('The future is already done')
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+def _then(future, func):
+    """Return a Future of func(future.result()).
+
+    func may return another Future, then its result is used.
+    """
+    result = Future()
+
+    def copy(done):
+        if done.exception() is not None:
+            result.set_exception(done.exception())
+        else:
+            result.set_result(done.result())
+
+    def on_done(done):
+        try:
+            value = func(done.result())
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if isinstance(value, Future):
+            value.add_done_callback(copy)
+        else:
+            result.set_result(value)
+
+    future.add_done_callback(on_done)
+    return result
+
+
+class ResponseReader(object):
+    """Splits the data from the server into responses.
+
+    feed() returns a list of (tag, type, data) tuples:
+      - ('+', None, [text]) for continuation requests;
+      - (tag, 'OK', [text]) for command completion, type may also be 'NO'
+        or 'BAD';
+      - ('*', type, data) for untagged responses, where data is a list in the
+        format of imaplib, e.g. [('1 (RFC822 {5}', 'hello'), ')'] for
+        "* 1 FETCH (RFC822 {5}\\r\\nhello)".
+    Response codes like "[UIDVALIDITY 123]" are also returned as untagged
+    responses ('*', 'UIDVALIDITY', ['123']), like imaplib does.
+    """
+
+    def __init__(self):
+        self._buf = ''
+        # (line, literal) tuples of the response being read.
+        self._parts = []
+        # The line announcing the literal being read.
+        self._literal_line = None
+        self._literal_size = 0
+        self._literal_chunks = []
+        self._literal_read = 0
+
+    def feed(self, data):
+        responses = []
+        buf = self._buf + data if self._buf else data
+        # The position of unparsed data. The rest is sliced off buf once at
+        # the end, rather than after every line.
+        pos = 0
+        while pos < len(buf):
+            if self._literal_line is not None:
+                pos = self._read_literal(buf, pos)
+                if self._literal_line is not None:
+                    break
+                continue
+            idx = buf.find('\r\n', pos)
+            if idx < 0:
+                break
+            line = buf[pos:idx]
+            pos = idx + 2
+            match = _LITERAL_RE.search(line)
+            if match:
+                self._literal_line = line
+                self._literal_size = int(match.group('size'))
+                continue
+            responses.extend(self._make_responses(self._parts, line))
+            self._parts = []
+        self._buf = buf[pos:]
+        # The last literal may be empty, and there's no more data for it.
+        if self._literal_line is not None and not self._literal_size:
+            self._read_literal('', 0)
+        return responses
+
+    def _read_literal(self, buf, pos):
+        """Read literal data from buf at pos, return the position after it.
+
+        The literal is complete when self._literal_line is reset to None.
+        """
+        end = min(pos + self._literal_size - self._literal_read, len(buf))
+        chunk = buf[pos:end]
+        self._literal_chunks.append(chunk)
+        self._literal_read += len(chunk)
+        if self._literal_read < self._literal_size:
+            return end
+        self._parts.append(
+            (self._literal_line, ''.join(self._literal_chunks)))
+        self._literal_line = None
+        self._literal_size = self._literal_read = 0
+        self._literal_chunks = []
+        return end
+
+    def _make_responses(self, parts, last_line):
+        first = parts[0][0] if parts else last_line
+        if first == '+' or first.startswith('+ '):
+            return [('+', None, [first[2:]])]
+        if first.startswith('* '):
+            match = imaplib.Untagged_response.match(first)
+            if match:
+                typ, dat = match.group('type'), match.group('data') or ''
+            else:
+                match = imaplib.Untagged_status.match(first)
+                if not match:
+                    raise Error('Unexpected response: %r' % first)
+                typ, dat = match.group('type'), match.group('data')
+                if match.group('data2'):
+                    dat = dat + ' ' + match.group('data2')
+            if parts:
+                data = [(dat, parts[0][1])] + parts[1:] + [last_line]
+            else:
+                data = [dat]
+            tag = '*'
+        else:
+            match = _TAGGED_RE.match(first)
+            if not match:
+                raise Error('Unexpected response: %r' % first)
+            tag, typ, dat = match.group('tag', 'type', 'data')
+            dat = dat or ''
+            data = [dat]
+        responses = [(tag, typ, data)]
+        if typ in ('OK', 'NO', 'BAD', 'BYE', 'PREAUTH') and not parts:
+            match = imaplib.Response_code.match(dat)
+            if match:
+                responses.append(
+                    ('*', match.group('type'), [match.group('data')]))
+        return responses
+
+
+class IMAPProtocol(object):
+    """The client side of IMAP4, which does no I/O.
+
+    Put the data received from the server into receive_data(), and send what
+    data_to_send() returns. Commands are sent one at a time, in order, after
+    the server greeting.
+    """
+
+    def __init__(self):
+        self.reader = ResponseReader()
+        # Untagged responses by type, like imaplib.IMAP4.untagged_responses.
+        self.untagged_responses = {}
+        self.capabilities = set()
+        self.greeting = None
+        # Called with (type, data) for every untagged response.
+        self.on_untagged = None
+        self._tag_prefix = 'BI'
+        self._tag_counter = itertools.count(1)
+        self._queue = []
+        self._current = None
+        self._outgoing = []
+
+    def command(self, name, *args, **kwargs):
+        """Queue a command, return its tag.
+
+        Args:
+            name, args: the command and its arguments, e.g. 'SELECT', 'INBOX'.
+            callback: called with (type, data) on completion. If the type is
+              'OK', data are the untagged responses named "response",
+              otherwise the text of the completion response.
+            response: the untagged response name, the command name by default.
+            continuation: called with the text of each continuation request,
+              should return a string line to send back, or None.
+        """
+        tag = '%s%d' % (self._tag_prefix, next(self._tag_counter))
+        line = ' '.join([tag, name] + [str(arg) for arg in args])
+        self._queue.append(dict(
+            tag=tag, line=line + '\r\n', name=name,
+            response=kwargs.get('response', name),
+            callback=kwargs.get('callback'),
+            continuation=kwargs.get('continuation')))
+        self._send_next()
+        return tag
+
+    def send(self, data):
+        """Send raw data, e.g. "DONE\\r\\n" to finish IDLE."""
+        self._outgoing.append(data)
+
+    def data_to_send(self):
+        data = ''.join(self._outgoing)
+        self._outgoing = []
+        return data
+
+    def pop_untagged(self, name, default=None):
+        """Remove and return untagged responses named "name"."""
+        return self.untagged_responses.pop(name.upper(), default)
+
+    @property
+    def busy(self):
+        """True if there are commands not completed yet."""
+        return bool(self._current or self._queue)
+
+    def receive_data(self, data):
+        for tag, typ, dat in self.reader.feed(data):
+            if tag == '+':
+                self._on_continuation(dat[0])
+            elif tag == '*':
+                self._on_untagged(typ, dat)
+            else:
+                self._on_tagged(tag, typ, dat)
+
+    def _send_next(self):
+        if self.greeting is None or self._current or not self._queue:
+            return
+        self._current = self._queue.pop(0)
+        # Like imaplib, forget status responses of the previous commands.
+        for typ in ('OK', 'NO', 'BAD'):
+            self.untagged_responses.pop(typ, None)
+        self._outgoing.append(self._current['line'])
+
+    def _on_continuation(self, text):
+        current = self._current
+        if not current or not current['continuation']:
+            raise Error('Unexpected continuation request: %s' % text)
+        reply = current['continuation'](text)
+        if reply is not None:
+            self._outgoing.append(reply + '\r\n')
+
+    def _on_untagged(self, typ, data):
+        if self.greeting is None:
+            self.greeting = (typ, data)
+            self._send_next()
+        if typ == 'CAPABILITY':
+            self.capabilities = set(data[-1].upper().split())
+        self.untagged_responses.setdefault(typ, []).extend(data)
+        if self.on_untagged:
+            self.on_untagged(typ, data)
+
+    def _on_tagged(self, tag, typ, data):
+        current = self._current
+        if not current or current['tag'] != tag:
+            raise Error('Unexpected tagged response: %s %s' % (tag, typ))
+        self._current = None
+        if typ == 'OK':
+            data = self.pop_untagged(current['response'], [None])
+        self._send_next()
+        if current['callback']:
+            current['callback'](typ, data)
+
+
+class Loop(object):
+    """A minimal event loop for sockets and timers."""
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_counter = itertools.count()
+        self._stopped = False
+        self._epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self._registered = set()
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+        self._update(fd)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+        self._update(fd)
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds, return a timer handle."""
+        timer = [
+            time.time() + delay, next(self._timer_counter), callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer returned by call_later()."""
+        if timer:
+            timer[2] = None
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        """Run until stop() is called."""
+        self._stopped = False
+        while not self._stopped:
+            self.run_once()
+
+    def run_until_complete(self, future):
+        """Run until the future is done, return its result."""
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def run_once(self, timeout=None):
+        """Wait for events once and call their callbacks."""
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if self._timers:
+            delay = max(0, self._timers[0][0] - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+        if not (self._readers or self._writers or self._timers):
+            raise ProgrammingError('Nothing to wait for')
+        for fd, readable, writable in self._poll(timeout):
+            if readable and fd in self._readers:
+                self._readers[fd]()
+            if writable and fd in self._writers:
+                self._writers[fd]()
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                callback(*args)
+
+    def _update(self, fd):
+        if self._epoll is None:
+            return
+        mask = 0
+        if fd in self._readers:
+            mask |= select.EPOLLIN
+        if fd in self._writers:
+            mask |= select.EPOLLOUT
+        if not mask:
+            if fd in self._registered:
+                self._registered.discard(fd)
+                try:
+                    self._epoll.unregister(fd)
+                except (IOError, OSError, ValueError):
+                    pass
+        elif fd in self._registered:
+            self._epoll.modify(fd, mask)
+        else:
+            self._epoll.register(fd, mask)
+            self._registered.add(fd)
+
+    def _poll(self, timeout):
+        if self._epoll is not None:
+            try:
+                events = self._epoll.poll(-1 if timeout is None else timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+            error = select.EPOLLERR | select.EPOLLHUP
+            return [
+                (fd, bool(mask & (select.EPOLLIN | error)),
+                 bool(mask & (select.EPOLLOUT | error)))
+                for fd, mask in events]
+        try:
+            readable, writable, _ = select.select(
+                list(self._readers), list(self._writers), [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [(fd, True, False) for fd in readable] + [
+            (fd, False, True) for fd in writable]
+
+
+class AsyncIMAPAdapter(betterimap._FetchMixin):
+    """An IMAPAdapter counterpart, whose methods return Futures.
+
+    Messages are MessageWrapper objects, and folders are IMAPFolder
+    objects, same as with IMAPAdapter.
+    """
+
+    host = None
+    port = None
+    ssl = None
+
+    def __init__(
+        self, login=None, password=None, host=None, port=None, ssl=None,
+        use_uid=False, loop=None
+    ):
+        """Create an adapter, call connect() to connect and authenticate.
+
+        Args:
+            login, password, host, port, ssl, use_uid: same as in IMAPAdapter.
+            loop: the Loop to run in, a new one by default.
+        """
+        self.host = host or self.host
+        self.port = port or self.port
+        self.ssl = ssl or self.ssl
+        assert self.host, 'Server should not be empty'
+        self.login = login
+        self.password = password
+        self.use_uid = use_uid
+        self.loop = loop or Loop()
+        self.sock = None
+        self._address = None
+        self._reset()
+
+    def _reset(self):
+        self.protocol = IMAPProtocol()
+        self.protocol.on_untagged = self._on_untagged
+        self.selected_folder = None
+        self.total = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self._folder_list = None
+        self._wbuf = ''
+        self._idle = None
+        self._closed = Future()
+
+    # Connection handling.
+
+    def resolve(self):
+        """Look up the server address, which blocks until DNS answers.
+
+        The address is kept for connect() and reconnects, call resolve()
+        again to look it up anew.
+        """
+        port = self.port or (
+            imaplib.IMAP4_SSL_PORT if self.ssl else imaplib.IMAP4_PORT)
+        self._address = socket.getaddrinfo(
+            self.host, port, 0, socket.SOCK_STREAM)[0]
+
+    def connect(self):
+        """Connect and authenticate, returns a Future of self.
+
+        If resolve() was not called yet, connect() calls it, blocking the
+        loop while the host name is resolved.
+        """
+        future = Future()
+        if self._address is None:
+            self.resolve()
+        family, socktype, proto, _, address = self._address
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, errno.errorcode.get(err, err))
+        fd = self.sock.fileno()
+
+        def on_connected():
+            self.loop.remove_writer(fd)
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._fail(socket.error(err, errno.errorcode.get(err, err)))
+                return
+            if self.ssl:
+                self.sock = ssl_lib.wrap_socket(
+                    self.sock, do_handshake_on_connect=False)
+                self._handshake()
+            else:
+                self.loop.add_reader(fd, self._on_readable)
+
+        self.loop.add_writer(fd, on_connected)
+        capabilities = self._command('CAPABILITY')
+        _then(capabilities, lambda _: self._authenticate()).add_done_callback(
+            lambda done: (
+                future.set_exception(done.exception()) if done.exception()
+                else future.set_result(self)))
+        return future
+
+    def _handshake(self):
+        fd = self.sock.fileno()
+        try:
+            self.sock.do_handshake()
+        except ssl_lib.SSLError as e:
+            if e.args[0] == ssl_lib.SSL_ERROR_WANT_READ:
+                self.loop.add_reader(fd, self._handshake)
+            elif e.args[0] == ssl_lib.SSL_ERROR_WANT_WRITE:
+                self.loop.add_writer(fd, self._handshake)
+            else:
+                self._fail(e)
+            return
+        except socket.error as e:
+            self._fail(e)
+            return
+        self.loop.remove_writer(fd)
+        self.loop.add_reader(fd, self._on_readable)
+
+    def _authenticate(self):
+        assert self.login and self.password, 'Login and/or password missing'
+        return self._command(
+            'LOGIN', _quote(self.login), _quote(self.password))
+
+    def logout(self):
+        """Log out and close the connection, returns a Future."""
+        return _then(self._command('LOGOUT', response='BYE'),
+                     lambda _: self.close())
+
+    def close(self):
+        """Close the connection, failing all unfinished commands."""
+        self._fail(Error('Connection closed'))
+
+    @property
+    def closed(self):
+        """A Future, done with the reason when this connection is closed."""
+        return self._closed
+
+    def _fail(self, exception):
+        if self.sock is not None:
+            fd = self.sock.fileno()
+            self.loop.remove_reader(fd)
+            self.loop.remove_writer(fd)
+            self.sock.close()
+            self.sock = None
+        protocol, closed, idle = self.protocol, self._closed, self._idle
+        if idle:
+            self.loop.cancel(idle['timer'])
+        self._reset()
+        commands = ([protocol._current] if protocol._current else []) + (
+            protocol._queue)
+        for command in commands:
+            if command['callback']:
+                command['callback']('BYE', [str(exception)])
+        if idle and idle['stopped'] and not idle['stopped'].done():
+            idle['stopped'].set_exception(exception)
+        if not closed.done():
+            closed.set_result(exception)
+
+    def _on_readable(self):
+        if self.sock is None:
+            return
+        try:
+            while True:
+                data = self.sock.recv(READ_SIZE)
+                if not data:
+                    self._fail(Error('Connection closed by the server'))
+                    return
+                self.protocol.receive_data(data)
+                if self.sock is None:
+                    return
+                if not (self.ssl and self.sock.pending()):
+                    break
+        except ssl_lib.SSLError as e:
+            if e.args[0] != ssl_lib.SSL_ERROR_WANT_READ:
+                self._fail(e)
+                return
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(e)
+                return
+        except Error as e:
+            log.exception('Error handling data from %s', self.host)
+            self._fail(e)
+            return
+        self._flush()
+
+    def _flush(self):
+        """Send the data queued in the protocol."""
+        self._wbuf += self.protocol.data_to_send()
+        if not self._wbuf or self.sock is None:
+            return
+        fd = self.sock.fileno()
+        try:
+            sent = self.sock.send(self._wbuf)
+        except ssl_lib.SSLError as e:
+            if e.args[0] not in (
+                ssl_lib.SSL_ERROR_WANT_READ, ssl_lib.SSL_ERROR_WANT_WRITE
+            ):
+                self._fail(e)
+                return
+            sent = 0
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(e)
+                return
+            sent = 0
+        self._wbuf = self._wbuf[sent:]
+        if self._wbuf:
+            self.loop.add_writer(fd, self._flush)
+        else:
+            self.loop.remove_writer(fd)
+
+    def _command(self, name, *args, **kwargs):
+        """Queue a command, returns a Future of its untagged responses.
+
+        The Future fails with Error unless the server responds OK. Takes
+        the same keyword arguments as IMAPProtocol.command().
+        """
+        future = Future()
+
+        def on_done(typ, data):
+            if typ == 'OK':
+                future.set_result(data)
+            else:
+                future.set_exception(
+                    Error('%s failed: %s %s' % (name, typ, data[0])))
+
+        kwargs['callback'] = on_done
+        self.protocol.command(name, *args, **kwargs)
+        self._flush()
+        return future
+
+    # IMAPAdapter methods.
+
+    def select(self, folder):
+        """Select a folder, returns a Future of the number of messages."""
+        if isinstance(folder, IMAPFolder):
+            folder = folder.name
+        if self.selected_folder == folder:
+            future = Future()
+            future.set_result(self.total)
+            return future
+
+        def on_selected(data):
+            self.selected_folder = folder
+            self.total = int(data[-1])
+            self.uidvalidity = self._pop_response_code_int('UIDVALIDITY')
+            self.uidnext = self._pop_response_code_int('UIDNEXT')
+            return self.total
+
+        return _then(
+            self._command('SELECT', _quote(self._encode(folder)),
+                          response='EXISTS'),
+            on_selected)
+
+    def _pop_response_code_int(self, code):
+        for value in reversed(self.protocol.pop_untagged(code, [])):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                continue
+
+    def list(self):
+        """Returns a Future of a list of IMAPFolder objects."""
+        if self._folder_list:
+            future = Future()
+            future.set_result(self._folder_list)
+            return future
+
+        def on_list(data):
+            self._folder_list = [
+                IMAPFolder(self._decode(item)) for item in data if item]
+            return self._folder_list
+
+        return _then(self._command('LIST', '""', '*'), on_list)
+
+    def search(
+        self, query='ALL', reverse=True, limit=FETCH_LIMIT,
+        fetch_spec=FETCH_RFC822, batch_size=FETCH_BATCH_SIZE,
+        on_message=None
+    ):
+        """Search and fetch emails, see IMAPAdapter.search().
+
+        If on_message is provided, it's called with each MessageWrapper as
+        soon as its batch is fetched, and the Future result is None.
+        Otherwise the Future result is a list of MessageWrapper objects.
+        """
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        args = ('SEARCH', 'CHARSET', 'utf-8', query)
+        if self.use_uid:
+            args = ('UID',) + args
+
+        def on_search(data):
+            uids = data[0].split() if data and data[0] else []
+            if reverse:
+                uids.reverse()
+            if limit:
+                uids = uids[:limit]
+            return self._fetch_emails_by_uids(
+                uids, fetch_spec, batch_size, on_message)
+
+        return _then(self._command(*args, response='SEARCH'), on_search)
+
+    def easy_search(self, fetch_spec=FETCH_RFC822, on_message=None, **kwargs):
+        """Same as IMAPAdapter.easy_search(), but returns a Future.
+
+        on_message is handled like in search().
+        """
+        query_kwargs = dict(
+            (name, kwargs.pop(name)) for name in EASY_SEARCH_ARGS
+            if name in kwargs)
+        query, matches = self._easy_search_query(**query_kwargs)
+        batch_size = kwargs.get('batch_size', FETCH_BATCH_SIZE)
+
+        def on_headers(msgs):
+            msgs = [msg for msg in msgs if matches(msg)]
+            if fetch_spec == FETCH_HEADERS_ONLY:
+                if on_message is None:
+                    return msgs
+                for msg in msgs:
+                    on_message(msg)
+                return
+            return self._fetch_emails_by_uids(
+                [msg.uid for msg in msgs], fetch_spec, batch_size, on_message)
+
+        return _then(
+            self.search(query=query, fetch_spec=FETCH_HEADERS_ONLY, **kwargs),
+            on_headers)
+
+    def fetch_email_by_uid(self, uid, fetch_spec=FETCH_RFC822):
+        """Returns a Future of a MessageWrapper."""
+        def on_fetched(msgs):
+            if not msgs:
+                raise Error('Message %s not found' % uid)
+            return msgs[0]
+        return _then(self._fetch_batch([uid], fetch_spec), on_fetched)
+
+    def _fetch_emails_by_uids(self, uids, fetch_spec, batch_size, on_message):
+        """Fetch emails batch by batch, returns a Future."""
+        future = Future()
+        result = []
+        batches = [
+            uids[start:start + batch_size]
+            for start in xrange(0, len(uids), batch_size)]
+
+        def fetch_next(done=None):
+            if done is not None:
+                if done.exception() is not None:
+                    future.set_exception(done.exception())
+                    return
+                for msg in done.result():
+                    if on_message is None:
+                        result.append(msg)
+                    else:
+                        on_message(msg)
+            if not batches:
+                future.set_result(None if on_message else result)
+                return
+            self._fetch_batch(batches.pop(0), fetch_spec).add_done_callback(
+                fetch_next)
+
+        fetch_next()
+        return future
+
+    def _fetch_batch(self, uids, fetch_spec, by_uid=None):
+        """Fetch emails with one command, returns a Future of a list."""
+        if by_uid is None:
+            by_uid = self.use_uid
+        fetch_spec = betterimap._add_fetch_items(
+            fetch_spec, self._extra_fetch_items())
+        args = ('FETCH', betterimap._compress_uids(uids), fetch_spec)
+        if by_uid:
+            args = ('UID',) + args
+        return _then(
+            self._command(*args, response='FETCH'),
+            lambda data: self._messages_from_fetch(
+                uids, betterimap._parse_fetch_response(data), by_uid))
+
+    def idle(self, on_message, fetch_spec=FETCH_HEADERS_ONLY):
+        """Wait for new messages in the selected folder with IDLE.
+
+        on_message is called with each new MessageWrapper. Returns a function
+        to stop idling, which returns a Future done when IDLE is finished.
+        """
+        if not self.selected_folder:
+            raise ProgrammingError('You should select a folder before idling')
+        if self._idle:
+            raise ProgrammingError('Already idling')
+        self._idle = dict(
+            on_message=on_message, fetch_spec=fetch_spec, stopped=None,
+            done_sent=False, timer=None, total=self.total)
+        self._start_idle()
+
+        def stop():
+            state = self._idle
+            if not state:
+                future = Future()
+                future.set_result(None)
+                return future
+            state['stopped'] = Future()
+            self._send_done()
+            return state['stopped']
+
+        return stop
+
+    def _start_idle(self):
+        state = self._idle
+        if state['stopped']:
+            self._idle = None
+            state['stopped'].set_result(None)
+            return
+        if self.total > state['total']:
+            # Messages came while new ones were being fetched.
+            self._fetch_new()
+            return
+        state['done_sent'] = False
+        state['timer'] = self.loop.call_later(IDLE_TIMEOUT, self._send_done)
+        self._command(
+            'IDLE', continuation=lambda _: None
+        ).add_done_callback(self._on_idle_done)
+
+    def _send_done(self):
+        state = self._idle
+        if not state or state['done_sent']:
+            return
+        state['done_sent'] = True
+        self.loop.cancel(state['timer'])
+        self.protocol.send('DONE\r\n')
+        self._flush()
+
+    def _on_untagged(self, typ, data):
+        state = self._idle
+        if not state or typ not in ('EXISTS', 'EXPUNGE'):
+            return
+        self.protocol.pop_untagged(typ)
+        if typ == 'EXPUNGE':
+            for number in data:
+                # Only messages up to state['total'] were fetched already.
+                if int(number) <= state['total']:
+                    state['total'] -= 1
+                self.total -= 1
+            return
+        self.total = int(data[-1])
+        if self.total > state['total']:
+            self._send_done()
+
+    def _on_idle_done(self, done):
+        state = self._idle
+        if not state:
+            # The connection was closed.
+            return
+        if done.exception() is not None:
+            # IDLE was rejected. Closing the connection lets the owner see
+            # it in self.closed and reconnect, instead of waiting forever.
+            log.warning('IDLE failed on %s: %s', self.host, done.exception())
+            self._fail(done.exception())
+            return
+        self._fetch_new()
+
+    def _fetch_new(self):
+        """Fetch messages that came since the last check, then IDLE again."""
+        state = self._idle
+        new = range(state['total'] + 1, self.total + 1)
+        state['total'] = self.total
+
+        def on_fetched(done):
+            if done.exception() is not None:
+                log.error('Error fetching new messages: %s', done.exception())
+            else:
+                for msg in done.result():
+                    state['on_message'](msg)
+            if self._idle is state:
+                self._start_idle()
+
+        if not new:
+            self._start_idle()
+            return
+        # EXISTS reports sequence numbers, even in use_uid mode.
+        self._fetch_batch(
+            new, state['fetch_spec'], by_uid=False
+        ).add_done_callback(on_fetched)
+
+
+class AsyncGmail(betterimap._GmailMixin, AsyncIMAPAdapter):
+    """A Gmail counterpart of AsyncIMAPAdapter, supports XOAUTH2.
+
+    Refreshing an access token is a blocking HTTP request.
+    """
+
+    host = 'imap.gmail.com'
+    ssl = True
+
+    def _authenticate(self):
+        if not self._use_oauth2(self.password):
+            return super(AsyncGmail, self)._authenticate()
+        return self._auth_token(self.access_token, self.refresh_token)
+
+    def _auth_token(self, access_token, refresh_token):
+        access_token, refresh_token = self._next_access_token(
+            self.login, access_token, refresh_token)
+        auth_string = base64.b64encode(
+            self._generate_oauth_string(self.login, access_token))
+        replies = iter([auth_string])
+        result = Future()
+
+        def on_done(done):
+            if done.exception() is None:
+                self.access_token = access_token
+                result.set_result(None)
+                return
+            try:
+                next_try = self._auth_token(None, refresh_token)
+            except Exception as e:
+                result.set_exception(e)
+                return
+            next_try.add_done_callback(
+                lambda done: result.set_exception(done.exception())
+                if done.exception() else result.set_result(None))
+
+        # On error the server sends a continuation request with details,
+        # which is answered with an empty line.
+        self._command(
+            'AUTHENTICATE', 'XOAUTH2',
+            continuation=lambda _: next(replies, ''),
+        ).add_done_callback(on_done)
+        return result
+
+
+def _async_copy(adapter, loop):
+    """Make an AsyncIMAPAdapter with the settings of an IMAPAdapter."""
+    args, kwargs = adapter._copy_args()
+    for name in ('cache', 'compress', 'stream_messages'):
+        kwargs.pop(name, None)
+    cls = AsyncGmail if isinstance(adapter, betterimap.Gmail) else (
+        AsyncIMAPAdapter)
+    return cls(*args, loop=loop, **kwargs)
+
+
+class IdleMultiplexer(object):
+    """Waits for new messages in many folders with IDLE, in one thread.
+
+    IMAPAdapter.idle() runs a thread per folder. IdleMultiplexer instead
+    keeps an AsyncIMAPAdapter connection per watched folder, all driven by
+    one Loop. IDLE is restarted every IDLE_TIMEOUT, and failed connections
+    are reopened with an exponential backoff.
+
+    New messages are passed to the callback of their watch, or put into the
+    queue as (key, MessageWrapper) tuples. Methods are not thread-safe, call
+    them from the thread running the loop, or before run().
+
+    Example:
+
+        mux = IdleMultiplexer()
+        for account in accounts:
+            mux.add(AsyncIMAPAdapter(account.login, account.password,
+                                     host=account.host, ssl=True),
+                    'INBOX', key=account.id)
+        threading.Thread(target=mux.run).start()
+        while True:
+            account_id, msg = mux.queue.get()
+    """
+
+    def __init__(self, loop=None, queue=None):
+        """Create a multiplexer.
+
+        Args:
+            loop: the Loop to run in, a new one by default.
+            queue: where to put new messages, a new Queue.Queue by default.
+        """
+        self.loop = loop or Loop()
+        self.queue = queue if queue is not None else Queue.Queue()
+        self._watches = {}
+
+    def __len__(self):
+        return len(self._watches)
+
+    def add(
+        self, adapter, folder='INBOX', callback=None,
+        fetch_spec=FETCH_HEADERS_ONLY, key=None
+    ):
+        """Start watching a folder, returns the key of the watch.
+
+        Args:
+            adapter: an AsyncIMAPAdapter or AsyncGmail, not connected yet. An
+              IMAPAdapter or Gmail may be passed instead, a new connection
+              with its settings is opened then.
+            folder: the folder to watch.
+            callback: if given, called with each new MessageWrapper instead of
+              putting it into the queue.
+            fetch_spec: what to fetch for new messages.
+            key: identifies the watch in the queue and in remove(),
+              (login, folder) by default.
+
+        Blocks while the host name is resolved, see AsyncIMAPAdapter.resolve().
+        """
+        if not isinstance(adapter, AsyncIMAPAdapter):
+            adapter = _async_copy(adapter, self.loop)
+        elif adapter.sock is not None:
+            raise ProgrammingError('The adapter should not be connected yet')
+        else:
+            adapter.loop = self.loop
+        if isinstance(folder, IMAPFolder):
+            folder = folder.name
+        if key is None:
+            key = (adapter.login, folder)
+        if key in self._watches:
+            raise ProgrammingError('Already watching %r' % (key, ))
+        # Resolving blocks, so it is done here once, not in the loop on
+        # every reconnect.
+        adapter.resolve()
+        watch = dict(
+            adapter=adapter, folder=folder, callback=callback,
+            fetch_spec=fetch_spec, stop=None, timer=None, failures=0)
+        self._watches[key] = watch
+        self._connect(key, watch)
+        return key
+
+    def remove(self, key):
+        """Stop watching, returns a Future done when logged out."""
+        watch = self._watches.pop(key)
+        self.loop.cancel(watch['timer'])
+        adapter = watch['adapter']
+        if watch['stop'] is None:
+            # Connecting, or waiting to reconnect.
+            adapter.close()
+            future = Future()
+            future.set_result(None)
+            return future
+        return _then(watch['stop'](), lambda _: adapter.logout())
+
+    def run(self):
+        """Run the loop until close() is called."""
+        self.loop.run()
+
+    def close(self):
+        """Close all connections without logging out, and stop run()."""
+        for key in self._watches.keys():
+            watch = self._watches.pop(key)
+            self.loop.cancel(watch['timer'])
+            watch['adapter'].close()
+        self.loop.stop()
+
+    def _connect(self, key, watch):
+        watch['timer'] = None
+        adapter = watch['adapter']
+        try:
+            started = _then(
+                adapter.connect(), lambda _: adapter.select(watch['folder']))
+        except socket.error as e:
+            log.warning(
+                'Cannot connect to %s for %r: %s', adapter.host, key, e)
+            adapter.close()
+            self._reconnect_later(key, watch)
+            return
+
+        def on_started(done):
+            if self._watches.get(key) is not watch:
+                return
+            if done.exception() is not None:
+                log.warning('Cannot start IDLE for %r: %s',
+                            key, done.exception())
+                adapter.close()
+                self._reconnect_later(key, watch)
+                return
+            watch['failures'] = 0
+            watch['stop'] = adapter.idle(
+                lambda msg: self._deliver(key, watch, msg),
+                watch['fetch_spec'])
+            adapter.closed.add_done_callback(
+                lambda done: self._on_closed(key, watch, done.result()))
+
+        started.add_done_callback(on_started)
+
+    def _on_closed(self, key, watch, reason):
+        if self._watches.get(key) is not watch:
+            return
+        log.warning('IDLE connection for %r closed: %s', key, reason)
+        watch['stop'] = None
+        self._reconnect_later(key, watch)
+
+    def _reconnect_later(self, key, watch):
+        delay = min(
+            RECONNECT_DELAY * 2 ** watch['failures'], RECONNECT_MAX_DELAY)
+        watch['failures'] += 1
+        log.info('Reconnecting %r in %s seconds', key, delay)
+        watch['timer'] = self.loop.call_later(delay, self._connect, key, watch)
+
+    def _deliver(self, key, watch, msg):
+        try:
+            if watch['callback'] is not None:
+                watch['callback'](msg)
+            else:
+                self.queue.put((key, msg))
+        except Exception:
+            log.exception('Error delivering a new message for %r', key)
@@ -0,0 +1,107 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import betterimap
+from betterimap import cache
+
+from tests.imap_adapter_test import IMAPAdapterStub
+
+
+class MessageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = cache.MessageCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testPutAndGet(self):
+        items = {
+            'UID': '5', 'RFC822': 'Subject: \xff\r\n', 'FLAGS': ['\\Seen']}
+        self.cache.put('a@host', u'Входящие', 42, '5', '(RFC822)', items)
+
+        self.assertEqual(
+            self.cache.get('a@host', u'Входящие', 42, '5', '(RFC822)'), items)
+        self.assertIsNone(
+            self.cache.get('a@host', u'Входящие', 42, '5', '(UID RFC822)'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_rate, 0.5)
+
+    def testLeastRecentlyUsedEntriesAreEvicted(self):
+        self.cache.max_size = 150
+        for uid in '123':
+            self.cache.put('a', 'INBOX', 1, uid, 'x', {'RFC822': 'a' * 30})
+        self.cache.get('a', 'INBOX', 1, '1', 'x')
+        self.cache.put('a', 'INBOX', 1, '4', 'x', {'RFC822': 'a' * 30})
+
+        self.assertIsNone(self.cache.get('a', 'INBOX', 1, '2', 'x'))
+        self.assertIsNotNone(self.cache.get('a', 'INBOX', 1, '1', 'x'))
+        self.assertLessEqual(self.cache.size, 150)
+        # A new cache over the same directory sees the same entries.
+        self.assertEqual(
+            cache.MessageCache(self.path).size, self.cache.size)
+
+    def testCorruptEntriesAreRemovedAndCountedAsMisses(self):
+        self.cache.put('a', 'INBOX', 1, '1', 'x', {'RFC822': 'a'})
+        path = self.cache._entry_path('a', 'INBOX', 1, '1', 'x')
+        with open(path, 'wb') as f:
+            f.write('["RFC822", {"UI')
+
+        self.assertIsNone(self.cache.get('a', 'INBOX', 1, '1', 'x'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(self.cache.size, 0)
+
+    def testLeftoverTemporaryFilesAreRemoved(self):
+        self.cache.put('a', 'INBOX', 1, '1', 'x', {'RFC822': 'a'})
+        directory = os.path.dirname(
+            self.cache._entry_path('a', 'INBOX', 1, '1', 'x'))
+        tmp_path = os.path.join(directory, 'partial.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write('["RFC822"')
+
+        size = cache.MessageCache(self.path).size
+
+        self.assertEqual(size, self.cache.size)
+        self.assertFalse(os.path.exists(tmp_path))
+
+    def testSetUidValidityRemovesOtherUidValidities(self):
+        self.cache.put('a', 'INBOX', 1, '1', 'x', {'RFC822': 'a'})
+        self.cache.put('a', 'INBOX', 2, '1', 'x', {'RFC822': 'b'})
+
+        self.cache.set_uidvalidity('a', 'INBOX', 2)
+
+        self.assertIsNone(self.cache.get('a', 'INBOX', 1, '1', 'x'))
+        self.assertIsNotNone(self.cache.get('a', 'INBOX', 2, '1', 'x'))
+
+    def testAdapterReadsCachedMessagesWithoutFetching(self):
+        imap = IMAPAdapterStub()
+        imap.cache = self.cache
+        imap.use_uid = True
+        imap.mail = mock.Mock()
+        imap.mail.select.return_value = ('OK', ['2'])
+        imap.mail.response.side_effect = lambda code: (
+            code, ['42'] if code == 'UIDVALIDITY' else [None])
+        imap.mail.uid.return_value = ('OK', [
+            ('1 (UID 10 RFC822 {12}', 'Subject: a\r\n'), ')',
+            ('2 (UID 11 RFC822 {12}', 'Subject: b\r\n'), ')',
+        ])
+        imap.select('INBOX')
+
+        imap.fetch_email_by_uid('10')
+        msgs = imap._fetch_batch(['11', '10'], betterimap.FETCH_RFC822)
+
+        self.assertEqual([m.subject for m in msgs], [u'b', u'a'])
+        self.assertEqual([m.key for m in msgs], [
+            ('INBOX', 42, '11'), ('INBOX', 42, '10')])
+        self.assertEqual(imap.mail.uid.call_args_list, [
+            mock.call('FETCH', '10', '(UID RFC822)'),
+            mock.call('FETCH', '11', '(UID RFC822)'),
+        ])
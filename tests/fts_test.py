@@ -0,0 +1,92 @@
+# coding: utf-8
+
+import email
+import unittest
+
+import mock
+
+import betterimap
+from betterimap import fts
+
+PLAIN = '''Subject: =?UTF-8?B?0J7RgtGH0ZHRgg==?=
+From: Igor <igor@example.com>
+To: Galina <galina@example.com>
+Content-Type: text/plain; charset=utf-8
+
+квартальный budget
+'''
+
+HTML = '''Subject: Newsletter
+From: news@example.com
+Content-Type: text/html
+
+<html><style>p {color: red}</style><p>Quarterly&nbsp;budget</p></html>
+'''
+
+
+def make_message(content, uid):
+    msg = betterimap.MessageWrapper(email.message_from_string(content))
+    msg.folder = 'INBOX'
+    msg.uidvalidity = 42
+    msg.uid = str(uid)
+    return msg
+
+
+class FullTextIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = fts.FullTextIndex()
+        self.addCleanup(self.index.close)
+
+    def testSearch(self):
+        self.index.add(make_message(PLAIN, 1))
+        self.index.add(make_message(HTML, 2))
+
+        self.assertEqual(
+            sorted(self.index.search('budget')),
+            [('INBOX', '1'), ('INBOX', '2')])
+        self.assertEqual(self.index.search(u'ОТЧЁТ'), [('INBOX', '1')])
+        self.assertEqual(self.index.search(u'квартальный'), [('INBOX', '1')])
+        self.assertEqual(self.index.search('galina budget'), [('INBOX', '1')])
+        self.assertEqual(self.index.search('red'), [])
+        self.assertEqual(
+            self.index.search('sender:news', raw=True), [('INBOX', '2')])
+        self.assertEqual(self.index.search('budget', folder='Sent'), [])
+
+    def testAddReplacesAndRemoveDeletes(self):
+        self.index.add(make_message(PLAIN, 1))
+        self.index.add(make_message(HTML, 1))
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.search('newsletter'), [('INBOX', '1')])
+
+        self.index.remove('INBOX', ['1'])
+        self.assertEqual(self.index.search('newsletter'), [])
+
+    def testUpdateIndexesOnlyNewMessages(self):
+        adapter = mock.Mock(spec=betterimap.IMAPAdapter)
+        adapter.uidvalidity = 42
+        adapter._search_ids.return_value = ['1', '2']
+        adapter._fetch_batch.side_effect = lambda uids, *args, **kwargs: [
+            make_message(PLAIN if uid == 1 else HTML, uid) for uid in uids]
+
+        self.assertEqual(self.index.update(adapter, 'INBOX'), 2)
+        adapter._search_ids.return_value = ['2']
+        self.assertEqual(self.index.update(adapter, 'INBOX'), 0)
+
+        adapter._search_ids.assert_called_with('UID 3:*', by_uid=True)
+        self.assertEqual(len(self.index), 2)
+
+        adapter.uidvalidity = 43
+        adapter._search_ids.return_value = ['1']
+        self.assertEqual(self.index.update(adapter, 'INBOX'), 1)
+        self.assertEqual(len(self.index), 1)
+
+    def testUpdateWithoutUidValidityRaisesError(self):
+        adapter = mock.Mock(spec=betterimap.IMAPAdapter)
+        adapter.uidvalidity = None
+        adapter.selected_folder = None
+
+        self.assertRaises(
+            betterimap.ProgrammingError, self.index.update, adapter)
+        self.assertRaises(betterimap.Error, self.index.update, adapter, 'INBOX')
+        self.assertFalse(adapter._fetch_batch.called)
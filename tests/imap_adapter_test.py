@@ -1,7 +1,15 @@
 # coding: utf-8
 
+import email
+import email.message
+import imaplib
 import logging
+import socket
+import StringIO
+import threading
+import time
 import unittest
+import zlib
 
 import betterimap
 
@@ -19,6 +27,15 @@ class IMAPAdapterStub(betterimap.IMAPAdapter):
         super(IMAPAdapterStub, self).__init__('user', 'password', host='host')
 
 
+class GmailStub(betterimap.Gmail):
+    """A fake Gmail adapter."""
+    imap_cls = mock.Mock()
+    imap_cls_ssl = mock.Mock()
+
+    def __init__(self, **kwargs):
+        super(GmailStub, self).__init__('user', 'password', **kwargs)
+
+
 # TODO(igor): write more tests here..
 class IMAPAdapterTest(unittest.TestCase):
 
@@ -44,4 +61,992 @@ class IMAPAdapterTest(unittest.TestCase):
             inbox = imap.get_inbox_folder()
         self.assertEqual(inbox, 'inbox')
 
+    def testSearchFetchesEmailsInBatches(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.search.return_value = ('OK', ['1 2 3 5'])
+        imap.mail.fetch.side_effect = [
+            ('OK', [
+                ('3 (RFC822 {12}', 'Subject: 3\r\n'), ')',
+                ('5 (RFC822 {12}', 'Subject: 5\r\n'), ')',
+            ]),
+            ('OK', [
+                ('1 (RFC822 {12}', 'Subject: 1\r\n'), ')',
+                ('2 (RFC822 {12}', 'Subject: 2\r\n'), ')',
+            ]),
+        ]
+
+        msgs = list(imap.search(batch_size=2))
+
+        self.assertEqual([m.uid for m in msgs], ['5', '3', '2', '1'])
+        self.assertEqual([m.subject for m in msgs], [u'5', u'3', u'2', u'1'])
+        self.assertEqual(imap.mail.fetch.call_args_list, [
+            mock.call('3,5', betterimap.FETCH_RFC822),
+            mock.call('1:2', betterimap.FETCH_RFC822),
+        ])
+
+    def testSearchFetchesOnlyLimitEmails(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.search.return_value = ('OK', ['1 2 3'])
+        imap.mail.fetch.return_value = ('OK', [
+            ('2 (RFC822 {12}', 'Subject: 2\r\n'), ')',
+            ('3 (RFC822 {12}', 'Subject: 3\r\n'), ')',
+        ])
+
+        msgs = list(imap.search(limit=2))
+
+        self.assertEqual([m.uid for m in msgs], ['3', '2'])
+        imap.mail.fetch.assert_called_once_with('2:3', betterimap.FETCH_RFC822)
+
+    def testSelectRecordsUidValidityAndUidNext(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.select.return_value = ('OK', ['3'])
+        imap.mail.response.side_effect = lambda code: {
+            'UIDVALIDITY': ('UIDVALIDITY', ['1234']),
+            'UIDNEXT': ('UIDNEXT', ['42']),
+        }[code]
+
+        self.assertEqual(imap.select('INBOX'), 3)
+
+        self.assertEqual(imap.uidvalidity, 1234)
+        self.assertEqual(imap.uidnext, 42)
+
+    def testSearchWithUseUidUsesUidCommandsAndSetsKeys(self):
+        imap = IMAPAdapterStub()
+        imap.use_uid = True
+        imap.selected_folder = 'INBOX'
+        imap.uidvalidity = 1234
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.uid.side_effect = [
+            ('OK', ['10 12']),
+            ('OK', [
+                ('1 (UID 10 RFC822 {12}', 'Subject: 1\r\n'), ')',
+                ('2 (RFC822 {12}', 'Subject: 2\r\n'), ' UID 12)',
+            ]),
+        ]
+
+        msgs = list(imap.search())
+
+        self.assertEqual(
+            [m.key for m in msgs],
+            [('INBOX', 1234, '12'), ('INBOX', 1234, '10')])
+        self.assertEqual(imap.mail.uid.call_args_list, [
+            mock.call('SEARCH', 'CHARSET', 'utf-8', 'ALL'),
+            mock.call('FETCH', '10,12', '(UID RFC822)'),
+        ])
+        self.assertFalse(imap.mail.fetch.called)
+
+    def testEasySearchFetchesFilteredMessagesInOneBatch(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.search.return_value = ('OK', ['1 2 3'])
+        headers = betterimap.FETCH_HEADERS_ONLY[1:-1]
+        imap.mail.fetch.side_effect = [
+            ('OK', [
+                ('1 (%s {16}' % headers, 'Subject: foo 1\r\n'), ')',
+                ('2 (%s {16}' % headers, 'Subject: bar 2\r\n'), ')',
+                ('3 (%s {16}' % headers, 'Subject: foo 3\r\n'), ')',
+            ]),
+            ('OK', [
+                ('1 (RFC822 {22}', 'Subject: foo 1\r\n\r\nbody'), ')',
+                ('3 (RFC822 {22}', 'Subject: foo 3\r\n\r\nbody'), ')',
+            ]),
+        ]
+
+        msgs = list(imap.easy_search(subject=u'foo'))
+
+        self.assertEqual([m.uid for m in msgs], ['3', '1'])
+        self.assertEqual([m.get_payload() for m in msgs], ['body', 'body'])
+        self.assertEqual(imap.mail.fetch.call_args_list, [
+            mock.call('1:3', betterimap.FETCH_HEADERS_ONLY),
+            mock.call('1,3', betterimap.FETCH_RFC822),
+        ])
+
+    def testShardedSearchFetchesBatchesOverCopiesInOrder(self):
+        imap = IMAPAdapterStub()
+        imap.selected_folder = 'INBOX'
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.uid.return_value = ('OK', [' '.join(map(str, range(1, 8)))])
+        copies = []
+
+        def copy():
+            conn = mock.Mock()
+            conn._fetch_batch.side_effect = lambda batch, spec: list(batch)
+            copies.append(conn)
+            return conn
+
+        with mock.patch.object(imap, 'copy', copy):
+            uids = list(imap.sharded_search(connections=2, batch_size=2))
+
+        self.assertEqual(uids, ['7', '6', '5', '4', '3', '2', '1'])
+        imap.mail.uid.assert_called_once_with(
+            'SEARCH', 'CHARSET', 'utf-8', 'ALL')
+        self.assertTrue(1 <= len(copies) <= 2)
+        for conn in copies:
+            self.assertTrue(conn.use_uid)
+            conn.logout.assert_called_once_with()
+
+    def testBodystructureAttachmentsAreFetchedOnFirstAccess(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.search.return_value = ('OK', ['7'])
+        imap.mail.fetch.side_effect = [
+            ('OK', [
+                ('7 (BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL '
+                 'NIL "7BIT" 5 1 NIL NIL NIL)("APPLICATION" "PDF" '
+                 '("NAME" "a.pdf") NIL NIL "BASE64" 1000 NIL '
+                 '("ATTACHMENT" ("FILENAME" "a.pdf")) NIL) "MIXED" '
+                 '("BOUNDARY" "x") NIL NIL) BODY[HEADER] {12}',
+                 'Subject: 7\r\n'), ')',
+            ]),
+            ('OK', [('7 (BODY[2] {8}', 'aGVsbG8=\r\n'), ')']),
+        ]
+
+        msg, = imap.search(fetch_spec=betterimap.FETCH_BODYSTRUCTURE)
+        text, attachment = msg.attachments()
+
+        self.assertEqual(msg.subject, u'7')
+        self.assertIsNone(text.filename)
+        self.assertEqual(attachment.filename, u'a.pdf')
+        self.assertEqual(attachment.content_type, 'application/pdf')
+        self.assertEqual(attachment.encoded_size, 1000)
+        self.assertEqual(imap.mail.fetch.call_count, 1)
+
+        self.assertEqual(attachment.data, 'hello')
+        self.assertEqual(attachment.data, 'hello')
+        self.assertEqual(len(attachment), 5)
+        imap.mail.fetch.assert_called_with('7', '(BODY.PEEK[2])')
+        self.assertEqual(imap.mail.fetch.call_count, 2)
+
+    def testSaveToDownloadsAttachmentWithPartialFetches(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.fetch.side_effect = [
+            ('OK', [('7 (BODY[2]<0> {8}', 'aGVsbG8g'), ')']),
+            ('OK', [('7 (BODY[2]<8> {8}', 'd29y\r\nbG'), ')']),
+            ('OK', [('7 (BODY[2]<16> {2}', 'Q='), ')']),
+        ]
+        msg = betterimap.MessageWrapper(email.message.Message())
+        msg.uid = '7'
+        msg.adapter = imap
+        part = betterimap.BodyPart(
+            '2', 'application/pdf', encoding='base64', size=18)
+        fileobj = StringIO.StringIO()
+
+        written = betterimap.RemoteAttachment(msg, part).save_to(
+            fileobj, chunk_size=8)
+
+        self.assertEqual(fileobj.getvalue(), 'hello world')
+        self.assertEqual(written, 11)
+        self.assertEqual(imap.mail.fetch.call_args_list, [
+            mock.call('7', '(BODY.PEEK[2]<0.8>)'),
+            mock.call('7', '(BODY.PEEK[2]<8.8>)'),
+            mock.call('7', '(BODY.PEEK[2]<16.8>)'),
+        ])
+
+    def testSearchEnvelopes(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.search.return_value = ('OK', ['4'])
+        imap.mail.fetch.return_value = ('OK', [
+            '4 (RFC822.SIZE 2345 FLAGS (\\Seen) '
+            'INTERNALDATE "28-Sep-2014 07:07:13 +0000" '
+            'ENVELOPE ("Sun, 28 Sep 2014 00:07:13 -0700" '
+            '"=?UTF-8?B?0KLQtdGB0YI=?=" '
+            '(("=?UTF-8?B?0JjQs9C+0YDRjA==?=" NIL "igor" "example.com")) '
+            '(("Igor" NIL "igor" "example.com")) NIL '
+            '((NIL NIL "a" "example.com")("B" NIL "b" "example.com")) '
+            '((NIL NIL "undisclosed-recipients" NIL)(NIL NIL NIL NIL)) NIL '
+            '"<1@example.com>" "<2@example.com>"))',
+        ])
+
+        envelope, = imap.search_envelopes()
+
+        self.assertIsInstance(envelope, betterimap.Envelope)
+        self.assertEqual(envelope.uid, '4')
+        self.assertEqual(envelope.subject, u'Тест')
+        self.assertEqual(
+            envelope.from_addr, (u'Игорь', u'igor@example.com'))
+        self.assertEqual(
+            envelope.to,
+            [(u'', u'a@example.com'), (u'B', u'b@example.com')])
+        self.assertEqual(envelope.cc, [])
+        self.assertIsNone(envelope.reply_to)
+        self.assertEqual(envelope.in_reply_to, '<1@example.com>')
+        self.assertEqual(envelope.message_id, '<2@example.com>')
+        self.assertEqual(envelope.size, 2345)
+        self.assertEqual(envelope.flags, ['\\Seen'])
+        self.assertEqual(envelope.date, envelope.internaldate)
+        imap.mail.fetch.assert_called_once_with('4', betterimap.FETCH_ENVELOPE)
+
+    @mock.patch('betterimap._imap4_readable')
+    def testIdleFetchesNewMessagesWithOneFetch(self, readable):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.total = 5
+        # IDLE is only announced after login.
+        imap.mail.capabilities = ('IMAP4REV1', )
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1 IDLE'])
+        imap.mail._new_tag.return_value = 'A1'
+        lines = [
+            '+ idling\r\n',
+            '* 3 EXPUNGE\r\n',
+            '* 6 EXISTS\r\n',
+            '* 2 FETCH (FLAGS (\\Seen))\r\n',
+            '* 8 EXISTS\r\n',
+            'A1 OK IDLE terminated\r\n',
+        ]
+        imap.mail.readline.side_effect = lambda: lines.pop(0)
+        # Lines until DONE arrive during IDLE, then nothing does.
+        readable.side_effect = lambda mail, timeout: len(lines) > 1
+
+        def fetch(*args):
+            imap.idling = False
+            data = []
+            for i in xrange(5, 9):
+                data += [
+                    ('%d (BODY[HEADER] {24}' % i,
+                     'Subject: message %d\r\n\r\n' % i),
+                    ')']
+            return ('OK', data)
+        imap.mail.fetch.side_effect = fetch
+        messages = []
+
+        imap._idle(
+            betterimap.FETCH_HEADERS_ONLY, mock.Mock(put=messages.append),
+            debounce=0.01)
+
+        imap.mail.fetch.assert_called_once_with(
+            '5:8', betterimap.FETCH_HEADERS_ONLY)
+        self.assertEqual(
+            [msg.subject for msg in messages],
+            ['message %d' % i for i in xrange(5, 9)])
+        self.assertEqual(
+            imap.mail.send.call_args_list,
+            [mock.call('A1 IDLE\r\n'), mock.call('DONE\r\n')])
+        self.assertEqual(imap.total, 8)
+
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    def testIdlePollsWithNoopIfIdleIsNotSupported(self, sleep, time):
+        clock = [1000.0]
+        time.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds)
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.selected_folder = 'INBOX'
+        imap.total = 5
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.noop.return_value = ('OK', [None])
+        # Poll 1: nothing new, poll 2: message 3 expunged and 2 new ones.
+        responses = [
+            ('EXPUNGE', None), ('EXISTS', ['5']), ('EXPUNGE', None),
+            ('EXPUNGE', None), ('EXISTS', ['6']), ('EXPUNGE', ['3']),
+        ]
+        imap.mail.response.side_effect = lambda code: responses.pop(0)
+
+        def fetch(*args):
+            imap.idling = False
+            return ('OK', [
+                ('5 (BODY[HEADER] {14}', 'Subject: 5\r\n\r\n'), ')',
+                ('6 (BODY[HEADER] {14}', 'Subject: 6\r\n\r\n'), ')'])
+        imap.mail.fetch.side_effect = fetch
+        messages = []
+        stats = betterimap.IdleStats()
+
+        imap._idle(
+            betterimap.FETCH_HEADERS_ONLY, mock.Mock(put=messages.append),
+            stats=stats)
+
+        imap.mail.fetch.assert_called_once_with(
+            '5:6', betterimap.FETCH_HEADERS_ONLY)
+        self.assertEqual([msg.subject for msg in messages], ['5', '6'])
+        # The second poll waited longer, as the first one found nothing.
+        self.assertEqual(
+            sum(call[0][0] for call in sleep.call_args_list),
+            betterimap.POLL_MIN_INTERVAL * (1 + betterimap.POLL_BACKOFF))
+        self.assertEqual(stats.polls, 2)
+        self.assertEqual(stats.messages, 2)
+        self.assertEqual(
+            stats.mean_latency,
+            betterimap.POLL_MIN_INTERVAL * betterimap.POLL_BACKOFF)
+
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    def testPollWithOnlyExpungeDoesNotFetch(self, sleep, time):
+        clock = [1000.0]
+        time.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds)
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.selected_folder = 'INBOX'
+        imap.total = 5
+        imap.mail.noop.return_value = ('OK', [None])
+        responses = [('EXPUNGE', None), ('EXISTS', None), ('EXPUNGE', ['3'])]
+        imap.mail.response.side_effect = lambda code: responses.pop(0)
+        imap.idling = True
+
+        result = imap._poll_until_new(5, 1, betterimap.IdleStats())
+
+        self.assertEqual(result[:2], (4, 4))
+        self.assertEqual(imap.total, 4)
+
+    @mock.patch('betterimap._imap4_readable')
+    def testIdleYieldsEnvelopes(self, readable):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.selected_folder = 'INBOX'
+        imap.total = 1
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1 IDLE'])
+        imap.mail._new_tag.return_value = 'A1'
+        lines = ['+ idling\r\n', '* 2 EXISTS\r\n', 'A1 OK done\r\n']
+        imap.mail.readline.side_effect = lambda: lines.pop(0)
+        readable.side_effect = lambda mail, timeout: len(lines) > 1
+        imap.mail.fetch.return_value = ('OK', [
+            '2 (RFC822.SIZE 10 FLAGS () '
+            'INTERNALDATE "01-Jan-2014 00:00:00 +0000" '
+            'ENVELOPE ("01-Jan-2014" "new" NIL NIL NIL NIL NIL NIL NIL '
+            '"<2@example.com>"))'])
+        imap.copy = lambda: imap
+
+        stop, messages = imap.idle(
+            fetch_spec=betterimap.FETCH_ENVELOPE, debounce=0.01)
+        envelope = next(messages)
+        stop()
+
+        self.assertIsInstance(envelope, betterimap.Envelope)
+        self.assertEqual(envelope.subject, u'new')
+
+    @mock.patch('betterimap._imap4_readable')
+    def testIdlePassesFetchErrorsToTheConsumer(self, readable):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock()
+        imap.selected_folder = 'INBOX'
+        imap.total = 1
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1 IDLE'])
+        imap.mail._new_tag.return_value = 'A1'
+        lines = ['+ idling\r\n', '* 2 EXISTS\r\n', 'A1 OK done\r\n']
+        imap.mail.readline.side_effect = lambda: lines.pop(0)
+        readable.side_effect = lambda mail, timeout: len(lines) > 1
+        imap.mail.fetch.return_value = ('NO', ['No such message'])
+        imap.copy = lambda: imap
+
+        stop, messages = imap.idle(copy=True, debounce=0.01)
+
+        self.assertRaises(betterimap.Error, list, messages)
+        self.assertFalse(imap.idling)
+
+
+def socket_pair():
+    """Connect a client socket like imaplib does, return (server, client)."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return server, client
+
+
+class BulkOperationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.imap = IMAPAdapterStub()
+        self.imap.mail = mock.Mock()
+        self.imap.use_uid = True
+        self.imap.total = 10
+        self.imap.mail.uid.return_value = ('OK', [None])
+        self.imap.mail.expunge.return_value = ('OK', ['3', '3'])
+        self.expunged = []
+        self.imap.mail.response.side_effect = lambda code: (
+            code, self.expunged.pop(0) if self.expunged else None)
+
+    def setCapabilities(self, capabilities):
+        self.imap.mail.capability.return_value = ('OK', [capabilities])
+
+    def testDeleteUsesUidExpungeWithUidplus(self):
+        self.setCapabilities('IMAP4rev1 UIDPLUS')
+        self.expunged = [None, ['3', '3', '3']]
+
+        self.imap.delete(['5', '3', '4', '9'])
+
+        self.assertEqual(self.imap.mail.uid.call_args_list, [
+            mock.call('STORE', '3:5,9', '+FLAGS.SILENT', '(\\Deleted)'),
+            mock.call('EXPUNGE', '3:5,9'),
+        ])
+        self.assertFalse(self.imap.mail.expunge.called)
+        self.assertEqual(self.imap.total, 7)
+
+    def testMoveSplitsLongMessageSetsAndMovesTheLastFirst(self):
+        self.setCapabilities('IMAP4rev1 MOVE')
+        uids = range(2, 4000, 2)
+
+        self.imap.move_to(uids, u'Архив')
+
+        calls = self.imap.mail.uid.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            [call[0][0] for call in calls], ['MOVE', 'MOVE'])
+        second, first = [call[0][1] for call in calls]
+        self.assertTrue(first.startswith('2,4,'))
+        self.assertLessEqual(len(first), betterimap.MESSAGE_SET_MAX_LENGTH)
+        self.assertEqual(
+            map(int, (first + ',' + second).split(',')), uids)
+        self.assertEqual(calls[0][0][2], '&BBAEQARFBDgEMg-')
+
+    def testMoveFallsBackToCopyAndFlagsWithoutExpunge(self):
+        self.setCapabilities('IMAP4rev1')
+
+        self.imap.move_to(['1', '2'], 'Archive')
+
+        self.assertEqual(self.imap.mail.uid.call_args_list, [
+            mock.call('COPY', '1:2', 'Archive'),
+            mock.call('STORE', '1:2', '+FLAGS.SILENT', '(\\Deleted)'),
+        ])
+        # EXPUNGE would remove other \Deleted messages of the folder too.
+        self.assertFalse(self.imap.mail.expunge.called)
+
+        self.imap.move_to(['1', '2'], 'Archive', expunge=True)
+
+        self.imap.mail.expunge.assert_called_once_with()
+        self.assertEqual(self.imap.total, 8)
+
+    def testMoveFallsBackToUidExpungeWithUidplus(self):
+        self.setCapabilities('IMAP4rev1 UIDPLUS')
+
+        self.imap.move_to(['1', '2'], 'Archive')
+
+        self.assertEqual(self.imap.mail.uid.call_args_list, [
+            mock.call('COPY', '1:2', 'Archive'),
+            mock.call('STORE', '1:2', '+FLAGS.SILENT', '(\\Deleted)'),
+            mock.call('EXPUNGE', '1:2'),
+        ])
+        self.assertFalse(self.imap.mail.expunge.called)
+
+    def testSetFlagsBySequenceNumbers(self):
+        self.imap.mail._simple_command.return_value = ('OK', [None])
+
+        self.imap.set_flags([1, 2, 3], ['\\Seen', '\\Flagged'], by_uid=False)
+        self.imap.clear_flags([7], ['\\Seen'], by_uid=False)
+
+        self.assertEqual(self.imap.mail._simple_command.call_args_list, [
+            mock.call('STORE', '1:3', '+FLAGS.SILENT', '(\\Seen \\Flagged)'),
+            mock.call('STORE', '7', '-FLAGS.SILENT', '(\\Seen)'),
+        ])
+
+    def testFailedCommandRaisesError(self):
+        self.imap.mail.uid.return_value = ('NO', ['Over quota'])
+        self.assertRaises(
+            betterimap.Error, self.imap.copy_to, ['1'], 'Archive')
+
+
+class SortAndThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.imap = IMAPAdapterStub()
+        self.imap.mail = mock.Mock()
+        self.imap.use_uid = True
+
+    def setCapabilities(self, capabilities):
+        self.imap.mail.capability.return_value = ('OK', [capabilities])
+
+    def envelope(self, uid, date, subject, sender):
+        return (
+            '%s (UID %s RFC822.SIZE 10 FLAGS () '
+            'INTERNALDATE "01-Jan-2014 00:00:00 +0000" '
+            'ENVELOPE ("%s" "%s" ((NIL NIL "%s" "example.com")) '
+            'NIL NIL NIL NIL NIL NIL "<%s@example.com>"))' % (
+                uid, uid, date, subject, sender, uid))
+
+    def testSearchSortsWithSort(self):
+        self.setCapabilities('IMAP4rev1 SORT')
+        self.imap.mail.uid.side_effect = [
+            ('OK', ['7 3']),
+            ('OK', [('7 (UID 7 RFC822 {11}', 'Subject: 7\r\n'), ')']),
+        ]
+
+        msgs = list(self.imap.search(
+            '(FROM "igor")', sort='REVERSE DATE', limit=1))
+
+        self.assertEqual(self.imap.mail.uid.call_args_list, [
+            mock.call('SORT', '(REVERSE DATE)', 'UTF-8', '(FROM "igor")'),
+            mock.call('FETCH', '7', '(UID RFC822)'),
+        ])
+        self.assertEqual([msg.subject for msg in msgs], [u'7'])
+
+    def testSortIdsFallsBackToEnvelopes(self):
+        self.setCapabilities('IMAP4rev1')
+        self.imap.mail.uid.side_effect = [
+            ('OK', ['1 2 3 4']),
+            ('OK', [
+                self.envelope(1, 'Mon, 6 Jan 2014 10:00:00 +0000',
+                              'Re: [list] Report', 'bob'),
+                self.envelope(2, 'Sun, 5 Jan 2014 10:00:00 +0000',
+                              'Fwd: Agenda', 'Alice'),
+                self.envelope(3, 'Tue, 7 Jan 2014 10:00:00 +0000',
+                              'report (fwd)', 'alice'),
+                self.envelope(4, 'Mon, 6 Jan 2014 13:00:00 +0300',
+                              'agenda', 'carol'),
+            ]),
+        ]
+
+        by_subject = self.imap.sort_ids(['SUBJECT', 'REVERSE', 'DATE'])
+
+        self.assertEqual(by_subject, ['4', '2', '3', '1'])
+        self.assertEqual(
+            self.imap.mail.uid.call_args_list[1][0][:2], ('FETCH', '1:4'))
+
+    def testSortCriteriaAreChecked(self):
+        self.assertRaises(
+            betterimap.ProgrammingError, self.imap.sort_ids, 'REVERSE')
+        self.assertRaises(
+            betterimap.ProgrammingError, self.imap.sort_ids, 'DATE COLOR')
+
+    def testThreadUsesThread(self):
+        self.setCapabilities('IMAP4rev1 THREAD=REFERENCES')
+        self.imap.mail.uid.return_value = (
+            'OK', ['(2)(3 6 (4 23)(44 7 96))'])
+
+        threads = self.imap.thread()
+
+        self.imap.mail.uid.assert_called_once_with(
+            'THREAD', 'REFERENCES', 'UTF-8', 'ALL')
+        self.assertEqual(
+            threads, [['2'], ['3', '6', ['4', '23'], ['44', '7', '96']]])
+
+    def testThreadFallsBackToReferences(self):
+        self.setCapabilities('IMAP4rev1')
+        headers = {
+            1: 'Message-ID: <a>\r\nDate: Mon, 6 Jan 2014 10:00:00 +0000',
+            2: 'Message-ID: <b>\r\nIn-Reply-To: <a>\r\n'
+               'Date: Mon, 6 Jan 2014 12:00:00 +0000',
+            3: 'Message-ID: <c>\r\nReferences: <a> <missing>\r\n'
+               'Date: Mon, 6 Jan 2014 11:00:00 +0000',
+            4: 'Message-ID: <d>\r\nReferences: <a> <b>\r\n'
+               'Date: Mon, 6 Jan 2014 13:00:00 +0000',
+            5: 'Message-ID: <e>\r\nDate: Sun, 5 Jan 2014 10:00:00 +0000',
+        }
+        data = []
+        for uid, header in sorted(headers.items()):
+            header += '\r\n\r\n'
+            data += [(
+                '%d (UID %d BODY[HEADER.FIELDS (MESSAGE-ID IN-REPLY-TO '
+                'REFERENCES DATE)] {%d}' % (uid, uid, len(header)),
+                header), ')']
+        self.imap.mail.uid.side_effect = [('OK', ['1 2 3 4 5']), ('OK', data)]
+
+        threads = self.imap.thread()
+
+        # 3 refers to a missing message, so it is a reply to 1.
+        self.assertEqual(threads, [['5'], ['1', ['3'], ['2', '4']]])
+
+    def testBaseSubject(self):
+        self.assertEqual(
+            betterimap._base_subject(u'Re: Fwd[2]: [list]  Hello  (fwd)'),
+            u'hello')
+        self.assertEqual(betterimap._base_subject(u'[list]'), u'[list]')
+
+
+class ESearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.imap = IMAPAdapterStub()
+        self.imap.mail = mock.Mock()
+        self.imap.use_uid = True
+        self.esearch = []
+        # Each ESEARCH is preceded by popping stale responses.
+        self.imap.mail.response.side_effect = lambda code: (
+            code, self.esearch.pop(0) if self.esearch else None)
+
+    def setCapabilities(self, capabilities):
+        self.imap.mail.capability.return_value = ('OK', [capabilities])
+
+    def testMessageSetExpandsIdsOnDemand(self):
+        uids = betterimap.MessageSet('310:312,1:3,7')
+
+        self.assertEqual(len(uids), 7)
+        self.assertEqual(list(uids), ['1', '2', '3', '7', '310', '311', '312'])
+        self.assertEqual(uids[3], '7')
+        self.assertEqual(uids[-1], '312')
+        self.assertEqual(uids[2:5], ['3', '7', '310'])
+        self.assertIn('311', uids)
+        self.assertNotIn(5, uids)
+        self.assertEqual(str(uids), '1:3,7,310:312')
+
+        uids.reverse()
+
+        self.assertEqual(uids[:4], ['312', '311', '310', '7'])
+        self.assertEqual(list(uids)[-2:], ['2', '1'])
+        self.assertEqual(len(betterimap.MessageSet('1:1000000000')), 10 ** 9)
+
+    def testParseEsearch(self):
+        self.assertEqual(
+            betterimap._parse_esearch('(TAG "A1") UID MIN 2 COUNT 3'),
+            {'UID': True, 'MIN': 2, 'COUNT': 3})
+        result = betterimap._parse_esearch(
+            '(TAG "A1") UID COUNT 0 PARTIAL (1:10 NIL)')
+        self.assertEqual(len(result['PARTIAL']), 0)
+
+    def testSearchUsesEsearchRanges(self):
+        self.setCapabilities('IMAP4rev1 ESEARCH')
+        self.esearch = [None, ['(TAG "A1") UID ALL 1:1000000']]
+        self.imap.mail.uid.side_effect = [
+            ('OK', [None]),
+            ('OK', [
+                ('1 (UID 1000000 RFC822 {12}', 'Subject: 1\r\n'), ')',
+                ('2 (UID 999999 RFC822 {12}', 'Subject: 2\r\n'), ')',
+            ]),
+        ]
+
+        msgs = list(self.imap.search(limit=2))
+
+        self.assertEqual([msg.uid for msg in msgs], ['1000000', '999999'])
+        self.assertEqual(self.imap.mail.uid.call_args_list, [
+            mock.call('SEARCH', 'RETURN', '(ALL)', 'CHARSET', 'utf-8', 'ALL'),
+            mock.call('FETCH', '999999:1000000', '(UID RFC822)'),
+        ])
+
+    def testSearchGetsTheNewestWithPartial(self):
+        self.setCapabilities('IMAP4rev1 ESEARCH PARTIAL')
+        self.esearch = [
+            None, ['(TAG "A1") UID COUNT 40000 PARTIAL (-1:-3 39998:40000)']]
+        self.imap.mail.uid.return_value = ('OK', [None])
+
+        count, uids = self.imap._search_window('UNSEEN', 3, reverse=True)
+
+        self.assertEqual(count, 40000)
+        self.assertEqual(list(uids), ['40000', '39999', '39998'])
+        self.imap.mail.uid.assert_called_once_with(
+            'SEARCH', 'RETURN', '(COUNT PARTIAL -1:-3)', 'CHARSET', 'utf-8',
+            'UNSEEN')
+
+    def testSearchCountsFirstWithContextSearch(self):
+        self.setCapabilities('IMAP4rev1 ESEARCH CONTEXT=SEARCH')
+        self.esearch = [
+            None, ['(TAG "A1") UID COUNT 10'],
+            None, ['(TAG "A2") UID COUNT 10 PARTIAL (8:10 20,31:32)']]
+        self.imap.mail.uid.return_value = ('OK', [None])
+
+        count, uids = self.imap._search_window('ALL', 3, reverse=True)
+
+        self.assertEqual(count, 10)
+        self.assertEqual(list(uids), ['32', '31', '20'])
+        self.assertEqual(
+            [call[0][2] for call in self.imap.mail.uid.call_args_list],
+            ['(COUNT)', '(COUNT PARTIAL 8:10)'])
+
+    def testSearchWithoutLimitGetsAllRanges(self):
+        self.setCapabilities('IMAP4rev1 ESEARCH PARTIAL')
+        self.esearch = [None, ['(TAG "A1") UID COUNT 0']]
+        self.imap.mail.uid.return_value = ('OK', [None])
+
+        count, uids = self.imap._search_window('ALL', None)
+
+        self.assertEqual((count, list(uids)), (0, []))
+        self.imap.mail.uid.assert_called_once_with(
+            'SEARCH', 'RETURN', '(ALL)', 'CHARSET', 'utf-8', 'ALL')
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, client = socket_pair()
+        self.addCleanup(self.server.close)
+        self.addCleanup(client.close)
+        self.mail = object.__new__(betterimap.IMAP4)
+        self.mail.sock = client
+        self.mail.file = client.makefile('rb')
+        self.mail.capabilities = ('IMAP4REV1', 'COMPRESS=DEFLATE')
+        self.mail._simple_command = mock.Mock(return_value=('OK', ['ok']))
+
+    def testCompressedReadAndSend(self):
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = '* 1 FETCH (RFC822 {11}\r\nhello world)\r\n' * 20
+
+        self.mail.compress()
+        self.server.sendall(
+            compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.mail.send('A1 NOOP\r\n')
+
+        self.mail._simple_command.assert_called_once_with(
+            'COMPRESS', 'DEFLATE')
+        self.assertEqual(
+            self.mail.readline(), '* 1 FETCH (RFC822 {11}\r\n')
+        self.assertEqual(self.mail.read(11), 'hello world')
+        self.assertEqual(self.mail.readline(), ')\r\n')
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.assertEqual(
+            decompressor.decompress(self.server.recv(1024)), 'A1 NOOP\r\n')
+        self.assertEqual(self.mail.bytes_in, len(data))
+        self.assertLess(self.mail.wire_bytes_in, len(data) / 5)
+        self.assertEqual(self.mail.bytes_out, 9)
+        self.assertGreater(self.mail.compression_ratio, 1)
+
+    def testCompressDecompressesDataBufferedBeforeCompress(self):
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.server.sendall(
+            'A1 OK done\r\n' +
+            compressor.compress('* 2 EXISTS\r\n') +
+            compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.assertEqual(self.mail.readline(), 'A1 OK done\r\n')
+
+        self.mail.compress()
+
+        self.assertEqual(self.mail.readline(), '* 2 EXISTS\r\n')
+
+    def testCompressedReadOfLargeLiteral(self):
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        literal = ''.join('line %08d\r\n' % i for i in xrange(600000))
+        data = '* 1 FETCH (RFC822 {%d}\r\n%s)\r\n' % (len(literal), literal)
+        self.mail.compress()
+        sender = threading.Thread(target=self.server.sendall, args=(
+            compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH),))
+        sender.daemon = True
+        sender.start()
+
+        start = time.time()
+        self.assertEqual(
+            self.mail.readline(), '* 1 FETCH (RFC822 {%d}\r\n' % len(literal))
+        self.assertEqual(self.mail.read(len(literal)), literal)
+        self.assertEqual(self.mail.readline(), ')\r\n')
+
+        # Copying the whole buffer on each read took many seconds here.
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(self.mail.buffered_in, 0)
+        sender.join()
+
+    def testCompressRaisesNotSupported(self):
+        self.mail.capabilities = ('IMAP4REV1', )
+        self.assertRaises(betterimap.NotSupported, self.mail.compress)
+        self.assertFalse(self.mail.compressed)
+
+
+class RecvIntoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, client = socket_pair()
+        self.addCleanup(self.server.close)
+        self.addCleanup(client.close)
+        self.mail = object.__new__(betterimap.IMAP4)
+        self.mail.sock = client
+        self.mail.file = client.makefile('rb')
+
+    def testReadsLiteralsAfterBufferedData(self):
+        self.server.sendall('* 1 FETCH (RFC822 {5}\r\nhello)\r\n')
+        self.assertEqual(
+            self.mail.readline(), '* 1 FETCH (RFC822 {5}\r\n')
+        # Part of the literal is buffered by readline(), the rest is not
+        # received yet.
+        self.server.sendall('* 2 FETCH (RFC822 {11}\r\nhello world)\r\n')
+
+        self.assertEqual(self.mail.read(5), 'hello')
+        self.assertEqual(self.mail.readline(), ')\r\n')
+        self.assertEqual(
+            self.mail.readline(), '* 2 FETCH (RFC822 {11}\r\n')
+        self.assertEqual(self.mail.read(3), 'hel')
+        self.assertEqual(self.mail.read(8), 'lo world')
+        self.assertEqual(self.mail.readline(), ')\r\n')
+
+    @mock.patch('betterimap.LITERAL_BUFFER_SIZE', 4)
+    def testReadsLiteralsLargerThanBuffer(self):
+        self.server.sendall('ab')
+        self.assertEqual(self.mail.read(1), 'a')
+        self.server.sendall('cdefgh')
+
+        self.assertEqual(self.mail.read(6), 'bcdefg')
+        self.assertEqual(self.mail.read(1), 'h')
+
+
+class StreamMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, client = socket_pair()
+        self.addCleanup(self.server.close)
+        self.addCleanup(client.close)
+        self.mail = object.__new__(betterimap.IMAP4)
+        self.mail.sock = client
+        self.mail.file = client.makefile('rb')
+        self.mail.stream_messages = True
+        for name, value in (
+            ('STREAM_MIN_SIZE', 10), ('STREAM_CHUNK_SIZE', 7)
+        ):
+            patcher = mock.patch.object(betterimap, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def testParsesMessageLiteralsWhileReading(self):
+        raw = (
+            'Subject: streamed\r\n'
+            'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+            '--b\r\nContent-Type: text/plain\r\n\r\nhello\r\n'
+            '--b\r\nContent-Type: text/html\r\n\r\n<b>hi</b>\r\n'
+            '--b--\r\n')
+        self.server.sendall(
+            '* 1 FETCH (UID 3 BODY[] {%d}\r\n%s BODY[1] {%d}\r\n%s)\r\n' % (
+                len(raw), raw, len(raw), raw))
+
+        self.mail.readline()
+        parsed = self.mail.read(len(raw))
+        self.mail.readline()
+        part = self.mail.read(len(raw))
+
+        self.assertIsInstance(parsed, betterimap._ParsedMessage)
+        self.assertEqual(len(parsed), len(raw))
+        self.assertEqual(
+            parsed.message.as_string(),
+            email.message_from_string(raw).as_string())
+        # Only whole messages are parsed.
+        self.assertEqual(part, raw)
+        msg = IMAPAdapterStub().parse_email(parsed)
+        self.assertEqual(msg.subject, u'streamed')
+        self.assertEqual(msg.html(), '<b>hi</b>')
+
+    def testAdapterStreamsOnlyDuringItsOwnFetches(self):
+        imap = IMAPAdapterStub()
+        imap.mail = mock.Mock(stream_messages=False)
+        streaming = []
+
+        def fetch(*args):
+            streaming.append(imap.mail.stream_messages)
+            return ('OK', [('1 (RFC822 {12}', 'Subject: 1\r\n'), ')'])
+        imap.mail.fetch.side_effect = fetch
+
+        msg = imap.fetch_email_by_uid('1')
+
+        self.assertEqual(msg.subject, u'1')
+        self.assertEqual(streaming, [True])
+        self.assertFalse(imap.mail.stream_messages)
+
+
+class GmailTest(unittest.TestCase):
+
+    def testSearchFetchesGmailAttributesWithTheMessage(self):
+        imap = GmailStub(x_gm_fetch_items=['X-GM-MSGID', 'X-GM-LABELS'])
+        imap.mail = mock.Mock()
+        imap.mail.capability.return_value = ('OK', ['IMAP4rev1'])
+        imap.mail.search.return_value = ('OK', ['1'])
+        imap.mail.fetch.return_value = ('OK', [
+            ('1 (X-GM-MSGID 1417 X-GM-LABELS (\\Inbox "a b") RFC822 {12}',
+             'Subject: 1\r\n'), ')',
+        ])
+
+        msg, = imap.search()
+
+        self.assertEqual(msg.x_gm_msgid, '1417')
+        self.assertEqual(msg.x_gm_labels, [u'\\Inbox', u'a b'])
+        self.assertIsNone(msg.x_gm_thrid)
+        imap.mail.fetch.assert_called_once_with(
+            '1', '(X-GM-MSGID X-GM-LABELS RFC822)')
+
+    @mock.patch('betterimap.Gmail.get_access_token')
+    def testExpiredAccessTokenIsRefreshedOnce(self, get_access_token):
+        imap = GmailStub()
+        imap.mail = mock.Mock()
+        imap.access_token = 'expired'
+        imap.refresh_token = 'refresh'
+        imap.refresh_token_callback = mock.Mock()
+        get_access_token.return_value = {'access_token': 'new'}
+        auth_strings = []
+
+        def authenticate(mechanism, callback):
+            auth_strings.append(callback(None))
+            if 'expired' in auth_strings[-1]:
+                raise imaplib.IMAP4.error('AUTHENTICATE failed')
+        imap.mail.authenticate.side_effect = authenticate
+
+        imap._auth_token('user')
+
+        self.assertEqual(auth_strings, [
+            'user=user\1auth=Bearer expired\1\1',
+            'user=user\1auth=Bearer new\1\1'])
+        self.assertEqual(imap.access_token, 'new')
+        imap.refresh_token_callback.assert_called_once_with(
+            {'access_token': 'new'})
+
+        imap.access_token = 'expired'
+        get_access_token.return_value = {'access_token': 'expired'}
+        self.assertRaises(betterimap.OAuth2Error, imap._auth_token, 'user')
+        self.assertEqual(get_access_token.call_count, 2)
+
+
+class FetchResponseParsingTest(unittest.TestCase):
+
+    def testSplitMessageSets(self):
+        self.assertEqual(
+            betterimap._split_message_sets(
+                [1, 2, 3, 10, 20, 21, 30], max_length=8),
+            ['1:3,10', '20:21,30'])
+
+    def testCompressUids(self):
+        self.assertEqual(
+            betterimap._compress_uids(['5', 1, '2', '3', '10', '9', '3']),
+            '1:3,5,9:10')
+
+    def testParseImapList(self):
+        self.assertEqual(
+            betterimap._parse_imap_list(
+                r'(FLAGS (\Seen) X "a \"b\"" NIL '
+                r'BODY[HEADER.FIELDS (TO)] {3})',
+                ['abc']),
+            [['FLAGS', ['\\Seen'], 'X', 'a "b"', None,
+              'BODY[HEADER.FIELDS (TO)]', 'abc']])
+
+    def testParseFetchResponse(self):
+        data = [
+            ('1 (UID 10 RFC822 {5}', 'hello'), ' FLAGS (\\Seen))',
+            '2 (UID 11 FLAGS ())',
+        ]
+        self.assertEqual(betterimap._parse_fetch_response(data), [
+            ('1', {'UID': '10', 'RFC822': 'hello', 'FLAGS': ['\\Seen']}),
+            ('2', {'UID': '11', 'FLAGS': []}),
+        ])
+
+    def testParseBodystructureNumbersNestedParts(self):
+        structure = betterimap._parse_imap_list(
+            '(("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1)'
+            '("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 300 NIL '
+            '(("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1)'
+            '("IMAGE" "PNG" ("NAME" "=?utf-8?b?0L0ucG5n?=") NIL NIL "BASE64" '
+            '78) "MIXED") 10) "MIXED")')[0]
+
+        body = betterimap.BodyPart.parse(structure)
+
+        self.assertEqual(
+            [(p.part, p.content_type) for p in body.walk()], [
+                ('', 'multipart/mixed'),
+                ('1', 'text/plain'),
+                ('2', 'message/rfc822'),
+                ('2', 'multipart/mixed'),
+                ('2.1', 'text/plain'),
+                ('2.2', 'image/png'),
+            ])
+        self.assertEqual(list(body.walk())[-1].filename, u'\u043d.png')
+        self.assertEqual(
+            betterimap.BodyPart.parse(
+                ['TEXT', 'PLAIN', None, None, None, '7BIT', '5', '1']).part,
+            '1')
 
+    def testTransferDecoderDecodesSplitData(self):
+        for encoding, data in [
+            ('base64', 'aGVsbG8g\r\nd29ybGQ=\r\n'),
+            ('quoted-printable', 'caf=C3=A9 =\r\nau lait \r\nx=3D1'),
+        ]:
+            decoder = betterimap._TransferDecoder(encoding)
+            decoded = ''.join(decoder.decode(char) for char in data)
+            self.assertEqual(
+                decoded + decoder.flush(),
+                betterimap._decode_transfer_encoding(data, encoding))
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+import datetime
+import unittest
+
+import mock
+
+import betterimap
+from betterimap import index
+
+# The tests run without numpy, unless they say otherwise.
+numpy = index.numpy
+
+
+def make_envelope(uid, day, sender, size, flags):
+    return betterimap.Envelope({
+        'ENVELOPE': [
+            '%02d Sep 2014 10:00:00 +0000' % day, 'subject',
+            [[None, None, sender, 'example.com']],
+            None, None, None, None, None, None, None],
+        'RFC822.SIZE': str(size),
+        'FLAGS': flags,
+        'INTERNALDATE': '%02d-Sep-2014 10:00:00 +0000' % day,
+    })
+
+
+class MailboxIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.envelopes = {
+            1: make_envelope(1, 1, 'a', 100, ['\\Seen']),
+            2: make_envelope(2, 2, 'b', 2000, []),
+            3: make_envelope(3, 3, 'A', 300, ['\\Seen', '$Label']),
+        }
+        for uid, envelope in self.envelopes.iteritems():
+            envelope.uid = uid
+        self.adapter = mock.Mock(spec=betterimap.IMAPAdapter)
+        self.adapter.uidvalidity = 42
+        self.adapter._search_ids.side_effect = lambda *args, **kwargs: (
+            [str(uid) for uid in sorted(self.envelopes)])
+        self.adapter._fetch_batch.side_effect = lambda uids, *args, **kw: [
+            self.envelopes[uid] for uid in uids]
+        self.patch_numpy = mock.patch.object(index, 'numpy', None)
+        self.patch_numpy.start()
+        self.index = index.MailboxIndex(self.adapter, 'INBOX')
+
+    def tearDown(self):
+        self.patch_numpy.stop()
+
+    def testQuery(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.query(), [1, 2, 3])
+        self.assertEqual(
+            self.index.query(since=datetime.date(2014, 9, 2)), [2, 3])
+        self.assertEqual(
+            self.index.query(sent_before=datetime.date(2014, 9, 2)), [1])
+        self.assertEqual(self.index.query(sender='a@EXAMPLE.com'), [1, 3])
+        self.assertEqual(self.index.query(max_size=300), [1, 3])
+        self.assertEqual(self.index.query(flags=['\\seen', '$Label']), [3])
+        self.assertEqual(self.index.query(without_flags=['\\Seen']), [2])
+        self.assertEqual(self.index.query(flags=['$Unknown']), [])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def testNumpyQueriesMatchPythonQueries(self):
+        queries = [
+            {},
+            {'since': datetime.date(2014, 9, 2)},
+            {'before': datetime.datetime(2014, 9, 3, 10)},
+            {'sent_since': datetime.date(2014, 9, 2), 'max_size': 1000},
+            {'sender': ['a@example.com', 'b@example.com'], 'min_size': 200},
+            {'flags': ['\\Seen'], 'without_flags': ['$Label']},
+            {'without_flags': ['\\Seen', '$Unknown']},
+            {'sender': 'nobody@example.com'},
+        ]
+        for kwargs in queries:
+            expected = self.index.query(**kwargs)
+            with mock.patch.object(index, 'numpy', numpy):
+                self.assertEqual(self.index.query(**kwargs), expected, kwargs)
+
+    def testRefreshFetchesOnlyNewMessagesAndDropsExpunged(self):
+        del self.envelopes[2]
+        self.envelopes[4] = make_envelope(4, 4, 'c', 10, [])
+        self.envelopes[4].uid = 4
+
+        self.index.refresh()
+
+        self.assertEqual(list(self.index.uids), [1, 3, 4])
+        self.assertEqual(self.index.query(sender='c@example.com'), [4])
+        self.assertEqual(
+            self.adapter._fetch_batch.call_args[0][0], [4])
+
+    def testRefreshRebuildsIfUidValidityChanged(self):
+        self.adapter.uidvalidity = 43
+
+        self.index.refresh()
+
+        self.assertEqual(list(self.index.uids), [1, 2, 3])
+        self.assertEqual(self.adapter._fetch_batch.call_count, 2)
@@ -1,8 +1,11 @@
 # coding: utf-8
 
+import copy
 import datetime
+import email.header
 import email.message
 import os
+import pickle
 
 import mock
 import pytz
@@ -22,6 +25,10 @@ class MessageWrapperTest(base.BaseMockTest):
 
     UNICODE_MSG = u'Длинное сообщение'
 
+    def setUp(self):
+        betterimap.header_cache.clear()
+        betterimap.chardet_cache.clear()
+
     def testParseDateReturnsAwareDateTimeIfTimezoneProvided(self):
         dt = 'Sun, 28 Sep 2014 00:00:06 -0400 (EDT)'
         expected = self.EDT.localize(datetime.datetime(2014, 9, 28, 0, 0, 6))
@@ -100,6 +107,115 @@ class MessageWrapperTest(base.BaseMockTest):
             [('', 'anybody@gmail.com'), (u'Игорь Яковлев', 'address@gmail.com')]
         )
 
+    def testHeadersAreDecodedOnceUntilChanged(self):
+        msg = email.message.Message()
+        msg['Subject'] = '=?UTF-8?B?0KLQtdGB0YI=?='
+        msg['Date'] = 'Sun, 28 Sep 2014 00:00:06 -0400'
+        msg = self.testcls(msg)
+        get_header = self.patch(
+            'betterimap.MessageWrapper._get_header',
+            wraps=self.testcls._get_header)
+
+        self.assertEqual(msg.subject, u'Тест')
+        self.assertEqual(msg.subject, u'Тест')
+        self.assertEqual(msg.date, msg.date)
+        self.assertEqual(get_header.call_count, 2)
+
+        msg.replace_header('Subject', 'other')
+        self.assertEqual(msg.subject, u'other')
+
+    def testWrappersCanBeCopiedAndPickled(self):
+        msg = email.message.Message()
+        msg['Subject'] = 'test'
+        wrapper = self.testcls(msg)
+        wrapper.uid = '12'
+        self.assertEqual(wrapper.subject, u'test')
+        self.assertFalse(hasattr(wrapper, '__dict__'))
+
+        for copied in (
+            copy.copy(wrapper), copy.deepcopy(wrapper),
+            pickle.loads(pickle.dumps(wrapper)),
+            pickle.loads(pickle.dumps(wrapper, pickle.HIGHEST_PROTOCOL)),
+        ):
+            self.assertEqual(copied.uid, '12')
+            self.assertEqual(copied.subject, u'test')
+            self.assertEqual(copied.get_content_type(), 'text/plain')
+
+    def testGetHeaderResultsAreSharedBetweenMessages(self):
+        self.patch('betterimap.chardet', None)
+        decode_header = self.patch(
+            'email.header.decode_header', wraps=email.header.decode_header)
+        msgs = []
+        for _ in xrange(2):
+            msg = email.message.Message()
+            msg['Subject'] = '=?UTF-8?B?0KLQtdGB0YI=?= x'
+            msgs.append(self.testcls(msg))
+
+        self.assertEqual([m.subject for m in msgs], [u'Тест x', u'Тест x'])
+        self.assertEqual(decode_header.call_count, 1)
+        self.assertEqual(betterimap.header_cache.hit_rate, 0.5)
+
+        self.patch('betterimap.header_cache.max_size', 0)
+        self.assertEqual(self.testcls._get_header('x'), [u'x'])
+        self.assertEqual(len(betterimap.header_cache), 1)
+
+
+class CharsetDetectorTest(base.BaseMockTest):
+
+    def setUp(self):
+        betterimap.chardet_cache.clear()
+        self.backend = mock.Mock()
+        self.backend.detect.return_value = {
+            'encoding': 'windows-1251', 'confidence': 0.9}
+        self.detector = betterimap.CharsetDetector(
+            backend=self.backend, sample_size=10)
+
+    def testUtf8IsDetectedWithoutBackend(self):
+        self.detector.sample_size = 100
+        self.assertEqual(
+            self.detector.detect(u'Длинное'.encode('utf-8')),
+            {'encoding': 'utf-8', 'confidence': 0.99})
+        self.assertEqual(
+            self.detector.detect(u'aé'.encode('utf-8')),
+            {'encoding': 'utf-8', 'confidence': 0.505})
+        self.assertEqual(
+            self.detector.detect('abc'),
+            {'encoding': 'ascii', 'confidence': 1})
+        self.assertFalse(self.backend.detect.called)
+        self.assertEqual(self.detector.calls, 3)
+
+    def testBackendGetsSampleOnly(self):
+        data = u'Длинное сообщение'.encode('cp1251') * 1000
+
+        detected = self.detector.detect(data)
+
+        self.assertEqual(detected['encoding'], 'windows-1251')
+        self.backend.detect.assert_called_once_with(data[:10])
+
+    def testCacheIsNotSharedBetweenBackends(self):
+        other_backend = mock.Mock()
+        other_backend.detect.return_value = {
+            'encoding': 'koi8-r', 'confidence': 0.8}
+        other = betterimap.CharsetDetector(
+            backend=other_backend, sample_size=10)
+        data = u'Тема'.encode('cp1251')
+        first = self.backend.detect.return_value
+
+        self.assertEqual(self.detector.detect(data), first)
+        self.assertEqual(other.detect(data)['encoding'], 'koi8-r')
+        self.assertEqual(self.detector.detect(data), first)
+        self.assertEqual(self.backend.detect.call_count, 1)
+
+    def testGetTextUsesDetector(self):
+        self.patch('betterimap.charset_detector', self.detector)
+        msg = email.message.Message()
+        msg['Content-Type'] = 'text/plain; charset=bad-charset'
+        msg.set_payload(u'Длинное сообщение'.encode('cp1251'))
+
+        text = betterimap.MessageWrapper(msg).get_text()
+
+        self.assertEqual(text, u'Длинное сообщение')
+
 
 class Email1Test(base.BaseMockTest):
 
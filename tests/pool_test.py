@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import socket
+import unittest
+
+import mock
+
+import betterimap
+from betterimap import pool
+
+
+def make_adapter(folder=None):
+    adapter = mock.Mock(spec=betterimap.IMAPAdapter)
+    adapter.host = 'host'
+    adapter.selected_folder = folder
+    adapter.idling = False
+    adapter.copy.side_effect = make_adapter
+    return adapter
+
+
+class IMAPAdapterPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = make_adapter()
+        self.pool = pool.IMAPAdapterPool(
+            self.adapter, max_size=2, timeout=0, health_check_after=0)
+
+    def testCheckoutReusesConnections(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.assertIs(self.pool.checkout(), conn)
+        self.assertEqual(self.adapter.copy.call_count, 1)
+
+    def testCheckoutPrefersConnectionWithSelectedFolder(self):
+        conn1 = self.pool.checkout()
+        conn2 = self.pool.checkout()
+        conn1.selected_folder = 'Sent'
+        conn2.selected_folder = 'INBOX'
+        self.pool.checkin(conn1)
+        self.pool.checkin(conn2)
+
+        self.assertIs(self.pool.checkout('Sent'), conn1)
+
+    def testCheckoutRaisesPoolTimeoutIfExhausted(self):
+        self.pool.checkout()
+        self.pool.checkout()
+        self.assertRaises(pool.PoolTimeout, self.pool.checkout)
+
+    def testCheckoutReplacesDeadConnections(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        conn.noop.side_effect = socket.error
+
+        new_conn = self.pool.checkout()
+
+        self.assertIsNot(new_conn, conn)
+        conn.logout.assert_called_once_with()
+        self.assertEqual(self.pool.size, 1)
+
+    def testConnectionDiscardsAbortedConnections(self):
+        with self.assertRaises(socket.error):
+            with self.pool.connection() as conn:
+                raise socket.error()
+        conn.logout.assert_called_once_with()
+        self.assertEqual(self.pool.size, 0)
+
+    def testReapClosesIdleConnections(self):
+        self.pool.max_idle_time = -1
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        conn.logout.assert_called_once_with()
+        self.assertEqual(self.pool.size, 0)
@@ -0,0 +1,257 @@
+# coding: utf-8
+
+import socket
+import threading
+import unittest
+
+import mock
+
+from betterimap import protocol
+
+
+class FakeServer(threading.Thread):
+    """Serves plain text connections, answering commands with handlers.
+
+    handlers map command names to functions (tag, line) -> response string,
+    or None to close the connection.
+    """
+
+    def __init__(self, handlers, connections=1):
+        super(FakeServer, self).__init__()
+        self.daemon = True
+        self.handlers = handlers
+        self.connections = connections
+        self.lines = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        for _ in xrange(self.connections):
+            self.serve()
+
+    def serve(self):
+        conn, _ = self.listener.accept()
+        reader = conn.makefile('rb')
+        conn.sendall('* OK [CAPABILITY IMAP4rev1 IDLE] ready\r\n')
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            line = line.rstrip('\r\n')
+            self.lines.append(line)
+            if line == 'DONE':
+                tag, name = None, 'DONE'
+            else:
+                tag, name = line.split(' ')[:2]
+                if name == 'UID':
+                    name = line.split(' ')[2]
+            response = self.handlers[name](tag, line)
+            if response is None:
+                break
+            conn.sendall(response)
+            if name == 'LOGOUT':
+                break
+        conn.close()
+
+
+class ResponseReaderTest(unittest.TestCase):
+
+    data = (
+        '* 3 EXISTS\r\n'
+        '* OK [UIDVALIDITY 42] UIDs valid\r\n'
+        '* 1 FETCH (UID 5 RFC822 {5}\r\nhello FLAGS ())\r\n'
+        '* 2 FETCH (UID 6 RFC822 {0}\r\n)\r\n'
+        '+ idling\r\n'
+        'A1 OK done\r\n')
+    responses = [
+        ('*', 'EXISTS', ['3']),
+        ('*', 'OK', ['[UIDVALIDITY 42] UIDs valid']),
+        ('*', 'UIDVALIDITY', ['42']),
+        ('*', 'FETCH', [('1 (UID 5 RFC822 {5}', 'hello'), ' FLAGS ())']),
+        ('*', 'FETCH', [('2 (UID 6 RFC822 {0}', ''), ')']),
+        ('+', None, ['idling']),
+        ('A1', 'OK', ['done']),
+    ]
+
+    def feed(self, chunk_size):
+        reader = protocol.ResponseReader()
+        responses = []
+        for i in xrange(0, len(self.data), chunk_size):
+            responses.extend(reader.feed(self.data[i:i + chunk_size]))
+        return responses
+
+    def testFeedSplitsResponsesAndLiterals(self):
+        # Byte by byte, to check partial lines and literals.
+        self.assertEqual(self.feed(1), self.responses)
+
+    def testFeedParsesManyResponsesAtOnce(self):
+        self.assertEqual(self.feed(len(self.data)), self.responses)
+        self.assertEqual(self.feed(7), self.responses)
+
+
+class IMAPProtocolTest(unittest.TestCase):
+
+    def testCommandsAreSentOneByOneAfterGreeting(self):
+        proto = protocol.IMAPProtocol()
+        results = []
+        proto.command(
+            'SEARCH', 'ALL', callback=lambda *args: results.append(args))
+        proto.command('NOOP', callback=lambda *args: results.append(args))
+        self.assertEqual(proto.data_to_send(), '')
+
+        proto.receive_data('* OK ready\r\n')
+        self.assertEqual(proto.data_to_send(), 'BI1 SEARCH ALL\r\n')
+
+        proto.receive_data('* SEARCH 1 2\r\nBI1 OK done\r\n')
+        self.assertEqual(proto.data_to_send(), 'BI2 NOOP\r\n')
+        proto.receive_data('BI2 NO failed\r\n')
+
+        self.assertEqual(results, [('OK', ['1 2']), ('NO', ['failed'])])
+        self.assertFalse(proto.busy)
+
+
+class AsyncIMAPAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.idle_tag = None
+        self.reject_idle = False
+        self.server = FakeServer({
+            'CAPABILITY': lambda tag, _: (
+                '* CAPABILITY IMAP4rev1 IDLE\r\n%s OK done\r\n' % tag),
+            'LOGIN': lambda tag, _: '%s OK logged in\r\n' % tag,
+            'SELECT': lambda tag, _: (
+                '* 3 EXISTS\r\n* OK [UIDVALIDITY 42] ok\r\n'
+                '%s OK [READ-WRITE] done\r\n' % tag),
+            'SEARCH': lambda tag, _: '* SEARCH 1 3\r\n%s OK done\r\n' % tag,
+            'FETCH': self.fetch,
+            'IDLE': self.idle,
+            'DONE': lambda *_: '%s OK idle done\r\n' % self.idle_tag,
+            'LOGOUT': lambda tag, _: '* BYE bye\r\n%s OK done\r\n' % tag,
+        })
+        self.server.start()
+        self.imap = protocol.AsyncIMAPAdapter(
+            'user', 'password', host='127.0.0.1', port=self.server.port,
+            use_uid=True)
+        self.loop = self.imap.loop
+        self.loop.run_until_complete(self.imap.connect())
+
+    def tearDown(self):
+        if self.imap.sock is not None:
+            self.loop.run_until_complete(self.imap.logout())
+        self.server.join(1)
+
+    def fetch(self, tag, line):
+        words = line.split(' ')
+        message_set = words[words.index('FETCH') + 1]
+        uids = message_set.replace(':', ',').split(',')
+        response = ''
+        for uid in uids:
+            body = 'Subject: %s\r\n' % uid
+            response += '* %s FETCH (UID %s RFC822 {%d}\r\n%s)\r\n' % (
+                uid, uid, len(body), body)
+        return response + '%s OK done\r\n' % tag
+
+    def idle(self, tag, _):
+        self.idle_tag = tag
+        if self.reject_idle:
+            return '%s NO IDLE is not allowed now\r\n' % tag
+        if len([l for l in self.server.lines if 'IDLE' in l]) == 1:
+            return '+ idling\r\n* 4 EXISTS\r\n'
+        return '+ idling\r\n'
+
+    def testSelectAndSearch(self):
+        total = self.loop.run_until_complete(self.imap.select('INBOX'))
+        msgs = self.loop.run_until_complete(self.imap.search())
+
+        self.assertEqual(total, 3)
+        self.assertEqual(self.imap.uidvalidity, 42)
+        self.assertEqual([m.subject for m in msgs], [u'3', u'1'])
+        self.assertEqual(
+            [m.key for m in msgs], [('INBOX', 42, '3'), ('INBOX', 42, '1')])
+
+    def testIdleFetchesNewMessages(self):
+        self.loop.run_until_complete(self.imap.select('INBOX'))
+        received = []
+        stop = self.imap.idle(received.append)
+        while not received:
+            self.loop.run_once()
+        self.loop.run_until_complete(stop())
+
+        self.assertEqual([m.uid for m in received], ['4'])
+        self.assertIn('DONE', self.server.lines)
+
+    def testRejectedIdleClosesTheConnection(self):
+        self.reject_idle = True
+        self.loop.run_until_complete(self.imap.select('INBOX'))
+        self.imap.idle(lambda msg: None)
+
+        reason = self.loop.run_until_complete(self.imap.closed)
+
+        self.assertIn('IDLE is not allowed now', str(reason))
+        self.assertIsNone(self.imap.sock)
+        self.assertIsNone(self.imap._idle)
+
+
+class AsyncIdleCountsTest(unittest.TestCase):
+
+    def testExpungeAboveFetchedMessagesKeepsThemNew(self):
+        imap = protocol.AsyncIMAPAdapter('user', 'password', host='localhost')
+        imap.protocol = mock.Mock()
+        imap.total = 6
+        imap._idle = dict(total=4, done_sent=False, timer=None)
+
+        # 5 was not fetched yet, 2 was.
+        imap._on_untagged('EXPUNGE', ['5', '2'])
+
+        self.assertEqual(imap.total, 4)
+        self.assertEqual(imap._idle['total'], 3)
+
+
+class IdleMultiplexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.idles = 0
+        self.server = FakeServer({
+            'CAPABILITY': lambda tag, _: (
+                '* CAPABILITY IMAP4rev1 IDLE\r\n%s OK done\r\n' % tag),
+            'LOGIN': lambda tag, _: '%s OK logged in\r\n' % tag,
+            'SELECT': lambda tag, _: (
+                '* 3 EXISTS\r\n%s OK [READ-WRITE] done\r\n' % tag),
+            'FETCH': lambda tag, _: (
+                '* 4 FETCH (RFC822 {14}\r\nSubject: new\r\n)\r\n'
+                '%s OK done\r\n' % tag),
+            'IDLE': self.idle,
+            'DONE': lambda *_: '%s OK idle done\r\n' % self.idle_tag,
+            'LOGOUT': lambda tag, _: '* BYE bye\r\n%s OK done\r\n' % tag,
+        }, connections=2)
+        self.server.start()
+        patcher = mock.patch.object(protocol, 'RECONNECT_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def idle(self, tag, _):
+        self.idle_tag = tag
+        self.idles += 1
+        if self.idles == 1:
+            # Drop the first connection.
+            return None
+        return '+ idling\r\n* 4 EXISTS\r\n'
+
+    def testReconnectsAndPutsNewMessagesIntoQueue(self):
+        mux = protocol.IdleMultiplexer()
+        key = mux.add(
+            protocol.AsyncIMAPAdapter(
+                'user', 'password', host='127.0.0.1', port=self.server.port),
+            fetch_spec=protocol.FETCH_RFC822)
+        while mux.queue.empty():
+            mux.loop.run_once()
+        mux.loop.run_until_complete(mux.remove(key))
+        self.server.join(1)
+
+        self.assertEqual(key, ('user', 'INBOX'))
+        (key, msg), = [mux.queue.get_nowait()]
+        self.assertEqual(msg.subject, u'new')
+        self.assertEqual(self.server.lines.count('BI1 CAPABILITY'), 2)
+        self.assertEqual(len(mux), 0)